@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Batch image filtering over many files with a worker pool
+
+Invoked as, for example:
+   python3 batch.py 'test_images/*.png' 'blur:9,edges,sharpen:7' -o out --workers 8
+
+The chain is a comma-separated list of filters applied in order:
+   blur:N     box blur with kernel size N (make_blur_filter)
+   sharpen:N  unsharp mask with kernel size N (make_sharpen_filter)
+   edges      Sobel edge detection
+   invert     color inversion (inverted)
+
+Every image is printed with its latency as it finishes, followed by the
+overall throughput.  Results keep the inputs' paths relative to the
+directory they have in common, so a recursive glob cannot overwrite one
+result with another.
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import lab
+
+FILTERS = {
+    'blur': lab.make_blur_filter,
+    'sharpen': lab.make_sharpen_filter,
+    'edges': lambda: lab.edges,
+    'invert': lambda: lab.inverted,
+}
+
+
+def parse_chain(spec):
+    '''
+    Build the greyscale filters named by a chain spec like 'blur:9,edges'
+
+    Returns:
+    A list of greyscale filters, in order
+    '''
+    filters = []
+    for step in spec.split(','):
+        name, _, arg = step.strip().partition(':')
+        if name not in FILTERS:
+            raise ValueError('Unknown filter %r (expected one of %s)' % (name, ', '.join(sorted(FILTERS))))
+        if name in ('blur', 'sharpen'):
+            if not arg.isdigit() or int(arg) < 1:
+                raise ValueError('%s needs a positive kernel size, as in %s:5' % (name, name))
+            filters.append(FILTERS[name](int(arg)))
+        elif arg:
+            raise ValueError('%s takes no argument' % name)
+        else:
+            filters.append(FILTERS[name]())
+    return filters
+
+
+def output_names(filenames, out_dir):
+    '''
+    Name the result of every input after its path relative to the inputs'
+    common directory (the root of a recursive glob), mirrored under out_dir
+    and saved as PNG, so a/x.png and b/x.png do not overwrite each other
+
+    Returns:
+    A list of output filenames, one per input, or raises ValueError if two
+    inputs would still share one (such as x.png and x.jpg side by side)
+    '''
+    if not filenames:
+        return []
+    paths = [os.path.abspath(filename) for filename in filenames]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    names = [os.path.join(out_dir, os.path.splitext(os.path.relpath(path, root))[0] + '.png')
+             for path in paths]
+    seen = {}
+    for filename, name in zip(filenames, names):
+        if name in seen:
+            raise ValueError('%s and %s would both be saved as %s' % (seen[name], filename, name))
+        seen[name] = filename
+    return names
+
+
+def process_image(filename, spec, out_name, grey=False):
+    '''
+    Load one image, run the chain on it, and save it as out_name
+
+    Returns:
+    A tuple (filename, seconds, pixels)
+    '''
+    start = time.perf_counter()
+    filters = parse_chain(spec)
+    if grey:
+        image = lab.load_compact_image(filename, color=False)
+    else:
+        image = lab.load_compact_image(filename)
+        filters = [lab.color_filter_from_greyscale_filter(filt) for filt in filters]
+    result = lab.filter_cascade(filters)(image)
+
+    os.makedirs(os.path.dirname(out_name) or '.', exist_ok=True)
+    if grey:
+        lab.save_greyscale_image(result, out_name)
+    else:
+        lab.save_color_image(result, out_name)
+    return filename, time.perf_counter() - start, image.height*image.width
+
+
+def run_batch(filenames, spec, out_dir, workers=None, grey=False, report=print):
+    '''
+    Run process_image over filenames on a pool of worker processes (or in
+    this process when workers is 1), calling report with one line per image
+    as soon as it finishes and a final summary line
+
+    An image that cannot be read, filtered, or saved is reported as failed
+    and left out of the throughput; the other images carry on.
+
+    Returns:
+    A dictionary with the per-image results (in the order they finished),
+    the failed images as (filename, error message) pairs, and the overall
+    throughput
+    '''
+    parse_chain(spec)  # fail before starting any workers
+    out_names = output_names(filenames, out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    results = []
+    failed = []
+
+    def record(filename, run):
+        try:
+            result = run()
+        except Exception as e:
+            failed.append((filename, '%s: %s' % (type(e).__name__, e)))
+            report('%s: failed (%s)' % failed[-1])
+            return
+        _, seconds, pixels = result
+        results.append(result)
+        report('%s: %.3f s (%.2f Mpx/s)' % (filename, seconds, pixels/seconds/1e6))
+
+    if workers == 1:
+        for filename, out_name in zip(filenames, out_names):
+            record(filename, lambda: process_image(filename, spec, out_name, grey))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(process_image, filename, spec, out_name, grey): filename
+                       for filename, out_name in zip(filenames, out_names)}
+            for future in as_completed(futures):
+                record(futures[future], future.result)
+
+    elapsed = time.perf_counter() - start
+    total_pixels = sum(pixels for _, _, pixels in results)
+    summary = {
+        'images': len(results),
+        'seconds': elapsed,
+        'images_per_second': len(results)/elapsed if elapsed else 0.0,
+        'megapixels_per_second': total_pixels/elapsed/1e6 if elapsed else 0.0,
+        'results': results,
+        'failed': failed,
+    }
+    report('%d images in %.2f s: %.2f images/s, %.2f Mpx/s' % (
+        len(results), elapsed, summary['images_per_second'], summary['megapixels_per_second']))
+    if failed:
+        report('%d images failed' % len(failed))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply a filter chain to many images.')
+    parser.add_argument('pattern', help="glob of input images, e.g. 'scans/**/*.png'")
+    parser.add_argument('chain', help="filters to apply in order, e.g. 'blur:9,edges,sharpen:7'")
+    parser.add_argument('-o', '--out-dir', default='filtered', help='directory for the results')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPUs)')
+    parser.add_argument('--grey', action='store_true', help='convert to greyscale first')
+    parsed = parser.parse_args(argv)
+
+    filenames = sorted(glob.glob(parsed.pattern, recursive=True))
+    if not filenames:
+        parser.error('no files match %r' % parsed.pattern)
+    try:
+        parse_chain(parsed.chain)
+        output_names(filenames, parsed.out_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    summary = run_batch(filenames, parsed.chain, parsed.out_dir, parsed.workers, parsed.grey)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the lab.py filters
+
+Times correlate (with a float box kernel, which is correlated tap by tap,
+an integer box kernel, which is separable, and an integer kernel that is
+not, which goes through fft once it is large enough), blurred, sharpened, edges, and the color and cascade
+filters over a grid of image sizes, kernel sizes, and boundary behaviors,
+writes the timings as JSON, and compares them against a stored baseline.
+
+Invoked as, for example:
+   python3 bench.py -o baseline.json
+   python3 bench.py --sizes 64 256 --kernels 3 9 --baseline baseline.json
+   python3 bench.py --backend numpy --max-seconds 5 -o numpy.json
+
+Cases whose estimated running time exceeds --max-seconds (the larger end of
+the default grid, in pure Python) are recorded as skipped rather than run.
+"""
+
+import sys
+import json
+import math
+import time
+import platform
+import argparse
+import statistics
+
+import lab
+
+SIZES = [64, 256, 1024, 4096]
+KERNELS = [3, 9, 25, 51]
+MODES = ['zero', 'extend', 'wrap']
+
+# rough per-pixel costs in units of lab.DIRECT_TAP_SECONDS, used to skip
+# cases that would take too long
+RUNNING_SUM_TAPS = 12
+EDGES_TAPS = 6
+
+
+def make_image(size, color=False):
+    '''
+    Deterministic size-by-size test image with some texture
+    '''
+    pixels = [(x*7 + y*13 + (x*y) % 17) % 256 for y in range(size) for x in range(size)]
+    if not color:
+        return {'height': size, 'width': size, 'pixels': pixels}
+    return lab.CompactImage(size, size, [bytearray(pixels),
+                                         bytearray(255-p for p in pixels),
+                                         bytearray((3*p) % 256 for p in pixels)])
+
+
+def box_kernel(n):
+    return {'dimension': n, 'list_vals': [1/(n*n)]*n*n}
+
+
+def ones_kernel(n):
+    return {'dimension': n, 'list_vals': [1]*n*n}
+
+
+def peak_kernel(n):
+    vals = [1]*n*n
+    vals[n*n//2] = 2
+    return {'dimension': n, 'list_vals': vals}
+
+
+CORRELATE_KERNELS = {'correlate': box_kernel, 'correlate_ones': ones_kernel,
+                     'correlate_peak': peak_kernel}
+
+
+def correlate_estimate(kernel, size):
+    '''
+    Estimated seconds for lab.correlate on a size-by-size integer image,
+    following the path it picks: fft, two passes for kernels exact_factors
+    accepts, or one tap per nonzero weight otherwise
+    '''
+    image = {'height': size, 'width': size, 'pixels': [0]}
+    factors = lab.exact_factors(lab.separate_kernel(kernel))
+    if lab.choose_correlate_method(image, kernel, factors) == 'fft':
+        rows, cols = lab.fft_shape(size, size, kernel['dimension'])
+        points = rows*cols
+        return 3*lab.FFT_POINT_SECONDS*points*math.log2(points)
+    if factors is not None:
+        taps = sum(1 for v in factors[0] if v != 0) + sum(1 for v in factors[1] if v != 0)
+    else:
+        taps = sum(1 for v in kernel['list_vals'] if v != 0)
+    return size*size*taps*lab.DIRECT_TAP_SECONDS
+
+
+def cases(sizes=SIZES, kernels=KERNELS, modes=MODES):
+    '''
+    Generate the benchmark grid
+
+    Returns:
+    A list of dictionaries with the case name, its parameters, the estimated
+    seconds per run, and a function of the image that runs it
+    '''
+    result = []
+
+    def add(name, filt, size, taps, color=False, kernel=None, mode=None, estimate=None):
+        channels = 3 if color else 1
+        if estimate is None:
+            estimate = size*size*taps*lab.DIRECT_TAP_SECONDS
+        result.append({
+            'name': '/'.join(str(part) for part in (name, size, kernel, mode) if part is not None),
+            'filter': name,
+            'size': size,
+            'kernel': kernel,
+            'mode': mode,
+            'color': color,
+            'estimate': channels*estimate,
+            'run': filt,
+        })
+
+    for size in sizes:
+        for n in kernels:
+            for name, make_kernel in CORRELATE_KERNELS.items():
+                kernel = make_kernel(n)
+                estimate = correlate_estimate(kernel, size)
+                for mode in modes:
+                    add(name, lambda image, k=kernel, m=mode: lab.correlate(image, k, m),
+                        size, None, kernel=n, mode=mode, estimate=estimate)
+            add('blurred', lambda image, n=n: lab.blurred(image, n), size, RUNNING_SUM_TAPS, kernel=n)
+            add('sharpened', lambda image, n=n: lab.sharpened(image, n), size, RUNNING_SUM_TAPS, kernel=n)
+            add('color_blurred', lab.color_filter_from_greyscale_filter(lab.make_blur_filter(n)),
+                size, RUNNING_SUM_TAPS, color=True, kernel=n)
+            add('cascade', lab.filter_cascade([
+                    lab.color_filter_from_greyscale_filter(lab.edges),
+                    lab.color_filter_from_greyscale_filter(lab.make_blur_filter(n))]),
+                size, EDGES_TAPS + RUNNING_SUM_TAPS, color=True, kernel=n)
+        add('edges', lab.edges, size, EDGES_TAPS)
+        add('color_edges', lab.color_filter_from_greyscale_filter(lab.edges), size, EDGES_TAPS, color=True)
+    return result
+
+
+def time_case(case, image, repeat=3, max_seconds=30.0):
+    '''
+    Run one case up to repeat times (fewer if a run is slow)
+
+    Returns:
+    A dictionary of timings for the JSON report
+    '''
+    entry = {key: case[key] for key in ('name', 'filter', 'size', 'kernel', 'mode', 'color')}
+    if case['estimate'] > max_seconds:
+        entry['skipped'] = 'estimated %.0f s' % case['estimate']
+        return entry
+
+    times = []
+    spent = 0.0
+    while len(times) < repeat and (not times or spent + times[0] <= max_seconds):
+        start = time.perf_counter()
+        case['run'](image)
+        times.append(time.perf_counter() - start)
+        spent += times[-1]
+    entry['seconds'] = min(times)
+    entry['median_seconds'] = statistics.median(times)
+    entry['runs'] = len(times)
+    entry['megapixels_per_second'] = case['size']**2/entry['seconds']/1e6
+    return entry
+
+
+def run_benchmarks(sizes=SIZES, kernels=KERNELS, modes=MODES, repeat=3,
+                   max_seconds=30.0, report=print):
+    '''
+    Time every case of the grid, calling report with one line per case
+
+    Returns:
+    A dictionary with the environment and the per-case results
+    '''
+    images = {}
+    results = []
+    for case in cases(sizes, kernels, modes):
+        key = (case['size'], case['color'])
+        if key not in images and case['estimate'] <= max_seconds:
+            images[key] = make_image(*key)
+        entry = time_case(case, images.get(key), repeat, max_seconds)
+        results.append(entry)
+        if 'skipped' in entry:
+            report('%-32s skipped (%s)' % (entry['name'], entry['skipped']))
+        else:
+            report('%-32s %10.4f s %8.2f Mpx/s' % (entry['name'], entry['seconds'],
+                                                   entry['megapixels_per_second']))
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': getattr(lab.backend, '__name__', None),
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    '''
+    Compare the timings of two run_benchmarks reports, case by case
+
+    Returns:
+    A list of (name, baseline seconds, seconds, ratio, verdict) tuples,
+    where verdict is 'slower' or 'faster' when the ratio is beyond
+    threshold and 'same' otherwise
+    '''
+    old = {entry['name']: entry for entry in baseline['results'] if 'seconds' in entry}
+    rows = []
+    for entry in results['results']:
+        if 'seconds' not in entry or entry['name'] not in old:
+            continue
+        before = old[entry['name']]['seconds']
+        ratio = entry['seconds']/before
+        if ratio > 1 + threshold:
+            verdict = 'slower'
+        elif ratio < 1 - threshold:
+            verdict = 'faster'
+        else:
+            verdict = 'same'
+        rows.append((entry['name'], before, entry['seconds'], ratio, verdict))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the lab.py filters.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='image side lengths')
+    parser.add_argument('--kernels', type=int, nargs='+', default=KERNELS, help='kernel sizes')
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES, help='boundary behaviors')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case (the best one counts)')
+    parser.add_argument('--max-seconds', type=float, default=30.0,
+                        help='skip cases estimated to take longer than this per run')
+    parser.add_argument('--backend', choices=['python', 'numpy'], default='python')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change that counts as a regression or improvement')
+    parsed = parser.parse_args(argv)
+
+    if parsed.backend == 'numpy':
+        import numpy_backend
+        lab.set_backend(numpy_backend)
+    results = run_benchmarks(parsed.sizes, parsed.kernels, parsed.modes, parsed.repeat,
+                             parsed.max_seconds)
+    if parsed.output:
+        with open(parsed.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if not parsed.baseline:
+        return 0
+    with open(parsed.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, parsed.threshold)
+    for name, before, after, ratio, verdict in rows:
+        print('%-32s %10.4f -> %10.4f s  x%.2f  %s' % (name, before, after, ratio, verdict))
+    slower = sum(1 for row in rows if row[4] == 'slower')
+    faster = sum(1 for row in rows if row[4] == 'faster')
+    print('%d cases compared: %d slower, %d faster' % (len(rows), slower, faster))
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
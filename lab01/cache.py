@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of lab.py filter results
+
+Results are keyed by a hash of the input pixels, the image dimensions, and
+the filter's descriptor (for example ('blurred', 5) or
+('color', ('edges',))), so reapplying a filter to an identical image is a
+lookup.  Memory use is bounded with least-recently-used eviction.  An
+optional directory also keeps results on disk for other processes, bounded
+the same way by max_disk_bytes: each file is a one-line header followed by
+the raw pixel planes, so reading one back never runs code.  Results that
+are not 8-bit planes or float pixels (unclipped ints, say) stay in memory
+only.
+
+Invoked as, for example:
+   results = FilterCache(max_bytes=512*2**20, directory='/var/cache/thumbs',
+                         max_disk_bytes=4*2**30)
+   blurry = results.call(lab.blurred, image, 5)
+   frog = results.apply(lab.filter_cascade([color_edges, color_blur]), image)
+"""
+
+import os
+import sys
+import array
+import hashlib
+from collections import OrderedDict
+
+import lab
+
+
+def image_digest(image):
+    '''
+    Hash the dimensions and pixels of an image (dict or CompactImage)
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(image, lab.CompactImage):
+        digest.update(b'compact %d %d %d;' % (image.height, image.width, len(image.planes)))
+        for plane in image.planes:
+            digest.update(plane)
+        return digest.hexdigest()
+
+    pixels = image['pixels']
+    digest.update(b'dict %d %d;' % (image['height'], image['width']))
+    if isinstance(pixels, (bytes, bytearray)):
+        digest.update(pixels)
+    else:
+        try:
+            # 8-bit greyscale and color pixels hash as raw bytes
+            if pixels and isinstance(pixels[0], tuple):
+                digest.update(b'rgb;')
+                digest.update(bytes(c for p in pixels for c in p))
+            else:
+                digest.update(b'grey;')
+                digest.update(bytes(pixels))
+        except (TypeError, ValueError):
+            digest.update(b'other;')
+            digest.update(repr(list(pixels)).encode())
+    return digest.hexdigest()
+
+
+def copy_image(image):
+    # cached results are shared, so callers get their own copy to mutate
+    if isinstance(image, lab.CompactImage):
+        return lab.CompactImage(image.height, image.width, [bytearray(p) for p in image.planes])
+    copy = dict(image)
+    copy['pixels'] = list(image['pixels'])
+    return copy
+
+
+def image_size(image):
+    '''
+    Rough number of bytes an image occupies in memory
+    '''
+    if isinstance(image, lab.CompactImage):
+        return sum(len(plane) for plane in image.planes) + 200
+    pixels = image['pixels']
+    per_pixel = 8
+    if pixels and isinstance(pixels[0], tuple):
+        per_pixel += 64
+    elif pixels and isinstance(pixels[0], float):
+        per_pixel += 24
+    return per_pixel*len(pixels) + 200
+
+
+def encode_image(image):
+    '''
+    Serialize an image for the disk tier as a header line and raw planes
+
+    Returns:
+    bytes, or None for images whose pixels are not 8-bit values (or tuples
+    of them) or floats
+    '''
+    if isinstance(image, lab.CompactImage):
+        header = b'compact %d %d %d\n' % (image.height, image.width, len(image.planes))
+        return header + b''.join(bytes(plane) for plane in image.planes)
+
+    height, width, pixels = image['height'], image['width'], image['pixels']
+    if all(type(p) is int for p in pixels):
+        kind, data = b'grey', pixels
+    elif all(type(p) is tuple and len(p) == 3 for p in pixels):
+        kind, data = b'rgb', [c for p in pixels for c in p]
+    elif all(type(p) is float for p in pixels):
+        values = array.array('d', pixels)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return b'float %d %d 1\n' % (height, width) + values.tobytes()
+    else:
+        return None
+    try:
+        return b'%s %d %d 1\n' % (kind, height, width) + bytes(data)
+    except (TypeError, ValueError):
+        return None
+
+
+def decode_image(data):
+    '''
+    Inverse of encode_image
+
+    Returns:
+    The image, or None if data is not a well-formed encoding
+    '''
+    header, _, body = data.partition(b'\n')
+    try:
+        kind, height, width, planes = header.split()
+        height, width, planes = int(height), int(width), int(planes)
+    except ValueError:
+        return None
+    size = height*width
+    if kind == b'compact' and len(body) == planes*size:
+        return lab.CompactImage(height, width, [bytearray(body[i*size:(i+1)*size])
+                                                for i in range(planes)])
+    if kind == b'grey' and len(body) == size:
+        return {'height': height, 'width': width, 'pixels': list(body)}
+    if kind == b'rgb' and len(body) == 3*size:
+        return {'height': height, 'width': width, 'pixels': list(zip(body[0::3], body[1::3], body[2::3]))}
+    if kind == b'float' and len(body) == 8*size:
+        values = array.array('d', body)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return {'height': height, 'width': width, 'pixels': values.tolist()}
+    return None
+
+
+class FilterCache:
+    '''
+    Represents a bounded cache of filter results
+    '''
+    def __init__(self, max_bytes=256*2**20, directory=None, max_disk_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # files in directory, least recently used first (by modification
+        # time, which get refreshes), with their sizes
+        self.disk_entries = OrderedDict()
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            found = []
+            for name in os.listdir(directory):
+                if name.endswith('.img'):
+                    try:
+                        stat = os.stat(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        continue
+                    found.append((stat.st_mtime, name[:-4], stat.st_size))
+            for _, key, size in sorted(found):
+                self.disk_entries[key] = size
+                self.disk_bytes += size
+            self.trim_disk()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.img')
+
+    def key(self, digest, descriptors):
+        return hashlib.blake2b(repr((digest, tuple(descriptors))).encode(), digest_size=16).hexdigest()
+
+    def get(self, key):
+        '''
+        Look a result up in memory, then on disk
+
+        Returns:
+        A copy of the cached image, or None
+        '''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return copy_image(self.entries[key][0])
+        if self.directory is not None:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    data = f.read()
+                image = decode_image(data)
+                if image is not None:
+                    os.utime(self.path(key))
+            except FileNotFoundError:
+                # another process may have removed it meanwhile
+                image = None
+                self.forget_disk(key)
+            if image is not None:
+                self.add_disk(key, len(data))
+                self.remember(key, image)
+                self.hits += 1
+                return copy_image(image)
+        self.misses += 1
+        return None
+
+    def put(self, key, image):
+        image = copy_image(image)
+        self.remember(key, image)
+        if self.directory is not None:
+            data = encode_image(image)
+            if data is None or len(data) > self.max_disk_bytes:
+                return
+            path = self.path(key)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            self.add_disk(key, len(data))
+            self.trim_disk()
+
+    def add_disk(self, key, size):
+        # record key as the most recently used file
+        self.forget_disk(key)
+        self.disk_entries[key] = size
+        self.disk_bytes += size
+
+    def forget_disk(self, key):
+        if key in self.disk_entries:
+            self.disk_bytes -= self.disk_entries.pop(key)
+
+    def trim_disk(self):
+        # remove the least recently used files until the directory fits
+        while self.disk_bytes > self.max_disk_bytes:
+            key, size = self.disk_entries.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def remember(self, key, image):
+        # keep image in memory, evicting the least recently used results
+        size = image_size(image)
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (image, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted
+
+    def call(self, func, image, *args):
+        '''
+        Cached func(image, *args) for a lab.py filter function such as
+        lab.blurred or lab.edges
+        '''
+        return self.run(image, [(lambda image: func(image, *args), (func.__name__,) + args)])
+
+    def apply(self, filt, image):
+        '''
+        Cached filt(image) for a filter with a descriptor attribute (made by
+        make_blur_filter, color_filter_from_greyscale_filter, ...), or for a
+        filter_cascade of them; cascades reuse the longest cached prefix
+        '''
+        filters = getattr(filt, 'filters', [filt])
+        return self.run(image, [(f, getattr(f, 'descriptor', None)) for f in filters])
+
+    def run(self, image, steps):
+        '''
+        Apply (filter, descriptor) steps in order, caching every prefix that
+        is fully described
+        '''
+        described = 0
+        while described < len(steps) and steps[described][1] is not None:
+            described += 1
+        if described == 0:
+            return lab.filter_cascade([f for f, _ in steps])(image)
+
+        digest = image_digest(image)
+        descriptors = [d for _, d in steps[:described]]
+        start = 0
+        for length in range(described, 0, -1):
+            cached = self.get(self.key(digest, descriptors[:length]))
+            if cached is not None:
+                image, start = cached, length
+                break
+
+        for length in range(start+1, described+1):
+            image = steps[length-1][0](image)
+            self.put(self.key(digest, descriptors[:length]), image)
+        if described < len(steps):
+            image = lab.filter_cascade([f for f, _ in steps[described:]])(image)
+        return image
@@ -8,6 +8,72 @@ from PIL import Image as Image
 # NO ADDITIONAL IMPORTS ALLOWED!
 
 
+# BACKENDS
+
+#module with array implementations of correlate, round_and_clip_image,
+#inverted, blurred, sharpened, edges, and filter_brightness (for example
+#numpy_backend), or None to run the pure python reference code in this file
+backend = None
+
+
+def set_backend(new_backend):
+    '''
+    Route the filters through new_backend (None restores the reference code)
+
+    Returns:
+    The previously active backend, so callers can restore it
+    '''
+    global backend
+    previous = backend
+    backend = new_backend
+    return previous
+
+
+# PROFILING
+
+#object with a measure(label, func, image) method that returns func(image)
+#and records how long it took (for example profiling.Profiler), or None
+profiler = None
+
+
+def set_profiler(new_profiler):
+    '''
+    Report cascade stages and color channels to new_profiler (None turns
+    profiling off)
+
+    Returns:
+    The previously active profiler, so callers can restore it
+    '''
+    global profiler
+    previous = profiler
+    profiler = new_profiler
+    return previous
+
+
+def profiled(label, func, image):
+    '''
+    Return func(image), measured by the profiler under label if one is set
+    '''
+    if profiler is None:
+        return func(image)
+    return profiler.measure(label, func, image)
+
+
+def describe_filter(filt):
+    '''
+    Short readable name for a filter, such as 'color(blurred(5))'
+    '''
+    def describe(descriptor):
+        if len(descriptor) == 1:
+            return descriptor[0]
+        args = [describe(arg) if isinstance(arg, tuple) else repr(arg) for arg in descriptor[1:]]
+        return '%s(%s)' % (descriptor[0], ', '.join(args))
+    descriptor = getattr(filt, 'descriptor', None)
+    if descriptor is not None:
+        return describe(descriptor)
+    return getattr(filt, '__name__', repr(filt))
+
+
 def get_pixel(image, x, y):
     return image['pixels'][y*image['width']+x]
 
@@ -87,37 +153,358 @@ def apply_per_pixel(image, func):
     Returns:
     A new dictionary after changing image according to the function
     '''
-    #create new dictionary so old one is not modified
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': [255]*(image['height']*image['width']),
-    }
-    for x in range(image['width']):
-        for y in range(image['height']):
-            #get pixel val and apply function
-            color = get_pixel(image, x, y)
-            newcolor = func(color)
-            set_pixel(result, x, y, newcolor)
-    return result
+    #8-bit images call func once per distinct value (see apply_point_op)
+    #rather than once per pixel
+    return apply_point_op(image, func)
 
 
-def inverted(image):
+def inverted(image, out=None, region=None):
     '''
     Invert the colors of the image (255-c)
 
     Parameters:
-    * image (dict): contains height, width, and list of pixels for the image
+    * image (dict or CompactImage): contains height, width, and pixels for the image
+    * out (dict or CompactImage): optional image of the same size to write
+      the result into (see write_output); may be image itself
+    * region (tuple): optional (top, left, height, width) to compute only
+      that part of the result (see filter_region)
 
     Returns:
-    A new dictionary after changing image according to the function
+    A new dictionary after changing image according to the function, or out
+    '''
+    if region is not None:
+        return write_output(inverted(region_window(image, region, 0, 'extend')), out)
+    if backend is not None and not isinstance(image, CompactImage):
+        return write_output(backend.inverted(image), out)
+    return write_output(apply_point_op(image, inverted.point_op), out)
+
+
+# LOOKUP TABLES
+
+def lookup_table(op, values=None):
+    '''
+    Tabulate a function of one pixel value over the 8-bit values
+
+    Parameters:
+    * op: function from a pixel value to a new pixel value
+    * values (iterable): if given, the only values op is run on (the rest
+      of the table is 0), so op never sees values that are absent
+
+    Returns:
+    op.table for ops made by tabulated, otherwise a new list of 256 values,
+    op(c) at index c (which is not kept, since op may not be pure)
+    '''
+    table = getattr(op, 'table', None)
+    if table is None:
+        if values is None:
+            return [op(c) for c in range(256)]
+        table = [0]*256
+        for c in values:
+            table[c] = op(c)
+    return table
+
+
+def tabulated(op):
+    '''
+    A point op computing op(c), carrying its lookup table (as .table), which
+    is computed once here and reused for every image, channel, and frame.
+    Only for pure functions of the pixel value, such as lab.py's own.
+    '''
+    def point_op(c):
+        return op(c)
+    point_op.table = [op(c) for c in range(256)]
+    return point_op
+
+
+def is_byte(value):
+    return isinstance(value, int) and 0 <= value <= 255
+
+
+def byte_pixels(pixels):
+    '''
+    The pixels as bytes (a bytes or bytearray is returned as is) if every one
+    is an int from 0 to 255, otherwise None
     '''
-    return apply_per_pixel(image, lambda c: 255-c)
+    if isinstance(pixels, (bytes, bytearray)):
+        return pixels
+    if isinstance(pixels, list):
+        try:
+            #checks that every pixel is an int from 0 to 255 at C speed
+            return bytes(pixels)
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def apply_lookup_table(pixels, table):
+    '''
+    Map 8-bit pixel values through a table from lookup_table in one pass
+
+    Tables whose entries all fit in a byte run through bytes.translate, which
+    maps every pixel in C; other tables are indexed once per pixel.
+
+    Parameters:
+    * pixels (bytes, bytearray, or list): greyscale pixel values
+    * table (list): 256 entries
+
+    Returns:
+    A bytearray (for bytes or bytearray pixels whose table fits in a byte)
+    or a list of the mapped values, or None if some pixel is not an int from
+    0 to 255
+    '''
+    source = byte_pixels(pixels)
+    if source is None:
+        return None
+    if not all(is_byte(v) for v in table):
+        return [table[c] for c in source]
+    mapped = source.translate(bytes(table))
+    return bytearray(mapped) if source is pixels else list(mapped)
+
+
+# COMPACT IMAGES
+
+class CompactImage:
+    '''
+    Represents an image as contiguous 8-bit planes (one bytearray per channel,
+    so greyscale images have one plane and color images have red, green, and
+    blue planes) instead of a list of ints or RGB tuples
+    '''
+    def __init__(self, height, width, planes):
+        self.height = height
+        self.width = width
+        self.planes = planes
+
+    @classmethod
+    def from_dict(cls, image):
+        # color images hold RGB tuples, greyscale images hold ints
+        pixels = image['pixels']
+        if pixels and isinstance(pixels[0], tuple):
+            planes = [bytearray(p[i] for p in pixels) for i in range(3)]
+        else:
+            planes = [bytearray(pixels)]
+        return cls(image['height'], image['width'], planes)
+
+    @classmethod
+    def from_channels(cls, channels):
+        # pack greyscale images (dicts or single plane compact images) as planes
+        planes = []
+        for channel in channels:
+            if isinstance(channel, CompactImage):
+                planes.extend(channel.planes)
+            else:
+                planes.append(bytearray(channel['pixels']))
+        return cls(channels[0]['height'], channels[0]['width'], planes)
+
+    def is_color(self):
+        return len(self.planes) == 3
+
+    def channels(self):
+        # greyscale image dictionaries sharing memory with each plane
+        return [{'height': self.height, 'width': self.width, 'pixels': plane}
+                for plane in self.planes]
+
+    def to_dict(self):
+        if self.is_color():
+            pixels = list(zip(*self.planes))
+        else:
+            pixels = list(self.planes[0])
+        return {'height': self.height, 'width': self.width, 'pixels': pixels}
+
+    def __getitem__(self, key):
+        # lets read-only code written for image dictionaries use compact images
+        if key == 'height':
+            return self.height
+        if key == 'width':
+            return self.width
+        if key == 'pixels':
+            return list(zip(*self.planes)) if self.is_color() else self.planes[0]
+        raise KeyError(key)
+
+
+def apply_to_planes(image, filt):
+    '''
+    Apply a greyscale filter to every plane of a compact image
+
+    Parameters:
+    * image (CompactImage): greyscale or color compact image
+    * filt: function from greyscale image dictionaries to greyscale images
+
+    Returns:
+    A new CompactImage holding the filtered planes
+    '''
+    names = ['red', 'green', 'blue'] if image.is_color() else ['grey']
+    return CompactImage.from_channels([profiled(name, filt, channel)
+                                       for name, channel in zip(names, image.channels())])
+
+
+def write_output(result, out):
+    '''
+    Copy a filter result into a preallocated image, so that loops filtering
+    many images of one size (such as video frames) can keep reusing the same
+    buffers.  Filters never modify their input image except through out, so
+    out may be the input.  Filters that computed their pixels straight into
+    out's list (see output_pixels) need no copy at all.
+
+    Parameters:
+    * result (dict or CompactImage): the freshly computed image
+    * out (dict, CompactImage, or None): image of the same size whose pixels
+      list (or planes) is overwritten in place, keeping its identity
+
+    Returns:
+    out, or result itself if out is None
+    '''
+    if out is None or result is out:
+        return result
+    if (out['height'], out['width']) != (result['height'], result['width']):
+        raise ValueError('out is %dx%d but the result is %dx%d' % (
+            out['height'], out['width'], result['height'], result['width']))
+
+    if isinstance(out, CompactImage):
+        if not isinstance(result, CompactImage):
+            result = CompactImage.from_dict(result)
+        if len(out.planes) != len(result.planes):
+            raise ValueError('out has %d planes but the result has %d' % (len(out.planes), len(result.planes)))
+        for target, plane in zip(out.planes, result.planes):
+            target[:] = plane
+        return out
+
+    if isinstance(result, CompactImage):
+        result = result.to_dict()
+    if result['pixels'] is not out['pixels']:
+        out['pixels'][:] = result['pixels']
+    return out
+
+
+def output_pixels(image, out, overlap=True):
+    '''
+    The list a filter of image should compute its result pixels into: the
+    pixels list of out, so that frame loops reuse it without a copy, or a
+    new list when out is not given (or is not a dictionary of a list)
+
+    Parameters:
+    * image (dict): the filter's input
+    * out (dict or None): the filter's out argument
+    * overlap (bool): whether the filter may write into image's own list,
+      which is true for filters that have read every input pixel a result
+      pixel depends on before writing it; otherwise an out sharing image's
+      list gets a new list, and write_output copies it back
+
+    Returns:
+    A list of height*width pixels (of unspecified values)
+    '''
+    size = image['height']*image['width']
+    if out is not None:
+        if (out['height'], out['width']) != (image['height'], image['width']):
+            raise ValueError('out is %dx%d but the result is %dx%d' % (
+                out['height'], out['width'], image['height'], image['width']))
+        pixels = out['pixels'] if not isinstance(out, CompactImage) else None
+        if isinstance(pixels, list) and len(pixels) == size and (overlap or pixels is not image['pixels']):
+            return pixels
+    return [0]*size
+
+
+# REGIONS
+
+def check_region(image, region):
+    '''
+    Raise ValueError unless region, a tuple (top, left, height, width), is a
+    non-empty rectangle inside image
+    '''
+    top, left, height, width = region
+    if not (0 <= top and 0 <= left and height > 0 and width > 0 and
+            top+height <= image['height'] and left+width <= image['width']):
+        raise ValueError('Region %r is not inside the %dx%d image' % (
+            tuple(region), image['height'], image['width']))
+
+
+def window_pixels(pixels, stride, rows, cols, zero, top=0, left=0):
+    '''
+    Gather the pixels at rows x cols (indices into an image, None for zero)
+    out of pixels, which hold the rows of that image from top on and its
+    columns from left on, stride values per row
+
+    Returns:
+    A list of len(rows)*len(cols) pixels
+    '''
+    result = []
+    for y in rows:
+        if y is None:
+            result.extend([zero]*len(cols))
+        else:
+            start = (y-top)*stride - left
+            result.extend([zero if x is None else pixels[start+x] for x in cols])
+    return result
+
+
+def cropped(image, region):
+    '''
+    Copy the region (top, left, height, width) out of an image
+
+    Parameters:
+    * image (dict or CompactImage): contains height, width, and pixels for the image
+    * region (tuple): (top, left, height, width) of the part to copy
+
+    Returns:
+    A new image of the same kind, of the region's size
+    '''
+    check_region(image, region)
+    top, left, height, width = region
+    stride = image['width']
+    if isinstance(image, CompactImage):
+        planes = []
+        for plane in image.planes:
+            new_plane = bytearray()
+            for y in range(top, top+height):
+                new_plane += plane[y*stride+left:y*stride+left+width]
+            planes.append(new_plane)
+        return CompactImage(height, width, planes)
+    pixels = image['pixels']
+    result = []
+    for y in range(top, top+height):
+        result.extend(pixels[y*stride+left:y*stride+left+width])
+    return {'height': height, 'width': width, 'pixels': result}
+
+
+def region_window(image, region, radius, boundary_behavior):
+    '''
+    Copy the pixels a filter reading up to radius rows and columns away needs
+    to compute region of its output: the region plus a halo of radius
+    pixels, read according to boundary_behavior where it leaves the image
+
+    Returns:
+    A new image of the same kind, (height+2*radius) by (width+2*radius)
+    '''
+    check_region(image, region)
+    top, left, height, width = region
+    rows = boundary_indices(image['height'], radius, boundary_behavior)[top:top+height+2*radius]
+    cols = boundary_indices(image['width'], radius, boundary_behavior)[left:left+width+2*radius]
+    size = {'height': height+2*radius, 'width': width+2*radius}
+    if isinstance(image, CompactImage):
+        planes = [bytearray(window_pixels(plane, image.width, rows, cols, 0)) for plane in image.planes]
+        return CompactImage(size['height'], size['width'], planes)
+    pixels = image['pixels']
+    zero = (0, 0, 0) if pixels and isinstance(pixels[0], tuple) else 0
+    size['pixels'] = window_pixels(pixels, image['width'], rows, cols, zero)
+    return size
+
+
+def filter_region(filt, image, region, radius, boundary_behavior):
+    '''
+    Compute only region of filt(image), for a filter whose output pixels
+    depend on the input pixels at most radius rows and columns away (read
+    according to boundary_behavior beyond the edges), by filtering just the
+    region and its halo
+
+    Returns:
+    The region of filt(image), as a new image of the region's size
+    '''
+    window = region_window(image, region, radius, boundary_behavior)
+    return cropped(filt(window), (radius, radius, region[2], region[3]))
 
 
 # HELPER FUNCTIONS
 
-def correlate(image, kernel, boundary_behavior):
+def correlate(image, kernel, boundary_behavior, method='auto', out=None, region=None):
     """
     Compute the result of correlating the given image with the given kernel.
     `boundary_behavior` will one of the strings 'zero', 'extend', or 'wrap',
@@ -134,55 +521,534 @@ def correlate(image, kernel, boundary_behavior):
     they need to be integers (they should not be clipped or rounded at all).
 
     This process should not mutate the input image; rather, it should create a
-    separate structure to represent the output.
+    separate structure to represent the output, or overwrite the pixels of
+    `out` (an image of the same size, possibly the input itself) and return
+    it, as described in write_output.
+
+    Given a `region` (top, left, height, width), only that part of the output
+    is computed, reading only the pixels of the region and the kernel's halo
+    around it (see filter_region).
+
+    Separable kernels of integer or dyadic weights (Sobel operators,
+    binomial blurs, ...) are run on integer images as a row pass followed by
+    a column pass, which costs 2n instead of n*n per pixel and gives exactly
+    the same values.
+
+    `method` is 'direct', 'fft', or 'auto' (the default), which picks
+    whichever of the two choose_correlate_method estimates to be cheaper,
+    but only picks 'fft' where its output is exactly the direct output.
+    The 'fft' method multiplies in the frequency domain; its values match
+    the direct ones up to floating-point error (exactly, for integer images
+    and integer or dyadic kernels).
 
     kernel (dict): contains two key/val pairs
         *'dimension' (int): side length of the kernel
         *'list_vals; (list): pixel vals for kernel from left to right, top to bottom in order
     """
-    dimension = kernel['dimension']
-    
-    if boundary_behavior not in 'zeroextendwrap':
+    if boundary_behavior not in ('zero', 'extend', 'wrap'):
         return None
-    def func(x, y):
-        L_indices = []
-
-        #get a list of indice locations next to position (x, y)
-        distance_away = (int)((dimension-1)/2)
-        for j in range(y-distance_away, y+distance_away+1):
-            for i in range(x-distance_away, x+distance_away+1):
-            
-                L_indices.append((i,j))
-
-        #get the pixel val at each of those locations 
-        L_pixel = []
-        for element in L_indices:
-            L_pixel.append(advanced_get_pixel(image, element[0], element[1], boundary_behavior))
-       
-        #calculate the value using linear combination of kernel and pixel
+    if method not in ('auto', 'direct', 'fft'):
+        raise ValueError('Unknown correlate method: %r' % method)
+    if region is not None:
+        return write_output(filter_region(
+            lambda window: correlate(window, kernel, boundary_behavior, method),
+            image, region, (kernel['dimension']-1)//2, boundary_behavior), out)
+    if backend is not None:
+        return write_output(backend.correlate(image, kernel, boundary_behavior, method), out)
+    if image['height']*image['width'] == 0:
+        #no pixels, so nothing to pad the boundary with
+        return write_output({'height': image['height'], 'width': image['width'], 'pixels': []}, out)
+
+    factors = exact_factors(separate_kernel(kernel))
+    if factors is not None and not all(isinstance(p, int) for p in image['pixels']):
+        factors = None
+    if method == 'auto':
+        method = choose_correlate_method(image, kernel, factors)
+    if method == 'fft' and kernel['dimension'] % 2 == 1:
+        result = correlate_fft(image, kernel, boundary_behavior, out)
+    elif factors is not None:
+        col_vals, row_vals = factors
+        result = correlate_separable(image, col_vals, row_vals, boundary_behavior, out)
+    else:
+        result = correlate_direct(image, kernel, boundary_behavior, out)
+    return write_output(result, out)
+
+
+#measured seconds per kernel tap per pixel for the direct and separable paths,
+#and per point per log2(points) for one pass of fft
+DIRECT_TAP_SECONDS = 9e-8
+FFT_POINT_SECONDS = 1.6e-7
+
+
+def choose_correlate_method(image, kernel, factors=None,
+                            tap_seconds=DIRECT_TAP_SECONDS, fft_seconds=FFT_POINT_SECONDS):
+    '''
+    Estimate whether correlating image with kernel is cheaper directly
+    (tap by tap, or as two passes when factors from separate_kernel are
+    given) or through fft, using the per-operation costs tap_seconds and
+    fft_seconds (other backends pass their own)
+
+    Only integer images correlated with integer or dyadic kernels (see
+    fft_snap_step) go through fft, since only there are its results snapped
+    to exactly the direct ones; everything else is correlated directly.
+
+    Returns:
+    'direct' or 'fft'
+    '''
+    if kernel['dimension'] % 2 == 0 or fft_snap_step(kernel['list_vals']) is None:
+        return 'direct'
+    if factors is not None:
+        taps = sum(1 for v in factors[0] if v != 0) + sum(1 for v in factors[1] if v != 0)
+    else:
+        taps = sum(1 for v in kernel['list_vals'] if v != 0)
+    direct_cost = tap_seconds*taps*image['height']*image['width']
+
+    rows, cols = fft_shape(image['height'], image['width'], kernel['dimension'])
+    points = rows*cols
+    #forward transforms of the image and kernel, then the inverse transform
+    fft_cost = 3*fft_seconds*points*math.log2(points)
+    if fft_cost >= direct_cost or not all(isinstance(p, int) for p in image['pixels']):
+        return 'direct'
+    return 'fft'
+
+
+def correlate_direct(image, kernel, boundary_behavior, out=None):
+    '''
+    Correlate image with kernel by visiting every kernel tap for every pixel
+
+    Interior pixels, whose whole neighbourhood lies inside the image, read
+    their taps through fixed offsets into the pixel list; only the border band
+    looks up the boundary_behavior tables from boundary_table.
+
+    Parameters:
+    * image (dict): contains height, width, and list of pixels for the image
+    * kernel (dict): contains dimension and list_vals for the kernel
+    * boundary_behavior (str): one of 'zero', 'extend', or 'wrap'
+    * out (dict): optional image whose pixels list receives the result (see
+      output_pixels)
+
+    Returns:
+    A new (unrounded, unclipped) image dictionary
+    '''
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+
+    #the neighbourhood is side-by-side around each pixel and is paired with the
+    #kernel values in order (an even dimension only uses its first side*side values)
+    radius = (kernel['dimension']-1)//2
+    side = 2*radius+1
+    offsets, row_starts, x_indices = boundary_table(width, height, side, boundary_behavior)
+    taps = [(k, offsets[k], weight) for k, weight in enumerate(kernel['list_vals'][:side*side]) if weight != 0]
+    #later pixels still read the ones written earlier, so never write into the input
+    result = output_pixels(image, out, overlap=False)
+
+    #interior: no boundary checks at all.  taps are added one at a time, in
+    #the same order as border_value (sum() rounds floats differently)
+    for y in range(radius, height-radius):
+        for x in range(radius, width-radius):
+            base = y*width+x
+            pixel_val = 0
+            for _, offset, weight in taps:
+                pixel_val += pixels[base+offset]*weight
+            result[base] = pixel_val
+
+    #border band: look up each tap in the boundary tables
+    def border_value(x, y):
         pixel_val = 0
-        for i,j in zip(L_pixel, kernel['list_vals']):
-            pixel_val += i*j
+        for k, _, weight in taps:
+            row_start = row_starts[y+k//side]
+            source_x = x_indices[x+k%side]
+            if row_start is None or source_x is None:
+                continue
+            pixel_val += pixels[row_start+source_x]*weight
         return pixel_val
-    
-    #create a new image dictionary
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': [255]*(image['height']*image['width']),
-    }
-    #pass in vals for updating the image
-    for x in range(image['width']):
-        for y in range(image['height']):
-            newcolor = func(x, y)
-            set_pixel(result, x, y, newcolor)
-    return result
 
+    for y in range(height):
+        if radius <= y < height-radius:
+            xs = [x for x in range(width) if x < radius or x >= width-radius]
+        else:
+            xs = range(width)
+        for x in xs:
+            result[y*width+x] = border_value(x, y)
+
+    return {'height': height, 'width': width, 'pixels': result}
+
+
+#boundary tables keyed by (width, height, side, boundary_behavior), least
+#recently used first
+boundary_table_cache = {}
+BOUNDARY_TABLE_CACHE_SIZE = 64
+
+
+def boundary_table(width, height, side, boundary_behavior):
+    '''
+    Get the (cached) lookup tables correlate_direct needs for a side-by-side
+    neighbourhood on a width-by-height image
+
+    Returns:
+    A tuple (offsets, row_starts, x_indices) where offsets holds, for each
+    neighbourhood position in order, the offset from the center pixel's index
+    in the pixel list; row_starts[y+radius] is the pixel list index where the
+    row read for row y lies; and x_indices[x+radius] is the column read for
+    column x (None entries read zero)
+    '''
+    key = (width, height, side, boundary_behavior)
+    table = boundary_table_cache.pop(key, None)
+    if table is None:
+        radius = side//2
+        offsets = [(i-radius)*width + (j-radius) for i in range(side) for j in range(side)]
+        row_starts = [None if y is None else y*width
+                      for y in boundary_indices(height, radius, boundary_behavior)]
+        x_indices = boundary_indices(width, radius, boundary_behavior)
+        table = (offsets, row_starts, x_indices)
+        if len(boundary_table_cache) >= BOUNDARY_TABLE_CACHE_SIZE:
+            del boundary_table_cache[next(iter(boundary_table_cache))]
+    #reinserting moves the table to the most recently used end
+    boundary_table_cache[key] = table
+    return table
+
+
+def separate_kernel(kernel):
+    '''
+    Factor a kernel into a column vector and a row vector whose outer product
+    is the kernel
+
+    Parameters:
+    * kernel (dict): contains dimension and list_vals for the kernel
+
+    Returns:
+    A tuple (col_vals, row_vals) of lists of length dimension, or None if the
+    kernel is not separable (or has an even dimension)
+    '''
+    n = kernel['dimension']
+    vals = kernel['list_vals']
+    if n % 2 == 0 or len(vals) != n*n:
+        return None
+
+    #any nonzero entry can serve as the pivot; dividing by the smallest one in
+    #its row keeps integer kernels (sobel, binomial) integer
+    pivot_index = max(range(n*n), key=lambda i: abs(vals[i]))
+    if vals[pivot_index] == 0:
+        return [0]*n, [0]*n
+    r = pivot_index//n
+    c = min((j for j in range(n) if vals[r*n+j] != 0), key=lambda j: abs(vals[r*n+j]))
+    pivot = vals[r*n+c]
+
+    col_vals = [vals[i*n+c] for i in range(n)]
+    row_vals = [vals[r*n+j]/pivot for j in range(n)]
+    if all(float(v).is_integer() for v in row_vals):
+        row_vals = [int(v) for v in row_vals]
+
+    #only accept factorizations that reproduce every kernel value exactly
+    for i in range(n):
+        for j in range(n):
+            if col_vals[i]*row_vals[j] != vals[i*n+j]:
+                return None
+    return col_vals, row_vals
+
+
+def exact_factors(factors):
+    '''
+    Keep factors from separate_kernel only if both are integer or dyadic
+    (see fft_snap_step): then every product and partial sum over integer
+    pixels is exact, so the two passes of correlate_separable give exactly
+    the values of correlate_direct.  Other weights (1/9, 0.1, ...) round
+    differently in two passes than in one.
+
+    Returns:
+    factors, or None
+    '''
+    if factors is None or fft_snap_step(factors[0]) is None or fft_snap_step(factors[1]) is None:
+        return None
+    return factors
+
+
+def boundary_indices(length, radius, boundary_behavior):
+    '''
+    Map each position from -radius to length+radius-1 along one axis onto the
+    index it reads from, according to boundary_behavior
+
+    Returns:
+    A list of length+2*radius indices, with None for positions that read zero
+    '''
+    indices = []
+    for i in range(-radius, length+radius):
+        if 0 <= i < length:
+            indices.append(i)
+        elif boundary_behavior == 'zero':
+            indices.append(None)
+        elif boundary_behavior == 'extend':
+            indices.append(min(max(i, 0), length-1))
+        else:
+            indices.append(i % length)
+    return indices
+
+
+def correlate_separable(image, col_vals, row_vals, boundary_behavior, out=None):
+    '''
+    Correlate image with the kernel given by the outer product of col_vals and
+    row_vals, using a horizontal pass followed by a vertical pass
+
+    Each pass applies boundary_behavior along its own axis, which gives the
+    same result as applying it to the full 2d neighbourhood for 'zero',
+    'extend', and 'wrap'.
+
+    Parameters:
+    * image (dict): contains height, width, and list of pixels for the image
+    * col_vals (list): vertical weights, top to bottom
+    * row_vals (list): horizontal weights, left to right
+    * boundary_behavior (str): one of 'zero', 'extend', or 'wrap'
+    * out (dict): optional image whose pixels list receives the result (see
+      output_pixels)
 
-        
+    Returns:
+    A new (unrounded, unclipped) image dictionary
+    '''
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+    radius = len(row_vals)//2
+
+    #horizontal pass, one padded row at a time
+    x_indices = boundary_indices(width, radius, boundary_behavior)
+    row_taps = [(j, w) for j, w in enumerate(row_vals) if w != 0]
+    rows = []
+    for y in range(height):
+        row = pixels[y*width:(y+1)*width]
+        padded = [row[i] if i is not None else 0 for i in x_indices]
+        rows.append([sum(w*padded[x+j] for j, w in row_taps) for x in range(width)])
+
+    #vertical pass, accumulating whole rows (the input is no longer read)
+    y_indices = boundary_indices(height, radius, boundary_behavior)
+    col_taps = [(i, w) for i, w in enumerate(col_vals) if w != 0]
+    result = output_pixels(image, out)
+    for y in range(height):
+        acc = [0]*width
+        for i, w in col_taps:
+            source = y_indices[y+i]
+            if source is None:
+                continue
+            acc = [a + w*p for a, p in zip(acc, rows[source])]
+        result[y*width:(y+1)*width] = acc
+
+    return {'height': height, 'width': width, 'pixels': result}
+
+
+def fft_shape(height, width, n):
+    '''
+    Smallest power-of-two transform size that holds a height-by-width image
+    padded by an n-by-n kernel without wrapping around
+    '''
+    rows = 1
+    while rows < height+n-1:
+        rows *= 2
+    cols = 1
+    while cols < width+n-1:
+        cols *= 2
+    return rows, cols
 
 
-def round_and_clip_image(image):
+def fft(values, invert=False):
+    '''
+    Iterative radix-2 fast fourier transform (or its inverse, without the
+    1/n scaling) of a list whose length is a power of two
+    '''
+    n = len(values)
+    a = list(values)
+
+    #reorder the values by bit-reversed index
+    j = 0
+    for i in range(1, n):
+        bit = n >> 1
+        while j & bit:
+            j ^= bit
+            bit >>= 1
+        j |= bit
+        if i < j:
+            a[i], a[j] = a[j], a[i]
+
+    #combine transforms of length 2, 4, 8, ...
+    sign = 1 if invert else -1
+    length = 2
+    while length <= n:
+        half = length//2
+        angle = sign*2*math.pi/length
+        roots = [complex(math.cos(angle*k), math.sin(angle*k)) for k in range(half)]
+        for start in range(0, n, length):
+            for k in range(half):
+                u = a[start+k]
+                v = a[start+k+half]*roots[k]
+                a[start+k] = u+v
+                a[start+k+half] = u-v
+        length *= 2
+    return a
+
+
+def fft2(rows, invert=False):
+    '''
+    2d fft of a list of equal-length rows: transform the rows, then the columns
+    '''
+    rows = [fft(row, invert) for row in rows]
+    cols = [fft(col, invert) for col in zip(*rows)]
+    return [list(row) for row in zip(*cols)]
+
+
+def correlate_fft(image, kernel, boundary_behavior, out=None):
+    '''
+    Correlate image with an odd-sized kernel by multiplying in the frequency
+    domain
+
+    The image is padded by the kernel radius according to boundary_behavior,
+    so 'zero', 'extend', and 'wrap' all reduce to a plain linear correlation
+    of the padded image, computed as a convolution with the flipped kernel.
+
+    Parameters:
+    * image (dict): contains height, width, and list of pixels for the image
+    * kernel (dict): contains dimension and list_vals for the kernel
+    * boundary_behavior (str): one of 'zero', 'extend', or 'wrap'
+    * out (dict): optional image whose pixels list receives the result (see
+      output_pixels)
+
+    Returns:
+    A new (unrounded, unclipped) image dictionary; values are exact when the
+    image holds integers and the kernel holds integers or dyadic fractions
+    '''
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+    n = kernel['dimension']
+    vals = kernel['list_vals']
+    rows, cols = fft_shape(height, width, n)
+
+    x_indices = boundary_indices(width, n//2, boundary_behavior)
+    padded = []
+    for y in boundary_indices(height, n//2, boundary_behavior):
+        if y is None:
+            padded.append([0]*cols)
+        else:
+            row = pixels[y*width:(y+1)*width]
+            padded.append([row[i] if i is not None else 0 for i in x_indices] + [0]*(cols-len(x_indices)))
+    padded.extend([0]*cols for _ in range(rows-len(padded)))
+
+    flipped = [[vals[(n-1-i)*n + (n-1-j)] for j in range(n)] + [0]*(cols-n) for i in range(n)]
+    flipped.extend([0]*cols for _ in range(rows-n))
+
+    products = [[a*b for a, b in zip(row_a, row_b)]
+                for row_a, row_b in zip(fft2(padded), fft2(flipped))]
+    full = fft2(products, invert=True)
+
+    scale = rows*cols
+    step = fft_snap_step(vals)
+    if not all(isinstance(p, int) for p in pixels):
+        step = None
+    result = output_pixels(image, out)
+    for y in range(height):
+        row = [v.real/scale for v in full[y+n-1][n-1:n-1+width]]
+        if step == 1:
+            row = [round(v) for v in row]
+        elif step is not None:
+            row = [round(v*step)/step for v in row]
+        result[y*width:(y+1)*width] = row
+    return {'height': height, 'width': width, 'pixels': result}
+
+
+def fft_snap_step(vals):
+    '''
+    Integer pixels weighted by multiples of 1/2**m add up to exact multiples
+    of 1/2**m, so fft results can be snapped to that grid to remove the
+    transform's rounding error
+
+    Returns:
+    1 for integer kernels, 2**m for kernels of dyadic fractions (m <= 20),
+    and None otherwise
+    '''
+    if all(isinstance(v, int) for v in vals):
+        return 1
+    for m in range(1, 21):
+        step = 2**m
+        if all(float(v*step).is_integer() for v in vals):
+            return step
+    return None
+
+
+def box_sum(image, n, boundary_behavior):
+    '''
+    Sum every n-by-n window of the image using running row and column sums,
+    so each output pixel costs a constant amount of work regardless of n
+
+    Parameters:
+    * image (dict): contains height, width, and list of pixels for the image
+    * n (int): the (odd) side length of the window
+    * boundary_behavior (str): one of 'zero', 'extend', or 'wrap'
+
+    Returns:
+    A new image dictionary holding the window sums (equal to correlating with
+    an n-by-n kernel of ones), or None for an unknown boundary_behavior
+    '''
+    if boundary_behavior not in ('zero', 'extend', 'wrap'):
+        return None
+    result = []
+    for row in box_sum_rows(image, n, boundary_behavior):
+        result.extend(row)
+    return {'height': image['height'], 'width': image['width'], 'pixels': result}
+
+
+def box_sum_rows(image, n, boundary_behavior):
+    '''
+    Generate the rows of box_sum(image, n, boundary_behavior) top to bottom,
+    so callers can finish each row straight into their output.  Every input
+    pixel has been read by the time the first row comes out.
+    '''
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+    radius = n//2
+    if height*width == 0:
+        #no pixels to pad the boundary with: every row (if any) is empty
+        for _ in range(height):
+            yield []
+        return
+
+    #horizontal running sums: add the pixel entering the window, drop the one leaving it
+    x_indices = boundary_indices(width, radius, boundary_behavior)
+    rows = []
+    for y in range(height):
+        row = pixels[y*width:(y+1)*width]
+        padded = [row[i] if i is not None else 0 for i in x_indices]
+        total = sum(padded[:n])
+        sums = [total]
+        for x in range(1, width):
+            total += padded[x+n-1] - padded[x-1]
+            sums.append(total)
+        rows.append(sums)
+
+    #vertical running sums, one whole row entering and leaving at a time
+    zeros = [0]*width
+    y_rows = [rows[i] if i is not None else zeros for i in boundary_indices(height, radius, boundary_behavior)]
+    acc = [0]*width
+    for row in y_rows[:n]:
+        acc = [a + p for a, p in zip(acc, row)]
+    yield acc
+    for y in range(1, height):
+        entering = y_rows[y+n-1]
+        leaving = y_rows[y-1]
+        acc = [a + e - l for a, e, l in zip(acc, entering, leaving)]
+        yield acc
+
+
+def round_div(numerator, denominator):
+    '''
+    Round numerator/denominator (ints, denominator > 0) to the nearest int
+    exactly, sending halves to the even neighbour like Python's round
+    '''
+    quotient, remainder = divmod(numerator, denominator)
+    if 2*remainder > denominator or (2*remainder == denominator and quotient % 2 == 1):
+        return quotient + 1
+    return quotient
+
+
+def round_and_clip_image(image, out=None, region=None):
     """
     Given a dictionary, ensure that the values in the 'pixels' list are all
     integers in the range [0, 255].
@@ -192,91 +1058,501 @@ def round_and_clip_image(image):
     Any locations with values higher than 255 in the input should have value
     255 in the output; and any locations with values lower than 0 in the input
     should have value 0 in the output.
+
+    Like the other filters, this returns a new image and leaves the input
+    alone; round an image in place with round_and_clip_image(image, out=image).
+    Given a region (top, left, height, width), only that part is returned.
     """
-    list_pixels = image['pixels']
-    for i in range(len(list_pixels)):
-        list_pixels[i] = round(list_pixels[i])
-        if list_pixels[i] < 0:
-            list_pixels[i] = 0
-        if list_pixels[i] > 255:
-            list_pixels[i] = 255
-    
-    return {'height': image['height'], 'width': image['width'], 'pixels': list_pixels}
+    if region is not None:
+        return write_output(round_and_clip_image(region_window(image, region, 0, 'extend')), out)
+    if backend is not None:
+        return write_output(backend.round_and_clip_image(image), out)
+
+    #a row at a time, straight into out (each row is read before it is written)
+    pixels = image['pixels']
+    width = image['width']
+    result = output_pixels(image, out)
+    for start in range(0, len(pixels), width or 1):
+        result[start:start+width] = [min(max(round(p), 0), 255) for p in pixels[start:start+width]]
+    return write_output({'height': image['height'], 'width': width, 'pixels': result}, out)
+
+# PYRAMIDS
+
+def scaled_pixel(total, weight, integer):
+    # integer images stay integers, rounded exactly like round()
+    return round_div(total, weight) if integer else total/weight
+
+
+def downsampled(image):
+    '''
+    Halve an image in each direction (rounding odd sizes up), prefiltering
+    with the separable kernel [1, 3, 3, 1]/8 so that each new pixel is a
+    weighted average of the 4-by-4 block around the 2-by-2 block it covers,
+    rather than an aliased sample.  Out-of-bounds pixels use the 'extend'
+    behavior.
+
+    Parameters:
+    * image (dict or CompactImage): contains height, width, and pixels for the image
+
+    Returns:
+    A new image of size ((height+1)//2, (width+1)//2); integer images stay
+    integers
+    '''
+    if isinstance(image, CompactImage):
+        return apply_to_planes(image, downsampled)
+    height = image['height']
+    width = image['width']
+    pixels = image['pixels']
+    integer = all(isinstance(p, int) for p in pixels)
+
+    # positions -2 .. width+1, so output x reads positions 2x-1 .. 2x+2
+    cols = boundary_indices(width, 2, 'extend')
+    halved_rows = []
+    for y in range(height):
+        row = pixels[y*width:(y+1)*width]
+        padded = [row[i] for i in cols]
+        halved_rows.append([a + 3*b + 3*c + d for a, b, c, d in
+                            zip(padded[1::2], padded[2::2], padded[3::2], padded[4::2])])
+
+    rows = boundary_indices(height, 2, 'extend')
+    result = []
+    for y in range((height+1)//2):
+        a, b, c, d = [halved_rows[rows[i]] for i in range(2*y+1, 2*y+5)]
+        result.extend([scaled_pixel(p + 3*q + 3*r + s, 64, integer) for p, q, r, s in zip(a, b, c, d)])
+    return {'height': (height+1)//2, 'width': (width+1)//2, 'pixels': result}
+
+
+def upsampled(image, height, width):
+    '''
+    Double an image in each direction with bilinear interpolation, undoing the
+    half-pixel offset of downsampled: each new pixel mixes the two nearest
+    coarse pixels along each axis with weights 3/4 and 1/4
+
+    Parameters:
+    * image (dict or CompactImage): contains height, width, and pixels for the image
+    * height, width (int): size of the result, at most twice the input's
+      (typically the size of the level image was downsampled from)
+
+    Returns:
+    A new image of the given size; integer images stay integers
+    '''
+    if isinstance(image, CompactImage):
+        return apply_to_planes(image, lambda channel: upsampled(channel, height, width))
+    if not (height <= 2*image['height'] and width <= 2*image['width']):
+        raise ValueError('Cannot upsample %dx%d to %dx%d' % (image['height'], image['width'], height, width))
+    coarse_height = image['height']
+    coarse_width = image['width']
+    pixels = image['pixels']
+    integer = all(isinstance(p, int) for p in pixels)
+
+    def doubled(values, indices, length):
+        # even outputs mix the coarse pixel to their left, odd to their right
+        padded = [values[i] for i in indices]
+        line = [0]*(2*(len(padded)-2))
+        line[0::2] = [a + 3*b for a, b in zip(padded, padded[1:-1])]
+        line[1::2] = [3*b + c for b, c in zip(padded[1:-1], padded[2:])]
+        return line[:length]
+
+    cols = boundary_indices(coarse_width, 1, 'extend')
+    wide_rows = [doubled(pixels[y*coarse_width:(y+1)*coarse_width], cols, width)
+                 for y in range(coarse_height)]
+    rows = boundary_indices(coarse_height, 1, 'extend')
+    result = []
+    for y in range(height):
+        i = y//2 + 1
+        near, far = wide_rows[rows[i]], wide_rows[rows[i-1 if y % 2 == 0 else i+1]]
+        result.extend([scaled_pixel(3*p + q, 16, integer) for p, q in zip(near, far)])
+    return {'height': height, 'width': width, 'pixels': result}
+
+
+def pyramid(image, levels=None):
+    '''
+    Build a multi-resolution pyramid by repeated downsampling
+
+    Parameters:
+    * image (dict or CompactImage): contains height, width, and pixels for the image
+    * levels (int): number of images to return, including image itself;
+      by default, keep halving until the image is a single pixel
+
+    Returns:
+    A list of images, from image itself to the coarsest level
+    '''
+    result = [image]
+    while (len(result) < levels) if levels is not None else max(result[-1]['height'], result[-1]['width']) > 1:
+        result.append(downsampled(result[-1]))
+    return result
+
+
+def approximate_blurred(image, n, min_kernel=5):
+    '''
+    Preview-quality box blur: blur the coarsest pyramid level on which the
+    kernel still spans at least min_kernel pixels, with a kernel scaled down
+    to match, then upsample back to full size.  Each level cuts the blurring
+    work by 4; the result differs from blurred(image, n) by the smoothing of
+    the pyramid filters, which matters less the larger n is.
+    '''
+    levels = [image]
+    size = n
+    while size >= 2*min_kernel and min(levels[-1]['height'], levels[-1]['width']) > 1:
+        levels.append(downsampled(levels[-1]))
+        size /= 2
+    if len(levels) == 1:
+        return blurred(image, n)
+
+    kernel = int(size)
+    result = blurred(levels[-1], kernel if kernel % 2 == 1 else kernel+1)
+    for level in reversed(levels[:-1]):
+        result = upsampled(result, level['height'], level['width'])
+    return result
 
 # FILTERS
 
-def blurred(image, n):
+def blurred(image, n, approximate=False, out=None, region=None):
     """
     Return a new image representing the result of applying a box blur (with
     kernel size n) to the given input image.
 
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
+
+    With approximate=True, large kernels are applied on a coarser level of
+    the image pyramid instead (see approximate_blurred), which is much faster
+    but not exact.
+
+    Given `out` (an image of the same size, possibly the input itself), the
+    result is written into its pixels instead, as described in write_output.
+
+    Given a region (top, left, height, width), only that part of the output
+    is computed, from the region and a halo of n//2 pixels around it.
     """
-    # first, create a representation for the appropriate n-by-n kernel (you may
+    if region is not None:
+        return write_output(filter_region(lambda window: blurred(window, n, approximate),
+                                          image, region, (n-1)//2, 'extend'), out)
+    if approximate:
+        return write_output(approximate_blurred(image, n), out)
+    if isinstance(image, CompactImage):
+        return write_output(apply_to_planes(image, lambda channel: blurred(channel, n)), out)
+    if backend is not None:
+        return write_output(backend.blurred(image, n), out)
+
+    # integer images with an odd kernel size go through the running-sum
+    # engine, whose cost per pixel does not depend on n.  the sums are exact
+    # integers, so a single rounding division per pixel replaces the float
+    # kernel weights
+    if n % 2 == 1 and all(isinstance(p, int) for p in image['pixels']):
+        width = image['width']
+        area = n*n
+        result = output_pixels(image, out)
+        for y, sums in enumerate(box_sum_rows(image, n, 'extend')):
+            result[y*width:(y+1)*width] = [min(max(round_div(s, area), 0), 255) for s in sums]
+        return write_output({'height': image['height'], 'width': width, 'pixels': result}, out)
+
+    # otherwise, create a representation for the appropriate n-by-n kernel (you may
     # wish to define another helper function for this)
     def create_kernel(n):
         list_vals = [1/(n*n)]*n*n
         return {'dimension': n, 'list_vals': list_vals}
-    image_copy = {'height': image['height'], 'width': image['width'], 'pixels': image['pixels'].copy()}
     # then compute the correlation of the input image with that kernel using
     # the 'extend' behavior for out-of-bounds pixels
-    result = correlate(image_copy, create_kernel(n), 'extend')
+    result = correlate(image, create_kernel(n), 'extend')
 
     # and, finally, make sure that the output is a valid image (using the
     # helper function from above) before returning it.
-    return round_and_clip_image(result)
+    return round_and_clip_image(result, out=result if out is None else out)
 
 
-def sharpened(image, n):
+def sharpened(image, n, out=None, region=None):
     '''
     Apply a sharpening effect to image with kernel size n 
 
     Parameters:
-    * image (dict): contains height, width, and list of pixels for the image
+    * image (dict or CompactImage): contains height, width, and pixels for the image
     * n (int): the size of the kernel
+    * out (dict or CompactImage): optional image of the same size to write
+      the result into (see write_output); may be image itself
+    * region (tuple): optional (top, left, height, width) to compute only
+      that part of the result (see filter_region)
 
     Returns:
-    A new dictionary after sharpening the image
+    A new dictionary after sharpening the image, or out
     '''
+    if region is not None:
+        return write_output(filter_region(lambda window: sharpened(window, n),
+                                          image, region, (n-1)//2, 'extend'), out)
+    if isinstance(image, CompactImage):
+        return write_output(apply_to_planes(image, lambda channel: sharpened(channel, n)), out)
+    if backend is not None:
+        return write_output(backend.sharpened(image, n), out)
+
+    # integer images: 2*pixel - blur straight from the exact window sums
+    pixels = image['pixels']
+    width = image['width']
+    result = output_pixels(image, out)
+    if n % 2 == 1 and all(isinstance(p, int) for p in pixels):
+        area = n*n
+        for y, sums in enumerate(box_sum_rows(image, n, 'extend')):
+            start = y*width
+            result[start:start+width] = [min(max(2*p - min(max(round_div(s, area), 0), 255), 0), 255)
+                                         for p, s in zip(pixels[start:start+width], sums)]
+        return write_output({'height': image['height'], 'width': width, 'pixels': result}, out)
+
     B_xy = blurred(image, n)['pixels']
-    
-    S_xy= []
-    for i, j in zip(image['pixels'], B_xy):
-        S_xy.append(2*i-j)
 
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': S_xy
-    }
-    return round_and_clip_image(result)
+    #each row of 2*pixel - blur is read before it is overwritten
+    for start in range(0, len(B_xy), width or 1):
+        S_xy = [2*i-j for i, j in zip(pixels[start:start+width], B_xy[start:start+width])]
+        result[start:start+width] = [min(max(round(p), 0), 255) for p in S_xy]
+    return write_output({'height': image['height'], 'width': width, 'pixels': result}, out)
+
+def sobel_rows(image):
+    '''
+    Yield the Sobel gradients of an integer greyscale image one row at a
+    time, with the 'extend' behavior, reading each row only once: every row
+    is differenced (p[x+1] - p[x-1]) and smoothed (p[x-1] + 2p[x] + p[x+1])
+    as it comes in, and the three rows around y combine into both gradients
+
+    Returns:
+    A generator of (gx, gy) pairs of lists of ints, one per row
+    '''
+    width = image['width']
+    pixels = image['pixels']
+    return sobel_stream_rows(lambda y: pixels[y*width:(y+1)*width], image['height'])
+
+
+def sobel_stream_rows(read_row, height):
+    '''
+    Like sobel_rows, but reading the rows of the image through read_row(y)
+    (a list of ints), each exactly once, and keeping only three rows' terms
+    '''
+    if height == 0:
+        return
+
+    def row_terms(y):
+        row = list(read_row(y))
+        #empty rows (0 wide images) stay empty
+        padded = [row[0]] + row + [row[-1]] if row else []
+        diff = [c - a for a, c in zip(padded, padded[2:])]
+        smooth = [a + 2*b + c for a, b, c in zip(padded, padded[1:], padded[2:])]
+        return diff, smooth
+
+    above = current = row_terms(0)
+    for y in range(height):
+        below = row_terms(y+1) if y+1 < height else current
+        gx = [a + 2*b + c for a, b, c in zip(above[0], current[0], below[0])]
+        gy = [c - a for a, c in zip(above[1], below[1])]
+        yield gx, gy
+        above, current = current, below
 
-def edges(image):
+
+#round(sqrt(m)) for every squared gradient magnitude m that does not clip to 255
+sobel_magnitudes = []
+
+
+def sobel_magnitude_table():
+    if not sobel_magnitudes:
+        #255.5**2 < 65281, so larger magnitudes all round and clip to 255
+        sobel_magnitudes.extend(round(m**(1/2)) for m in range(65281))
+    return sobel_magnitudes
+
+
+def edges(image, out=None, norm='l2', region=None):
     '''
     Apply a Sobel operator filter useful for detecting edges in images
 
     Parameters:
-    * image (dict): contains height, width, and list of pixels for the image
+    * image (dict or CompactImage): contains height, width, and pixels for the image
+    * out (dict or CompactImage): optional image of the same size to write
+      the result into (see write_output); may be image itself
+    * norm (str): 'l2' (the default) for the gradient magnitude
+      sqrt(gx**2 + gy**2), or 'l1' for the cheaper approximation |gx| + |gy|,
+      which is never smaller and at most about 1.41 times larger
+    * region (tuple): optional (top, left, height, width) to compute only
+      that part of the result (see filter_region)
 
     Returns:
-    A new image dictionary after applying the Sobel operator filter
+    A new image dictionary after applying the Sobel operator filter, or out
 
     '''
+    if norm not in ('l2', 'l1'):
+        raise ValueError('Unknown edges norm: %r' % norm)
+    if region is not None:
+        return write_output(filter_region(lambda window: edges(window, norm=norm),
+                                          image, region, 1, 'extend'), out)
+    if isinstance(image, CompactImage):
+        return write_output(apply_to_planes(image, lambda channel: edges(channel, norm=norm)), out)
+    if backend is not None:
+        return write_output(backend.edges(image, norm), out)
+
+    # integer images: both gradients from one pass over the rows, and the
+    # rounded, clipped magnitude looked up from the exact table
+    # (sobel_rows reads row y+1 before row y is written, so out may be image)
+    width = image['width']
+    if all(isinstance(p, int) for p in image['pixels']):
+        result = output_pixels(image, out)
+        if norm == 'l1':
+            for y, (gx, gy) in enumerate(sobel_rows(image)):
+                result[y*width:(y+1)*width] = [min(abs(i) + abs(j), 255) for i, j in zip(gx, gy)]
+        else:
+            table = sobel_magnitude_table()
+            limit = len(table)
+            for y, (gx, gy) in enumerate(sobel_rows(image)):
+                result[y*width:(y+1)*width] = [table[m] if (m := i*i + j*j) < limit else 255
+                                               for i, j in zip(gx, gy)]
+        return write_output({'height': image['height'], 'width': width, 'pixels': result}, out)
+
     kx = {'dimension': 3, 'list_vals': [-1, 0, 1, -2, 0, 2, -1, 0, 1]}
     ky = {'dimension': 3, 'list_vals': [-1, -2, -1, 0, 0, 0, 1, 2, 1]}
     O_x = correlate(image, kx, "extend")
     O_y = correlate(image, ky, 'extend')
     
+    result = output_pixels(image, out)
+    for k, (i, j) in enumerate(zip(O_x['pixels'], O_y['pixels'])):
+        if norm == 'l1':
+            result[k] = min(round(abs(i) + abs(j)), 255)
+        else:
+            result[k] = min(round((i**2+j**2)**(1/2)), 255)
+
+    return write_output({'height': image['height'], 'width': width, 'pixels': result}, out)
+
+# RANK FILTERS
+
+#windows at least this wide slide through dense per-column histograms, whose
+#cost per pixel is flat in n; narrower windows update the window histogram
+#pixel by pixel, which is faster until about this size (measured)
+DENSE_RANK_WINDOW = 121
+
+
+def rank_filtered(image, n, rank, boundary_behavior='extend', region=None):
+    '''
+    Replace every pixel with the rank-th smallest value (counting from 0) in
+    the n-by-n window around it, reading out-of-bounds pixels according to
+    boundary_behavior as correlate does
+
+    8-bit images are filtered with a sliding window histogram: moving one
+    pixel right removes one column of the window and adds another, and the
+    answer is found by walking the histogram from the previous answer, so no
+    window is ever sorted.  Windows of DENSE_RANK_WINDOW or more keep a
+    histogram per column as well (Perreault and Hebert's method), making the
+    cost per pixel independent of n.
+
+    Parameters:
+    * image (dict or CompactImage): contains height, width, and pixels for the image
+    * n (int): odd window size
+    * rank (int): from 0 (minimum) to n*n-1 (maximum)
+    * boundary_behavior (str): 'zero', 'extend', or 'wrap'
+    * region (tuple): optional (top, left, height, width) to compute only
+      that part of the result (see filter_region)
+
+    Returns:
+    A new image, or None if boundary_behavior is not valid
+    '''
+    if boundary_behavior not in ('zero', 'extend', 'wrap'):
+        return None
+    if n < 1 or n % 2 == 0:
+        raise ValueError('Rank filters need an odd window size, not %r' % n)
+    if not 0 <= rank < n*n:
+        raise ValueError('Rank %r is outside the %d pixels of the window' % (rank, n*n))
+    if region is not None:
+        return filter_region(lambda window: rank_filtered(window, n, rank, boundary_behavior),
+                             image, region, n//2, boundary_behavior)
+    if isinstance(image, CompactImage):
+        return apply_to_planes(image, lambda channel: rank_filtered(channel, n, rank, boundary_behavior))
+
+    height = image['height']
+    width = image['width']
+    pixels = image['pixels']
+    if height*width == 0:
+        #no pixels, so nothing to pad the boundary with
+        return {'height': height, 'width': width, 'pixels': []}
+    rows = boundary_indices(height, n//2, boundary_behavior)
+    cols = boundary_indices(width, n//2, boundary_behavior)
+    #each source row padded to the window's columns once, shared by the
+    #windows that read it
+    padded_rows = {y: [0]*len(cols) if y is None else [0 if x is None else pixels[y*width+x] for x in cols]
+                   for y in set(rows)}
+    window = [padded_rows[y] for y in rows[:n]]
+
+    if not all(isinstance(p, int) and 0 <= p <= 255 for p in pixels):
+        # no histogram for other values; sort each window instead
+        result = []
+        for y in range(height):
+            window = [padded_rows[row] for row in rows[y:y+n]]
+            for x in range(width):
+                result.append(sorted(v for row in window for v in row[x:x+n])[rank])
+        return {'height': height, 'width': width, 'pixels': result}
+
+    dense = n >= DENSE_RANK_WINDOW
+    if dense:
+        columns = [[0]*256 for _ in cols]
+        for row in window:
+            for column, p in zip(columns, row):
+                column[p] += 1
+
     result = []
-    for i,j in zip(O_x['pixels'], O_y['pixels']):
-        result.append(round((i**2+j**2)**(1/2)))
-        
-    O_xy = {'height': image['height'], 'width': image['width'], 'pixels': result}
-    
-    
+    for y in range(height):
+        if y > 0:
+            leaving = window.pop(0)
+            window.append(padded_rows[rows[y+n-1]])
+            if dense:
+                for column, a, b in zip(columns, leaving, window[-1]):
+                    column[a] -= 1
+                    column[b] += 1
+
+        # window histogram at the start of the row, and its rank-th value v,
+        # with below pixels smaller than v
+        if dense:
+            counts = [sum(c) for c in zip(*columns[:n])]
+        else:
+            counts = [0]*256
+            for row in window:
+                for p in row[:n]:
+                    counts[p] += 1
+        v = below = 0
+        while below + counts[v] <= rank:
+            below += counts[v]
+            v += 1
+        result.append(v)
+
+        for x in range(1, width):
+            if dense:
+                counts = [c - a + b for c, a, b in zip(counts, columns[x-1], columns[x+n-1])]
+                below = sum(counts[:v])
+            else:
+                for row in window:
+                    a = row[x-1]
+                    b = row[x+n-1]
+                    counts[a] -= 1
+                    counts[b] += 1
+                    below += (b < v) - (a < v)
+            while below > rank:
+                v -= 1
+                below -= counts[v]
+            while below + counts[v] <= rank:
+                below += counts[v]
+                v += 1
+            result.append(v)
+    return {'height': height, 'width': width, 'pixels': result}
+
+
+def median_filtered(image, n, boundary_behavior='extend', region=None):
+    '''
+    Median of the n-by-n window around every pixel (see rank_filtered)
+    '''
+    return rank_filtered(image, n, n*n//2, boundary_behavior, region)
 
-    return round_and_clip_image(O_xy)
+
+def eroded(image, n, boundary_behavior='extend', region=None):
+    '''
+    Minimum of the n-by-n window around every pixel (see rank_filtered)
+    '''
+    return rank_filtered(image, n, 0, boundary_behavior, region)
+
+
+def dilated(image, n, boundary_behavior='extend', region=None):
+    '''
+    Maximum of the n-by-n window around every pixel (see rank_filtered)
+    '''
+    return rank_filtered(image, n, n*n-1, boundary_behavior, region)
 
 # COLOR FILTERS
 
@@ -285,10 +1561,14 @@ def color_split(image):
     Split the color image RGB values into separate lists
 
     Parameters:
-    * image (dict): contains height, width, and list of pixels for the image
+    * image (dict or CompactImage): contains height, width, and pixels for the image
 
     Returns a tuple of lists for each R, G, and B value in a color image
     '''
+    if isinstance(image, CompactImage):
+        #the planes are already split, so no pixels need to be copied
+        return tuple(image.channels())
+
     r_pixels = []
     g_pixels = []
     b_pixels = []
@@ -324,52 +1604,444 @@ def color_filter_from_greyscale_filter(filt):
     input and produces the filtered color image.
     """
     def new_filt(image):
+        if isinstance(image, CompactImage):
+            return apply_to_planes(image, filt)
+
         red, green, blue = color_split(image)
-        red_result = filt(red)
-        green_result = filt(green)
-        blue_result = filt(blue)
+        red_result = profiled('red', filt, red)
+        green_result = profiled('green', filt, green)
+        blue_result = profiled('blue', filt, blue)
 
         return color_combine(image, red_result, green_result, blue_result)
+    #lets filter_cascade keep the channels split across consecutive color filters
+    new_filt.greyscale_filter = filt
+    if hasattr(filt, 'descriptor'):
+        new_filt.descriptor = ('color', filt.descriptor)
     return new_filt
 
 def make_blur_filter(n):
     def blur(image):
         return blurred(image, n)
+    blur.descriptor = ('blurred', n)
     return blur
 
 def make_sharpen_filter(n):
     def sharpen(image):
         return sharpened(image, n)
+    sharpen.descriptor = ('sharpened', n)
     return sharpen
 
+def make_point_filter(op, descriptor):
+    '''
+    Greyscale filter applying op to every pixel, which filter_cascade can
+    fuse with neighbouring point filters
+
+    Parameters:
+    * op: pure function from a pixel value to a new pixel value, tabulated
+      once here (see tabulated)
+    * descriptor (tuple): (operation name, *arguments) describing op
+    '''
+    def point_filter(image):
+        return apply_point_op(image, point_filter.point_op)
+    point_filter.point_op = tabulated(op)
+    point_filter.descriptor = descriptor
+    return point_filter
+
+def make_brightness_filter(n):
+    '''
+    Greyscale filter adding n to every pixel, clipped to 0..255
+    '''
+    return make_point_filter(lambda c: min(max(c+n, 0), 255), ('brightness', n))
+
+def make_contrast_filter(factor):
+    '''
+    Greyscale filter scaling every pixel's distance from mid-grey (128) by
+    factor, rounded and clipped to 0..255
+    '''
+    return make_point_filter(lambda c: min(max(round(128 + (c-128)*factor), 0), 255),
+                             ('contrast', factor))
+
+def make_gamma_filter(gamma):
+    '''
+    Greyscale filter applying the tone curve 255*(c/255)**gamma (darkening
+    for gamma above 1, lightening below), rounded and clipped to 0..255
+    '''
+    return make_point_filter(lambda c: round(255*(min(max(c, 0), 255)/255)**gamma),
+                             ('gamma', gamma))
+
 def filter_cascade(filters):
     """
     Given a list of filters (implemented as functions on images), returns a new
     single filter such that applying that filter to an image produces the same
     output as applying each of the individual ones in turn.
+
+    The filters are grouped by plan_cascade first, so a run of color filters
+    splits the channels once and combines them once, and adjacent per-pixel
+    operations run as a single pass.
     """
+    stages = plan_cascade(filters)
     def filter_cas(image):
-        for filter in filters:
-            image = filter(image)
-        return image
+        return profiled('cascade', lambda image: run_stages(image, stages), image)
+    filter_cas.filters = list(filters)
     return filter_cas
 
-#adjust the brightness of the image by value n
+
+def plan_cascade(filters):
+    '''
+    Group a list of filters into stages for run_stages
+
+    Returns:
+    A list of (kind, stage) tuples, where kind is one of
+    * 'channels': stage is a plan for consecutive color filters built with
+      color_filter_from_greyscale_filter, run on each channel separately
+    * 'point': stage is the composition of consecutive per-pixel operations
+      (filters with a point_op attribute, such as inverted)
+    * 'image': stage is any other filter, applied to the whole image
+    '''
+    stages = []
+    greyscale_run = []
+    for filt in filters:
+        greyscale = getattr(filt, 'greyscale_filter', None)
+        if greyscale is not None:
+            greyscale_run.append(greyscale)
+            continue
+        if greyscale_run:
+            stages.append(('channels', plan_cascade(greyscale_run)))
+            greyscale_run = []
+
+        point_op = getattr(filt, 'point_op', None)
+        if point_op is None:
+            stages.append(('image', filt))
+        elif stages and stages[-1][0] == 'point':
+            stages[-1] = ('point', compose_point_ops(stages[-1][1], point_op))
+        else:
+            stages.append(('point', point_op))
+    if greyscale_run:
+        stages.append(('channels', plan_cascade(greyscale_run)))
+    return stages
+
+
+def compose_point_ops(first, second):
+    '''
+    Compose two per-pixel operations, first then second
+
+    When both carry lookup tables (see tabulated), the tables fold into the
+    table of the result, so a whole run of point ops costs one table lookup
+    per pixel.
+    '''
+    def composed(c):
+        return second(first(c))
+    if hasattr(first, 'table') and hasattr(second, 'table'):
+        composed.table = [second.table[v] if is_byte(v) else second(v) for v in first.table]
+    return composed
+
+
+def run_stages(image, stages):
+    '''
+    Apply stages from plan_cascade to image in order
+
+    Each intermediate image is dropped as soon as the next stage has consumed
+    it, so at most two buffers per channel are alive at any time.
+    '''
+    for number, (kind, stage) in enumerate(stages, 1):
+        if kind == 'channels':
+            image = profiled('stage %d: channels' % number, lambda image: run_channels(image, stage), image)
+        elif kind == 'point':
+            image = profiled('stage %d: point op' % number, lambda image: apply_point_op(image, stage), image)
+        else:
+            image = profiled('stage %d: %s' % (number, describe_filter(stage)), stage, image)
+    return image
+
+
+def run_channels(image, stages):
+    # apply a plan for greyscale filters to each channel of a color image
+    channels = [profiled(name, lambda channel: run_stages(channel, stages), channel)
+                for name, channel in zip(['red', 'green', 'blue'], color_split(image))]
+    if isinstance(image, CompactImage):
+        return CompactImage.from_channels(channels)
+    return color_combine(image, *channels)
+
+
+def apply_point_op(image, op):
+    '''
+    Apply a function of one pixel value to every pixel in a single pass
+
+    Images of 8-bit values are mapped through a lookup table in one pass:
+    op's own table if it carries one (see tabulated), otherwise a table of
+    op over just the values present, built for this call only.
+
+    Parameters:
+    * image (dict or CompactImage): contains height, width, and pixels for the image
+    * op: function from a pixel value to a new pixel value
+
+    Returns:
+    A new image of the same kind as image
+    '''
+    if isinstance(image, CompactImage):
+        return CompactImage.from_channels([apply_point_op(channel, op) for channel in image.channels()])
+    pixels = image['pixels']
+    source = byte_pixels(pixels)
+    if source is None:
+        mapped = [op(c) for c in pixels]
+    else:
+        #op runs once per distinct value (never on values that are absent)
+        mapped = apply_lookup_table(source, lookup_table(op, set(source)))
+        if isinstance(pixels, list) and not isinstance(mapped, list):
+            mapped = list(mapped)
+    return {'height': image['height'], 'width': image['width'], 'pixels': mapped}
+
+
+#adjust the brightness of the image by value n, clipping to 0..255
 def filter_brightness(image, n):
-    red, green, blue = color_split(image)
-    colors = [red['pixels'], green['pixels'], blue['pixels']]
-    
-    for color in colors:
-        for i in range(len(color)):
-            color[i] = color[i]+ n
+    if backend is not None and not isinstance(image, CompactImage):
+        return backend.filter_brightness(image, n)
+    return color_filter_from_greyscale_filter(make_brightness_filter(n))(image)
+
+
+#per-pixel operations that filter_cascade can fuse into a single pass
+inverted.point_op = tabulated(lambda c: 255-c)
+round_and_clip_image.point_op = tabulated(lambda c: min(max(round(c), 0), 255))
+
+#canonical descriptions of filters, (operation name, *arguments), so results
+#can be looked up by what was computed (see cache.py)
+inverted.descriptor = ('inverted',)
+edges.descriptor = ('edges',)
+round_and_clip_image.descriptor = ('round_and_clip_image',)
+
+
+# SEAM CARVING
+
+def greyscale_image_from_color_image(image):
+    """
+    Given a color image, computes and returns a corresponding greyscale image
+    with round(.299*r + .587*g + .114*b) per pixel.
+
+    Returns a greyscale image (represented as a dictionary).
+    """
+    if isinstance(image, CompactImage):
+        pixels = list(rgb_to_greyscale(*image.planes))
+    else:
+        pixels = [round(.299 * r + .587 * g + .114 * b) for r, g, b in image['pixels']]
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+
+def compute_energy(grey):
+    """
+    Given a greyscale image, computes a measure of "energy", in our case using
+    the edges function from last week.
+
+    Returns a greyscale image (represented as a dictionary).
+    """
+    return edges(grey)
+
+
+def cumulative_energy_map(energy):
+    """
+    Given a measure of energy (e.g., the output of the compute_energy
+    function), computes a "cumulative energy map": the energy of each pixel
+    plus the least cumulative energy of the (up to) three pixels above it.
+
+    Returns a dictionary with 'height', 'width', and 'pixels' keys (but where
+    the values in the 'pixels' array may not necessarily be in the range [0,
+    255].
+    """
+    height, width = energy['height'], energy['width']
+    pixels = energy['pixels']
+    row = list(pixels[:width])
+    result = list(row)
+    for y in range(1, height):
+        #min over whole shifted rows, with the edge columns repeated
+        above = map(min, row[:1] + row[:-1], row, row[1:] + row[-1:])
+        row = [e + m for e, m in zip(pixels[y*width:(y+1)*width], above)]
+        result.extend(row)
+    return {'height': height, 'width': width, 'pixels': result}
+
+
+def minimum_energy_seam(cem):
+    """
+    Given a cumulative energy map, returns a list of the indices into the
+    'pixels' list that correspond to pixels contained in the minimum-energy
+    seam (computed as described in the lab 2 writeup), from the bottom row
+    to the top.  Ties go to the leftmost pixel.
+    """
+    height, width = cem['height'], cem['width']
+    pixels = cem['pixels']
+    bottom = pixels[(height-1)*width:height*width]
+    x = bottom.index(min(bottom))
+    seam = [(height-1)*width + x]
+    for y in range(height-2, -1, -1):
+        #follow the cheapest of the three pixels above
+        left = max(x-1, 0)
+        above = pixels[y*width+left:y*width+min(x+2, width)]
+        x = left + above.index(min(above))
+        seam.append(y*width + x)
+    return seam
+
+
+def image_without_seam(image, seam):
+    """
+    Given a (color or greyscale) image and a list of indices to be removed
+    from the image, return a new image (without modifying the original) that
+    contains all the pixels from the original image except those
+    corresponding to the locations in the given list.
+
+    Parameters:
+    * image (dict or CompactImage): contains height, width, and pixels for the image
+    * seam (list): one index into the pixels per row, in any order
+
+    Returns:
+    A new image of the same kind, one column narrower
+    """
+    indices = sorted(seam)
+
+    def without_seam(pixels):
+        #copy the runs between removed pixels, keeping the sequence type
+        result = pixels[:0]
+        start = 0
+        for index in indices:
+            result += pixels[start:index]
+            start = index+1
+        result += pixels[start:]
+        return result
+
+    if isinstance(image, CompactImage):
+        return CompactImage(image.height, image.width-1, [without_seam(plane) for plane in image.planes])
+    return {'height': image['height'], 'width': image['width']-1, 'pixels': without_seam(image['pixels'])}
+
+
+def carved_energy(energy, grey, seam):
+    """
+    Energy map of an image after removing a seam, recomputing only the
+    pixels the seam passed next to instead of the whole map
+
+    A pixel's energy depends on its 3x3 neighbourhood, which is unchanged
+    unless the seam crossed it: in each row, only the columns from one left
+    of the leftmost removed pixel in that row and its neighbouring rows up
+    to the rightmost one (in the narrower image) need recomputing.
+
+    Parameters:
+    * energy (dict): energy map of the image the seam was removed from
+    * grey (dict): greyscale image after removing the seam
+    * seam (list): the removed seam, as from minimum_energy_seam
+
+    Returns:
+    A new energy map, equal to compute_energy(grey) for integer grey pixels
+    """
+    result = image_without_seam(energy, seam)
+    height, width = grey['height'], grey['width']
+    columns = [0]*height
+    for index in seam:
+        y, x = divmod(index, width+1)
+        columns[y] = x
+    pixels = result['pixels']
+    g = grey['pixels']
+    table = sobel_magnitude_table()
+    limit = len(table)
+    for y in range(height):
+        near = columns[max(y-1, 0):y+2]
+        #row offsets of the pixels above, at, and below, extended at the edges
+        up, mid, down = max(y-1, 0)*width, y*width, min(y+1, height-1)*width
+        for x in range(max(min(near)-1, 0), min(max(near), width-1)+1):
+            #the edges kernels, read directly for these few pixels
+            l, r = max(x-1, 0), min(x+1, width-1)
+            gx = g[up+r] - g[up+l] + 2*(g[mid+r] - g[mid+l]) + g[down+r] - g[down+l]
+            gy = g[down+l] + 2*g[down+x] + g[down+r] - g[up+l] - 2*g[up+x] - g[up+r]
+            m = gx*gx + gy*gy
+            pixels[mid+x] = table[m] if m < limit else 255
+    return result
+
+
+def seam_carving(image, ncols):
+    """
+    Starting from the given image, use the seam carving technique to remove
+    ncols (an integer) columns from the image. Returns a new image.
+
+    The energy map is computed once; after each seam is removed only the
+    energies next to it are recomputed (see carved_energy), so each seam
+    costs a cumulative energy map rather than a whole edges pass.
+
+    Parameters:
+    * image (dict or CompactImage): color image
+    * ncols (int): number of columns to remove, less than the image width
+
+    Returns:
+    A new image of the same kind, ncols columns narrower
+    """
+    if not 0 <= ncols < image['width']:
+        raise ValueError('Cannot remove %r columns from a %d pixel wide image' % (ncols, image['width']))
+    if ncols == 0:
+        return cropped(image, (0, 0, image['height'], image['width']))
+    grey = greyscale_image_from_color_image(image)
+    energy = compute_energy(grey)
+    for _ in range(ncols):
+        seam = minimum_energy_seam(cumulative_energy_map(energy))
+        image = image_without_seam(image, seam)
+        grey = image_without_seam(grey, seam)
+        energy = carved_energy(energy, grey, seam)
+    return image
 
-    return color_combine(image, red, green, blue)
-    
 
-    
-    
 # HELPER FUNCTIONS FOR LOADING AND SAVING IMAGES
 
+def rgb_to_greyscale(r, g, b):
+    """
+    Convert red, green, and blue planes (bytes) to one greyscale plane with
+    round(.299*r + .587*g + .114*b).  A backend with its own rgb_to_greyscale
+    converts whole planes at once, to the same values.
+
+    Returns:
+    A bytearray with one byte per pixel
+    """
+    if backend is not None and hasattr(backend, 'rgb_to_greyscale'):
+        return backend.rgb_to_greyscale(r, g, b)
+    return bytearray(round(.299 * i + .587 * j + .114 * k)
+                     for i, j, k in zip(r, g, b))
+
+
+def greyscale_plane(img, exact=True):
+    """
+    Read the pixels of a PIL image as one greyscale bytearray, without
+    building per-pixel tuples.
+
+    PIL's own convert('L') rounds in fixed point and differs by one from
+    rgb_to_greyscale on 9443 of the 2**24 colors, so it is only used when
+    exact is False.
+    """
+    if img.mode.startswith('RGB'):
+        if not exact:
+            return bytearray(img.convert('L').tobytes())
+        return rgb_to_greyscale(*[band.tobytes() for band in img.split()[:3]])
+    elif img.mode in ('L', 'LA'):
+        return bytearray(img.getchannel(0).tobytes())
+    else:
+        raise ValueError('Unsupported image mode: %r' % img.mode)
+
+
+def pil_image(image, mode):
+    """
+    Build a PIL image in mode 'L' or 'RGB' from an image dictionary or
+    CompactImage, copying whole planes with frombytes where possible
+    """
+    size = (image['width'], image['height'])
+    if isinstance(image, CompactImage):
+        bands = [Image.frombytes('L', size, bytes(plane)) for plane in image.planes]
+        if mode == 'L' and len(bands) == 1:
+            return bands[0]
+        if mode == 'RGB' and len(bands) == 3:
+            return Image.merge('RGB', bands)
+        image = image.to_dict()
+
+    if mode == 'L':
+        try:
+            # 8-bit integer pixels pack straight into bytes
+            return Image.frombytes('L', size, bytes(image['pixels']))
+        except (TypeError, ValueError):
+            pass
+    out = Image.new(mode=mode, size=size)
+    out.putdata(image['pixels'])
+    return out
+
+
 def load_greyscale_image(filename):
     """
     Loads an image from the given file and returns an instance of this class
@@ -380,16 +2052,7 @@ def load_greyscale_image(filename):
     """
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
-        img_data = img.getdata()
-        if img.mode.startswith('RGB'):
-            pixels = [round(.299 * p[0] + .587 * p[1] + .114 * p[2])
-                      for p in img_data]
-        elif img.mode == 'LA':
-            pixels = [p[0] for p in img_data]
-        elif img.mode == 'L':
-            pixels = list(img_data)
-        else:
-            raise ValueError('Unsupported image mode: %r' % img.mode)
+        pixels = list(greyscale_plane(img))
         w, h = img.size
         return {'height': h, 'width': w, 'pixels': pixels}
 
@@ -401,8 +2064,7 @@ def save_greyscale_image(image, filename, mode='PNG'):
     filename is given as a file-like object, the file type will be determined
     by the 'mode' parameter.
     """
-    out = Image.new(mode='L', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    out = pil_image(image, 'L')
     if isinstance(filename, str):
         out.save(filename)
     else:
@@ -421,8 +2083,7 @@ def load_color_image(filename):
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
         img = img.convert('RGB')  # in case we were given a greyscale image
-        img_data = img.getdata()
-        pixels = list(img_data)
+        pixels = list(zip(*[band.tobytes() for band in img.split()]))
         w, h = img.size
         return {'height': h, 'width': w, 'pixels': pixels}
 
@@ -434,8 +2095,7 @@ def save_color_image(image, filename, mode='PNG'):
     If filename is given as a file-like object, the file type will be
     determined by the 'mode' parameter.
     """
-    out = Image.new(mode='RGB', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    out = pil_image(image, 'RGB')
     if isinstance(filename, str):
         out.save(filename)
     else:
@@ -443,6 +2103,281 @@ def save_color_image(image, filename, mode='PNG'):
     out.close()
 
 
+def load_compact_image(filename, color=True, exact=True):
+    """
+    Loads an image from the given file into a CompactImage without building a
+    list of per-pixel values or tuples.  Greyscale conversion matches
+    load_greyscale_image, unless exact is False, in which case PIL's faster
+    convert('L') is used (see greyscale_plane).
+
+    Invoked as, for example:
+       i = load_compact_image('test_images/cat.png')
+       j = load_compact_image('test_images/cat.png', color=False)
+    """
+    with open(filename, 'rb') as img_handle:
+        img = Image.open(img_handle)
+        w, h = img.size
+        if color:
+            img = img.convert('RGB')  # in case we were given a greyscale image
+            planes = [bytearray(band.tobytes()) for band in img.split()]
+        else:
+            planes = [greyscale_plane(img, exact)]
+        return CompactImage(h, w, planes)
+
+
+
+# STREAMING
+
+class RowReader:
+    '''
+    Reads the rows of an image file one at a time as lists of greyscale
+    values (converted the same way as load_greyscale_image), so filters can
+    run without a pixel list for the whole image.  Only the rows that are
+    asked for become lists, but PIL decodes the whole file into its own
+    buffer (a few bytes per pixel) on the first read, so the decoded image
+    still has to fit in memory.  For images larger than RAM, use
+    PGMRowReader (or RawRowReader), which read rows straight from disk.
+
+    Invoked as, for example:
+       with RowReader('test_images/cat.png') as reader:
+           save_greyscale_rows(stream_edges(reader.read_row, reader.height, reader.width),
+                               reader.width, reader.height, 'cat_edges.pgm')
+    '''
+    def __init__(self, filename):
+        self.handle = open(filename, 'rb')
+        self.img = Image.open(self.handle)
+        if not (self.img.mode.startswith('RGB') or self.img.mode in ('L', 'LA')):
+            self.close()
+            raise ValueError('Unsupported image mode: %r' % self.img.mode)
+        self.width, self.height = self.img.size
+
+    def read_row(self, y):
+        bands = self.img.crop((0, y, self.width, y+1)).split()
+        if self.img.mode.startswith('RGB'):
+            r, g, b = [band.tobytes() for band in bands[:3]]
+            return [round(.299 * i + .587 * j + .114 * k) for i, j, k in zip(r, g, b)]
+        return list(bands[0].tobytes())
+
+    def close(self):
+        self.img.close()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RawRowReader:
+    '''
+    Reads the rows of a file of 8-bit greyscale pixels (width bytes per row,
+    top to bottom, starting offset bytes in) one at a time, seeking to each
+    row, so only the rows asked for are ever in memory.  Files of any size
+    can be filtered this way, together with save_greyscale_rows.
+    '''
+    def __init__(self, filename, width, height, offset=0):
+        self.handle = open(filename, 'rb')
+        self.width = width
+        self.height = height
+        self.offset = offset
+
+    def read_row(self, y):
+        if not 0 <= y < self.height:
+            raise IndexError('Row %d is outside the %d row image' % (y, self.height))
+        self.handle.seek(self.offset + y*self.width)
+        row = self.handle.read(self.width)
+        if len(row) != self.width:
+            raise ValueError('Truncated row %d: %d of %d bytes' % (y, len(row), self.width))
+        return list(row)
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PGMRowReader(RawRowReader):
+    '''
+    RawRowReader for binary PGM files (such as those save_greyscale_rows
+    writes), taking the size from the header.
+
+    Invoked as, for example:
+       with PGMRowReader('mosaic.pgm') as reader:
+           save_greyscale_rows(stream_edges(reader.read_row, reader.height, reader.width),
+                               reader.width, reader.height, 'mosaic_edges.pgm')
+    '''
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            #magic number, width, height, and maxval, separated by whitespace
+            #and comments, then a single whitespace byte before the pixels
+            fields = [b'']
+            while True:
+                c = f.read(1)
+                if not c:
+                    raise ValueError('Truncated PGM header: %r' % filename)
+                if c == b'#':
+                    f.readline()
+                elif not c.isspace():
+                    fields[-1] += c
+                elif len(fields) == 4 and fields[-1]:
+                    break
+                elif fields[-1]:
+                    fields.append(b'')
+            offset = f.tell()
+        magic, width, height, maxval = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+        if magic != b'P5' or maxval > 255:
+            raise ValueError('Not an 8-bit binary PGM file: %r' % filename)
+        RawRowReader.__init__(self, filename, width, height, offset)
+
+
+def stream_correlate(read_row, height, width, kernel, boundary_behavior):
+    '''
+    Correlate an image with kernel one output row at a time, reading input
+    rows through read_row(y) and keeping only the rows the kernel currently
+    covers.  Every output row is identical to the matching row of correlate.
+
+    Parameters:
+    * read_row: function returning row y of the image as a list of ints
+      (as RowReader.read_row does)
+    * height (int), width (int): the dimensions of the image
+    * kernel (dict): contains dimension and list_vals for the kernel
+    * boundary_behavior (str): one of 'zero', 'extend', or 'wrap'
+
+    Returns:
+    A generator of output rows (lists of unrounded values), top to bottom
+    '''
+    if boundary_behavior not in ('zero', 'extend', 'wrap'):
+        raise ValueError('Unknown boundary behavior: %r' % boundary_behavior)
+    if height*width == 0:
+        #no pixels to pad the boundary with: every row (if any) is empty
+        for _ in range(height):
+            yield []
+        return
+    radius = (kernel['dimension']-1)//2
+    side = 2*radius+1
+    x_indices = boundary_indices(width, radius, boundary_behavior)
+    y_indices = boundary_indices(height, radius, boundary_behavior)
+
+    factors = exact_factors(separate_kernel(kernel))
+    if factors is not None:
+        col_vals, row_vals = factors
+        row_taps = [(j, w) for j, w in enumerate(row_vals) if w != 0]
+        #buffered rows already hold their horizontal pass, as in correlate_separable
+        def prepare(row):
+            padded = [row[i] if i is not None else 0 for i in x_indices]
+            return [sum(w*padded[x+j] for j, w in row_taps) for x in range(width)]
+        taps = [(i, [(0, w)]) for i, w in enumerate(col_vals) if w != 0]
+    else:
+        #buffered rows are padded; each kernel row is applied tap by tap
+        vals = kernel['list_vals'][:side*side]
+        def prepare(row):
+            return [row[i] if i is not None else 0 for i in x_indices]
+        taps = [(i, [(j, vals[i*side+j]) for j in range(side) if vals[i*side+j] != 0])
+                for i in range(side)]
+        taps = [(i, kernel_row) for i, kernel_row in taps if kernel_row]
+
+    buffered = {}
+    for y in range(height):
+        window = y_indices[y:y+side]
+        for source in list(buffered):
+            if source not in window:
+                del buffered[source]
+        for source in window:
+            if source is not None and source not in buffered:
+                buffered[source] = prepare(read_row(source))
+
+        acc = [0]*width
+        for i, kernel_row in taps:
+            source = window[i]
+            if source is None:
+                continue
+            row = buffered[source]
+            for j, w in kernel_row:
+                acc = [a + w*p for a, p in zip(acc, row[j:j+width])]
+        yield acc
+
+
+def stream_blurred(read_row, height, width, n):
+    '''
+    Row-at-a-time version of blurred, producing identical rows of ints
+
+    For odd n this is the running-sum engine of box_sum_rows over the rows
+    currently in the window, so each pixel costs the same for any n.
+    '''
+    if height*width == 0:
+        for _ in range(height):
+            yield []
+        return
+    if n % 2 == 1:
+        radius = n//2
+        area = n*n
+        x_indices = boundary_indices(width, radius, 'extend')
+        y_indices = boundary_indices(height, radius, 'extend')
+
+        #buffered rows hold their horizontal running sums
+        def prepare(row):
+            padded = [row[i] for i in x_indices]
+            total = sum(padded[:n])
+            sums = [total]
+            for x in range(1, width):
+                total += padded[x+n-1] - padded[x-1]
+                sums.append(total)
+            return sums
+
+        buffered = {}
+        acc = [0]*width
+        for y in range(height):
+            if y == 0:
+                for source in y_indices[:n]:
+                    if source not in buffered:
+                        buffered[source] = prepare(read_row(source))
+                    acc = [a + p for a, p in zip(acc, buffered[source])]
+            else:
+                entering = y_indices[y+n-1]
+                if entering not in buffered:
+                    buffered[entering] = prepare(read_row(entering))
+                acc = [a + e - l for a, e, l in zip(acc, buffered[entering], buffered[y_indices[y-1]])]
+                window = y_indices[y:y+n]
+                for source in list(buffered):
+                    if source not in window:
+                        del buffered[source]
+            yield [min(max(round_div(s, area), 0), 255) for s in acc]
+        return
+
+    kernel = {'dimension': n, 'list_vals': [1/(n*n)]*n*n}
+    for row in stream_correlate(read_row, height, width, kernel, 'extend'):
+        yield [min(max(round(c), 0), 255) for c in row]
+
+
+def stream_edges(read_row, height, width):
+    '''
+    Row-at-a-time version of edges, producing identical rows of ints
+
+    Both gradients come from one window of three rows (see
+    sobel_stream_rows), so every row of ints from read_row is read once.
+    '''
+    table = sobel_magnitude_table()
+    limit = len(table)
+    for gx, gy in sobel_stream_rows(read_row, height):
+        yield [table[m] if (m := i*i + j*j) < limit else 255 for i, j in zip(gx, gy)]
+
+
+def save_greyscale_rows(rows, width, height, filename):
+    """
+    Writes greyscale rows (ints in [0, 255]) to a binary PGM file as they are
+    produced, so the whole image never has to be in memory.  PGM is used
+    because PIL can only encode PNG files from a complete image.
+    """
+    with open(filename, 'wb') as out:
+        out.write(b'P5\n%d %d\n255\n' % (width, height))
+        for row in rows:
+            out.write(bytes(row))
+
 if __name__ == '__main__':
     # code in this block will only be run when you explicitly run your script,
     # and not when the tests are being run.  this is a good place for
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Deferred evaluation of the lab.py filters
+
+The functions here mirror the lab.py filters, but instead of computing
+anything they return a Node describing the computation:
+
+   preview = lazy.inverted(lazy.blurred(lazy.image(im), 5))
+
+Nothing runs until the pixels are needed (preview['pixels'],
+preview.evaluate(), or preview.save(...)).  Before running, the graph is
+optimized: runs of per-pixel operations are fused into a single pass, double
+inversions cancel, and rounding and clipping is dropped after filters whose
+output is already rounded and clipped.  A region can also be evaluated on its
+own, in which case every filter only computes the pixels that region depends
+on:
+
+   viewport = preview.evaluate((top, left, 480, 640))
+
+Color images (dictionaries of RGB tuples) are filtered one channel at a
+time, as with lab.color_filter_from_greyscale_filter.  CompactImages are
+converted to dictionaries when they enter a graph.
+"""
+
+import lab
+
+
+class Node:
+    '''
+    Represents a deferred image: either a source image, a chain of per-pixel
+    operations, or a filter, applied to the node it depends on
+    '''
+    def __init__(self, kind, height, width, color, input=None, value=None, ops=(),
+                 func=None, name=None, radius=None, boundary='extend', clipped=False):
+        self.kind = kind          # 'source', 'point', or 'filter'
+        self.height = height
+        self.width = width
+        self.color = color
+        self.input = input
+        self.value = value        # the computed image, once known
+        self.ops = list(ops)      # (name, function of one pixel value) pairs
+        self.func = func          # greyscale filter, for 'filter' nodes
+        self.name = name
+        self.radius = radius      # how far filter reads around each pixel (None: anywhere)
+        self.boundary = boundary  # how filter reads beyond the image edges
+        self.clipped = clipped    # filter output is already rounded and clipped
+
+    def __getitem__(self, key):
+        # lets code written for image dictionaries read nodes (computing them)
+        if key == 'height':
+            return self.height
+        if key == 'width':
+            return self.width
+        if key == 'pixels':
+            return self.evaluate()['pixels']
+        raise KeyError(key)
+
+    def __repr__(self):
+        if self.kind == 'source':
+            return 'image(%dx%d)' % (self.height, self.width)
+        if self.kind == 'point':
+            return 'point(%r, [%s])' % (self.input, ', '.join(name for name, _ in self.ops))
+        return '%s(%r)' % (self.name, self.input)
+
+    def optimized(self):
+        '''
+        An equivalent graph with point operations fused and no-ops removed
+        '''
+        if self.kind == 'source' or self.value is not None:
+            return self
+        source = self.input.optimized()
+        if self.kind == 'filter':
+            if source is self.input:
+                return self
+            return Node('filter', self.height, self.width, self.color, source, func=self.func,
+                        name=self.name, radius=self.radius, boundary=self.boundary,
+                        clipped=self.clipped)
+
+        ops = list(self.ops)
+        if source.kind == 'point':
+            ops = source.ops + ops
+            source = source.input
+        clipped = source.clipped or (source.kind == 'source' and is_clipped(source.value))
+        ops = simplified_ops(ops, clipped)
+        if not ops:
+            return source
+        return Node('point', self.height, self.width, self.color, source, ops=ops)
+
+    def evaluate(self, region=None):
+        '''
+        Compute the image, or only a region of it
+
+        Parameters:
+        * region (tuple): (top, left, height, width) of the part to compute;
+          the whole image by default
+
+        Returns:
+        An image dictionary (of the region's size); the whole image is
+        computed once and the same dictionary is returned every time
+        '''
+        whole = (0, 0, self.height, self.width)
+        if region is None or tuple(region) == whole:
+            if self.value is None:
+                self.value = self.optimized().compute(whole)
+            return self.value
+        lab.check_region(self, region)
+        return self.optimized().compute(tuple(region))
+
+    def compute(self, region):
+        # compute the region (top, left, height, width) of an optimized graph
+        top, left, height, width = region
+        whole = (top, left, height, width) == (0, 0, self.height, self.width)
+        if self.value is not None:
+            # a copy, so results never share pixel lists with the graph
+            return lab.cropped(self.value, region)
+
+        if self.kind == 'point':
+            return apply_ops(self.input.compute(region), self.ops, self.color)
+
+        filt = self.func
+        if self.color:
+            filt = lab.color_filter_from_greyscale_filter(filt)
+        if whole:
+            return filt(self.input.compute(region))
+        if self.radius is None:
+            return lab.cropped(filt(self.input.compute((0, 0, self.height, self.width))), region)
+
+        # filter a window of the input around region, filling its halo with
+        # the pixels the filter would have read there on the whole image
+        r = self.radius
+        rows = lab.boundary_indices(self.height, r, self.boundary)[top:top+height+2*r]
+        cols = lab.boundary_indices(self.width, r, self.boundary)[left:left+width+2*r]
+        inside_rows = [y for y in rows if y is not None]
+        inside_cols = [x for x in cols if x is not None]
+        y0, x0 = min(inside_rows), min(inside_cols)
+        source = self.input.compute((y0, x0, max(inside_rows)-y0+1, max(inside_cols)-x0+1))
+
+        window = lab.window_pixels(source['pixels'], source['width'], rows, cols,
+                                   (0, 0, 0) if self.color else 0, y0, x0)
+        result = filt({'height': height+2*r, 'width': width+2*r, 'pixels': window})
+        return lab.cropped(result, (r, r, height, width))
+
+    def save(self, filename, mode='PNG'):
+        '''
+        Compute the image and save it with lab.save_color_image or
+        lab.save_greyscale_image
+        '''
+        if self.color:
+            lab.save_color_image(self.evaluate(), filename, mode)
+        else:
+            lab.save_greyscale_image(self.evaluate(), filename, mode)
+
+
+def is_clipped(image):
+    pixels = image['pixels']
+    if isinstance(pixels, (bytes, bytearray)):
+        return True
+    if pixels and isinstance(pixels[0], tuple):
+        return all(isinstance(c, int) and 0 <= c <= 255 for p in pixels for c in p)
+    return all(isinstance(p, int) and 0 <= p <= 255 for p in pixels)
+
+
+def simplified_ops(ops, clipped):
+    '''
+    Remove operations that cancel or do nothing from a list of (name, op)
+    pairs applied to pixels that are already rounded and clipped if clipped
+    is True
+    '''
+    result = []
+    for name, op in ops:
+        if name == 'inverted' and result and result[-1][0] == 'inverted':
+            # 255-(255-c) == c for every value
+            result.pop()
+        elif name == 'round_and_clip_image' and clipped:
+            continue
+        else:
+            result.append((name, op))
+            if name == 'round_and_clip_image':
+                clipped = True
+            elif name != 'inverted':
+                # inversion keeps rounded, clipped values rounded and clipped
+                clipped = False
+    return result
+
+
+def apply_ops(image, ops, color):
+    # run a fused list of per-pixel operations as a single pass
+    # composing folds the ops' lookup tables into one (see lab.compose_point_ops)
+    fused = ops[0][1]
+    for _, op in ops[1:]:
+        fused = lab.compose_point_ops(fused, op)
+    if color:
+        return lab.color_filter_from_greyscale_filter(lambda channel: lab.apply_point_op(channel, fused))(image)
+    return lab.apply_point_op(image, fused)
+
+
+# BUILDING GRAPHS
+
+def image(img):
+    '''
+    Start a graph from an image (dict or CompactImage), or return it
+    unchanged if it is already a Node
+    '''
+    if isinstance(img, Node):
+        return img
+    if isinstance(img, lab.CompactImage):
+        img = img.to_dict()
+    pixels = img['pixels']
+    color = bool(pixels) and isinstance(pixels[0], tuple)
+    return Node('source', img['height'], img['width'], color, value=img)
+
+
+def point(img, name, op):
+    '''
+    Deferred per-pixel operation op, described by name
+    '''
+    img = image(img)
+    return Node('point', img.height, img.width, img.color, img, ops=[(name, op)])
+
+
+def apply(img, filt, radius=None, boundary='extend', name=None, clipped=False):
+    '''
+    Deferred greyscale filter filt (applied per channel to color images)
+
+    Parameters:
+    * radius (int): if every output pixel depends only on input pixels at
+      most radius rows and columns away, regions are computed from a window
+      of the input; otherwise the whole input is computed
+    * boundary (str): how filt reads pixels beyond the image edges
+    * name (str): shown when printing the graph
+    * clipped (bool): whether filt always returns rounded, clipped pixels
+    '''
+    img = image(img)
+    return Node('filter', img.height, img.width, img.color, img, func=filt,
+                name=name or lab.describe_filter(filt), radius=radius, boundary=boundary,
+                clipped=clipped)
+
+
+def inverted(img):
+    return point(img, 'inverted', lab.inverted.point_op)
+
+
+def round_and_clip_image(img):
+    return point(img, 'round_and_clip_image', lab.round_and_clip_image.point_op)
+
+
+def correlate(img, kernel, boundary_behavior):
+    if boundary_behavior not in ('zero', 'extend', 'wrap'):
+        return None
+    return apply(img, lambda image: lab.correlate(image, kernel, boundary_behavior),
+                 (kernel['dimension']-1)//2, boundary_behavior,
+                 'correlate(%d, %s)' % (kernel['dimension'], boundary_behavior))
+
+
+def blurred(img, n):
+    return apply(img, lambda image: lab.blurred(image, n), (n-1)//2, 'extend', 'blurred(%d)' % n, True)
+
+
+def sharpened(img, n):
+    return apply(img, lambda image: lab.sharpened(image, n), (n-1)//2, 'extend', 'sharpened(%d)' % n, True)
+
+
+def edges(img, norm='l2'):
+    return apply(img, lambda image: lab.edges(image, norm=norm), 1, 'extend', 'edges', True)
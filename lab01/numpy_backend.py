@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+NumPy implementations of the lab.py filters
+
+Enable with:
+   import lab, numpy_backend
+   lab.set_backend(numpy_backend)
+
+Every function takes and returns the same image dictionaries as the
+reference code in lab.py (pixels may also be a bytearray or a numpy array)
+and produces identical rounded and clipped output.  Out-of-bounds pixels are
+handled by padding the whole image once instead of calling
+advanced_get_pixel for every kernel tap.
+"""
+
+import numpy as np
+
+import lab
+
+PAD_MODES = {'zero': 'constant', 'extend': 'edge', 'wrap': 'wrap'}
+
+
+def to_array(image, dtype=None):
+    '''
+    View the pixels of a greyscale image as a (height, width) array
+    '''
+    pixels = image['pixels']
+    if isinstance(pixels, (bytes, bytearray)):
+        pixels = np.frombuffer(pixels, dtype=np.uint8)
+    array = np.asarray(pixels, dtype=dtype)
+    return array.reshape(image['height'], image['width'])
+
+
+def from_array(array):
+    '''
+    Convert a (height, width) array back to an image dictionary
+    '''
+    height, width = array.shape
+    return {'height': height, 'width': width, 'pixels': array.ravel().tolist()}
+
+
+def is_integer_image(image):
+    pixels = image['pixels']
+    if isinstance(pixels, (bytes, bytearray)):
+        return True
+    if isinstance(pixels, np.ndarray):
+        return np.issubdtype(pixels.dtype, np.integer)
+    return all(isinstance(p, int) for p in pixels)
+
+
+def correlate_array(source, kernel, boundary_behavior):
+    '''
+    Correlate a (height, width) array with an odd-sized kernel by adding one
+    shifted copy of the padded array per nonzero kernel tap, in the same order
+    as lab.correlate_direct
+    '''
+    n = kernel['dimension']
+    height, width = source.shape
+    padded = np.pad(source, n//2, mode=PAD_MODES[boundary_behavior])
+    result = np.zeros((height, width), dtype=source.dtype)
+    for index, weight in enumerate(kernel['list_vals']):
+        if weight == 0:
+            continue
+        i, j = divmod(index, n)
+        result += weight*padded[i:i+height, j:j+width]
+    return result
+
+
+def correlate_fft_array(source, kernel, boundary_behavior):
+    '''
+    Correlate a (height, width) array with an odd-sized kernel through real
+    ffts of the padded array and the flipped kernel
+    '''
+    n = kernel['dimension']
+    height, width = source.shape
+    padded = np.pad(source, n//2, mode=PAD_MODES[boundary_behavior]).astype(np.float64)
+    flipped = np.asarray(kernel['list_vals'], dtype=np.float64).reshape(n, n)[::-1, ::-1]
+    shape = (padded.shape[0]+n-1, padded.shape[1]+n-1)
+    full = np.fft.irfft2(np.fft.rfft2(padded, shape)*np.fft.rfft2(flipped, shape), shape)
+    return full[n-1:n-1+height, n-1:n-1+width]
+
+
+# seconds per tap per pixel for correlate_array, and per point per log2(points)
+# for one pass of the transforms in correlate_fft_array
+TAP_SECONDS = 2e-9
+FFT_POINT_SECONDS = 7e-10
+
+
+def correlate(image, kernel, boundary_behavior, method='auto'):
+    if boundary_behavior not in PAD_MODES:
+        return None
+    if kernel['dimension'] % 2 == 0:
+        #even kernels have no center; keep the reference semantics for them
+        return lab.correlate_direct(image, kernel, boundary_behavior)
+    if method == 'auto':
+        method = lab.choose_correlate_method(image, kernel, None, TAP_SECONDS, FFT_POINT_SECONDS)
+
+    # integer images and kernels are summed exactly
+    integer_image = is_integer_image(image)
+    integer = integer_image and all(isinstance(v, int) for v in kernel['list_vals'])
+    source = to_array(image, np.int64 if integer else np.float64)
+    if method != 'fft':
+        return from_array(correlate_array(source, kernel, boundary_behavior))
+
+    result = correlate_fft_array(source, kernel, boundary_behavior)
+    step = lab.fft_snap_step(kernel['list_vals']) if integer_image else None
+    if step == 1:
+        result = np.rint(result).astype(np.int64)
+    elif step is not None:
+        result = np.rint(result*step)/step
+    return from_array(result)
+
+
+def round_and_clip_array(array):
+    # np.rint rounds halves to even, exactly like python's round
+    return np.clip(np.rint(array), 0, 255).astype(np.int64)
+
+
+def round_and_clip_image(image):
+    return from_array(round_and_clip_array(to_array(image, np.float64)))
+
+
+def inverted(image):
+    # float pixels stay floats, as in lab.inverted
+    return from_array(255 - to_array(image, np.int64 if is_integer_image(image) else np.float64))
+
+
+def box_blur_array(image, n):
+    '''
+    Round and clip the n-by-n box blur of an integer image (with the 'extend'
+    behavior) using exact integer window sums from a summed-area table
+    '''
+    padded = np.pad(to_array(image, np.int64), n//2, mode='edge')
+    table = np.zeros((padded.shape[0]+1, padded.shape[1]+1), dtype=np.int64)
+    table[1:, 1:] = padded.cumsum(0).cumsum(1)
+    sums = table[n:, n:] - table[:-n, n:] - table[n:, :-n] + table[:-n, :-n]
+    return np.clip(round_div_array(sums, n*n), 0, 255)
+
+
+def round_div_array(numerators, denominator):
+    '''
+    Integer version of lab.round_div for int64 arrays
+    '''
+    quotients, remainders = np.divmod(numerators, denominator)
+    up = (2*remainders > denominator) | ((2*remainders == denominator) & (quotients % 2 == 1))
+    return quotients + up
+
+
+def blurred(image, n):
+    if n % 2 == 0 or not is_integer_image(image):
+        kernel = {'dimension': n, 'list_vals': [1/(n*n)]*n*n}
+        return round_and_clip_image(correlate(image, kernel, 'extend'))
+    return from_array(box_blur_array(image, n))
+
+
+def sharpened(image, n):
+    # like lab.sharpened, subtract the rounded blur
+    if n % 2 == 1 and is_integer_image(image):
+        return from_array(np.clip(2*to_array(image, np.int64) - box_blur_array(image, n), 0, 255))
+    blur = to_array(blurred(image, n), np.int64)
+    return from_array(round_and_clip_array(2*to_array(image, np.float64) - blur))
+
+
+def edges(image, norm='l2'):
+    kx = {'dimension': 3, 'list_vals': [-1, 0, 1, -2, 0, 2, -1, 0, 1]}
+    ky = {'dimension': 3, 'list_vals': [-1, -2, -1, 0, 0, 0, 1, 2, 1]}
+    source = to_array(image, np.float64)
+    o_x = correlate_array(source, kx, 'extend')
+    o_y = correlate_array(source, ky, 'extend')
+    if norm == 'l1':
+        return from_array(round_and_clip_array(np.abs(o_x) + np.abs(o_y)))
+    return from_array(round_and_clip_array(np.sqrt(o_x**2 + o_y**2)))
+
+
+def filter_brightness(image, n):
+    pixels = np.asarray(image['pixels'])
+    return {
+        'height': image['height'],
+        'width': image['width'],
+        'pixels': [tuple(p) for p in np.clip(pixels + n, 0, 255).tolist()],
+    }
+
+
+def rgb_to_greyscale(r, g, b):
+    # same operation order as lab.rgb_to_greyscale, so the doubles match
+    r, g, b = [np.frombuffer(plane, dtype=np.uint8).astype(np.float64) for plane in (r, g, b)]
+    return bytearray(np.rint(.299*r + .587*g + .114*b).astype(np.uint8).tobytes())
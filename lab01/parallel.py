@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Multi-process versions of the lab.py filters for large images
+
+The image is split into horizontal bands, and each band is filtered in a
+separate process together with a halo of `radius` rows above and below it.
+Pixels reach the workers through shared memory instead of pickled lists, and
+each worker writes its rows straight into a shared output buffer.
+
+The three channels of a color image can also be filtered concurrently, each
+worker reading its plane straight out of shared memory.
+
+Invoked as, for example:
+   result = correlate_tiled(image, kernel, 'wrap', workers=8)
+   result = filter_tiled(image, 'blurred', (9,), radius=4, workers=8)
+   color_blur = color_filter_parallel(functools.partial(lab.blurred, n=9))
+"""
+
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import lab
+
+# images smaller than this are filtered serially; the pool costs more
+MIN_PARALLEL_PIXELS = 250000
+MIN_CHANNEL_PIXELS = 40000
+
+
+def pixel_format(pixels):
+    '''
+    Pick the array type code that stores every pixel exactly
+    '''
+    if isinstance(pixels, (bytes, bytearray)):
+        return 'B'
+    if all(isinstance(p, int) for p in pixels):
+        if all(0 <= p <= 255 for p in pixels):
+            return 'B'
+        return 'q'
+    return 'd'
+
+
+def write_pixels(shm, offset, pixels):
+    '''
+    Write pixels into a shared buffer of 8-byte slots, starting at slot offset
+
+    Returns:
+    The type code ('q' or 'd') the pixels were written with
+    '''
+    code = 'q' if all(isinstance(p, int) for p in pixels) else 'd'
+    out = shm.buf.cast(code)
+    out[offset:offset+len(pixels)] = array(code, pixels)
+    out.release()
+    return code
+
+
+def read_pixels(shm, offset, count, code):
+    view = shm.buf.cast(code)
+    pixels = view[offset:offset+count].tolist()
+    view.release()
+    return pixels
+
+
+def filter_band(input_name, input_format, output_name, height, width, y0, y1,
+                filter_name, args, radius, boundary_behavior):
+    '''
+    Worker: filter rows y0 to y1 of the shared image (plus a halo of radius
+    rows read according to boundary_behavior) and write them into the shared
+    output buffer
+
+    Returns:
+    The type code ('q' or 'd') the rows were written with
+    '''
+    shm_in = shared_memory.SharedMemory(name=input_name)
+    shm_out = shared_memory.SharedMemory(name=output_name)
+    try:
+        pixels = shm_in.buf.cast(input_format)
+        band = []
+        zeros = [0]*width
+        for y in lab.boundary_indices(height, radius, boundary_behavior)[y0:y1+2*radius]:
+            band.extend(zeros if y is None else pixels[y*width:(y+1)*width].tolist())
+        del pixels
+
+        band_image = {'height': y1-y0+2*radius, 'width': width, 'pixels': band}
+        #a band may pick another correlate method than the whole image would,
+        #so pin the one whose values do not depend on the image size
+        kwargs = {'method': 'direct'} if filter_name == 'correlate' else {}
+        result = getattr(lab, filter_name)(band_image, *args, **kwargs)['pixels']
+        rows = result[radius*width:(radius+y1-y0)*width]
+
+        return write_pixels(shm_out, y0*width, rows)
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+
+def filter_tiled(image, filter_name, args, radius, boundary_behavior='extend',
+                 workers=None, min_pixels=MIN_PARALLEL_PIXELS):
+    '''
+    Run lab.<filter_name>(image, *args) on horizontal bands in parallel
+
+    The filter must compute each output pixel from the pixels within radius
+    rows of it, reading out-of-bounds rows according to boundary_behavior
+    (correlate, blurred, sharpened, and edges all qualify).  The result is
+    identical to calling the filter on the whole image.
+
+    Parameters:
+    * image (dict): greyscale image
+    * filter_name (str): name of a greyscale filter in lab.py
+    * args (tuple): extra positional arguments for the filter
+    * radius (int): how many rows above and below each band the filter reads
+    * boundary_behavior (str): how the filter treats out-of-bounds pixels
+    * workers (int): number of processes (defaults to the number of CPUs)
+    * min_pixels (int): smaller images are filtered in this process
+
+    Returns:
+    A new image dictionary
+    '''
+    filt = getattr(lab, filter_name)
+    height = image['height']
+    width = image['width']
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or height*width < min_pixels or height < 2:
+        return filt(image, *args)
+
+    pixels = image['pixels']
+    input_format = pixel_format(pixels)
+    itemsize = array(input_format).itemsize
+    shm_in = shared_memory.SharedMemory(create=True, size=max(1, height*width*itemsize))
+    shm_out = shared_memory.SharedMemory(create=True, size=max(1, height*width*8))
+    try:
+        view = shm_in.buf.cast(input_format)
+        view[:height*width] = array(input_format, pixels)
+        del view
+
+        count = min(workers, height)
+        cuts = [height*i//count for i in range(count+1)]
+        bands = list(zip(cuts, cuts[1:]))
+        with ProcessPoolExecutor(max_workers=count) as pool:
+            futures = [pool.submit(filter_band, shm_in.name, input_format, shm_out.name,
+                                   height, width, y0, y1, filter_name, args, radius,
+                                   boundary_behavior)
+                       for y0, y1 in bands]
+            codes = [future.result() for future in futures]
+
+        result = []
+        for (y0, y1), code in zip(bands, codes):
+            result.extend(read_pixels(shm_out, y0*width, (y1-y0)*width, code))
+        return {'height': height, 'width': width, 'pixels': result}
+    finally:
+        shm_in.close()
+        shm_in.unlink()
+        shm_out.close()
+        shm_out.unlink()
+
+
+def correlate_tiled(image, kernel, boundary_behavior, workers=None,
+                    min_pixels=MIN_PARALLEL_PIXELS):
+    '''
+    Parallel lab.correlate, byte-identical to the serial result
+    '''
+    if boundary_behavior not in ('zero', 'extend', 'wrap'):
+        return None
+    radius = (kernel['dimension']-1)//2
+    return filter_tiled(image, 'correlate', (kernel, boundary_behavior), radius,
+                        boundary_behavior, workers, min_pixels)
+
+
+def filter_plane(input_name, output_name, index, height, width, filt):
+    '''
+    Worker: apply a greyscale filter to plane index of the shared 8-bit planes
+    without copying it, and write the result into slot range index of the
+    shared output buffer
+
+    Returns:
+    The type code the result was written with
+    '''
+    shm_in = shared_memory.SharedMemory(name=input_name)
+    shm_out = shared_memory.SharedMemory(name=output_name)
+    try:
+        size = height*width
+        plane = shm_in.buf[index*size:(index+1)*size]
+        result = filt({'height': height, 'width': width, 'pixels': plane})
+        pixels = result['pixels']
+        if isinstance(pixels, memoryview):
+            pixels = pixels.tolist()
+        plane.release()
+        if (result['height'], result['width']) != (height, width):
+            raise ValueError('channel filters must keep the image size')
+        return write_pixels(shm_out, index*size, pixels)
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+
+def color_filter_parallel(filt, executor=None, min_pixels=MIN_CHANNEL_PIXELS):
+    '''
+    Like lab.color_filter_from_greyscale_filter, but filters the red, green,
+    and blue channels concurrently in separate processes
+
+    The planes are copied once into shared memory and each worker reads its
+    plane in place.  Images smaller than min_pixels are filtered serially.
+
+    Parameters:
+    * filt: picklable greyscale filter, such as lab.edges or
+      functools.partial(lab.blurred, n=9) (closures from make_blur_filter
+      cannot be sent to other processes)
+    * executor (ProcessPoolExecutor): pool to reuse across calls; a pool of
+      three processes is created per call otherwise
+    * min_pixels (int): smaller images skip the pool
+
+    Returns:
+    A filter on color images (dictionaries or CompactImages)
+    '''
+    serial = lab.color_filter_from_greyscale_filter(filt)
+
+    def new_filt(image):
+        height = image['height']
+        width = image['width']
+        size = height*width
+        if size < min_pixels:
+            return serial(image)
+
+        shm_in = shared_memory.SharedMemory(create=True, size=3*size)
+        shm_out = shared_memory.SharedMemory(create=True, size=3*size*8)
+        try:
+            for index, channel in enumerate(lab.color_split(image)):
+                shm_in.buf[index*size:(index+1)*size] = bytes(channel['pixels'])
+
+            pool = executor or ProcessPoolExecutor(max_workers=3)
+            try:
+                futures = [pool.submit(filter_plane, shm_in.name, shm_out.name, index,
+                                       height, width, filt)
+                           for index in range(3)]
+                codes = [future.result() for future in futures]
+            finally:
+                if executor is None:
+                    pool.shutdown()
+
+            channels = [{'height': height, 'width': width,
+                         'pixels': read_pixels(shm_out, index*size, size, code)}
+                        for index, code in enumerate(codes)]
+        finally:
+            shm_in.close()
+            shm_in.unlink()
+            shm_out.close()
+            shm_out.unlink()
+
+        if isinstance(image, lab.CompactImage):
+            return lab.CompactImage.from_channels(channels)
+        return lab.color_combine(image, *channels)
+    return new_filt
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Opt-in timing and memory instrumentation for the lab.py filters
+
+While a Profiler is active, every filter_cascade call, every stage inside
+it, and every channel filtered by a color filter (from
+color_filter_from_greyscale_filter, or inside a cascade) is recorded with its
+wall time, pixels per second, and, if asked for, the peak memory allocated
+while it ran.  Records are nested: a record's path names the enclosing
+cascade, stage, and channel.
+
+Invoked as, for example:
+   with profile() as p:
+       lab.filter_cascade([color_edges, color_blur])(image)
+   print(p.report())
+
+   with profile(callback=lambda record: log.info('%(path)s %(seconds).3f', record), memory=True):
+       ...
+
+Peak memory comes from tracemalloc, which slows filtering down noticeably,
+so it is off by default.  Records from several threads are kept apart, but
+peak memory is measured process-wide.
+"""
+
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+import lab
+
+
+class Profiler:
+    '''
+    Represents a collection of timing records for filter invocations
+    '''
+    def __init__(self, callback=None, memory=False):
+        self.callback = callback
+        self.memory = memory
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stack(self):
+        # the labels (and memory bookkeeping) of the measurements in progress
+        # on this thread
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def measure(self, label, func, image):
+        '''
+        Run func(image), recording its time under label
+
+        Returns:
+        func(image)
+        '''
+        stack = self.stack()
+        memory = self.memory and tracemalloc.is_tracing()
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # remember the enclosing measurement's peak before resetting
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        stack.append({'label': label, 'start': current, 'peak': current})
+
+        start = time.perf_counter()
+        try:
+            result = func(image)
+        finally:
+            seconds = time.perf_counter() - start
+            path = ' > '.join(entry['label'] for entry in stack)
+            entry = stack.pop()
+
+        pixels = image['height']*image['width']
+        record = {
+            'label': label,
+            'path': path,
+            'depth': len(stack),
+            'seconds': seconds,
+            'pixels': pixels,
+            'pixels_per_second': pixels/seconds if seconds else float('inf'),
+        }
+        if memory:
+            peak = max(entry['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_bytes'] = peak - entry['start']
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        with self.lock:
+            self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+        return result
+
+    def wrap(self, filt, label=None):
+        '''
+        Profiled version of a filter function, which may take extra arguments
+        after the image (for example wrap(lab.blurred)(image, 5))
+        '''
+        label = label or lab.describe_filter(filt)
+
+        def profiled_filt(image, *args, **kwargs):
+            return self.measure(label, lambda image: filt(image, *args, **kwargs), image)
+        return profiled_filt
+
+    def summary(self):
+        '''
+        Total the records by path
+
+        Returns:
+        A list of dictionaries with the path, number of calls, total and mean
+        seconds, pixels per second, and largest peak_bytes (if measured),
+        slowest first
+        '''
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['path'], {
+                'path': record['path'], 'depth': record['depth'],
+                'calls': 0, 'seconds': 0.0, 'pixels': 0,
+            })
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            total['pixels'] += record['pixels']
+            if 'peak_bytes' in record:
+                total['peak_bytes'] = max(total.get('peak_bytes', 0), record['peak_bytes'])
+        for total in totals.values():
+            total['mean_seconds'] = total['seconds']/total['calls']
+            total['pixels_per_second'] = total['pixels']/total['seconds'] if total['seconds'] else float('inf')
+        return sorted(totals.values(), key=lambda total: -total['seconds'])
+
+    def report(self):
+        '''
+        Format summary() as a table, slowest path first
+        '''
+        lines = ['%8s %6s %10s %10s  %s' % ('seconds', 'calls', 'Mpx/s', 'peak KiB', 'path')]
+        for total in self.summary():
+            peak = '%10.0f' % (total['peak_bytes']/1024) if 'peak_bytes' in total else '%10s' % '-'
+            lines.append('%8.3f %6d %10.2f %s  %s' % (total['seconds'], total['calls'],
+                                                       total['pixels_per_second']/1e6, peak, total['path']))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profile(callback=None, memory=False):
+    '''
+    Profile the lab.py filters run inside the with block
+
+    Parameters:
+    * callback: function called with each record as it is made
+    * memory (bool): also measure peak allocation with tracemalloc
+
+    Returns:
+    A context manager giving the active Profiler
+    '''
+    profiler = Profiler(callback, memory)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    previous = lab.set_profiler(profiler)
+    try:
+        yield profiler
+    finally:
+        lab.set_profiler(previous)
+        if started:
+            tracemalloc.stop()
@@ -397,6 +397,1155 @@ def test_cascades(cascade, image):
     compare_color_images(result, expected)
 
 
+SEPARABLE_KERNELS = {
+    'box': {'dimension': 5, 'list_vals': [1/25]*25},
+    'sobel_x': {'dimension': 3, 'list_vals': [-1, 0, 1, -2, 0, 2, -1, 0, 1]},
+    'sobel_y': {'dimension': 3, 'list_vals': [-1, -2, -1, 0, 0, 0, 1, 2, 1]},
+    'binomial': {'dimension': 5, 'list_vals': [a*b/256 for a in [1, 4, 6, 4, 1] for b in [1, 4, 6, 4, 1]]},
+    'shifted': {'dimension': 13, 'list_vals': [0]*26 + [1] + [0]*142},
+}
+
+
+def test_separate_kernel():
+    for kernel in SEPARABLE_KERNELS.values():
+        col_vals, row_vals = lab.separate_kernel(kernel)
+        assert [c*r for c in col_vals for r in row_vals] == kernel['list_vals']
+    assert lab.separate_kernel({'dimension': 3, 'list_vals': [1, 2, 3, 4, 5, 6, 7, 8, 10]}) is None
+    assert lab.separate_kernel({'dimension': 2, 'list_vals': [1, 1, 1, 1]}) is None
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'extend', 'wrap'])
+@pytest.mark.parametrize("kernel_name", sorted(SEPARABLE_KERNELS))
+def test_correlate_separable_matches_direct(kernel_name, boundary):
+    kernel = SEPARABLE_KERNELS[kernel_name]
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    oim = object_hash(im)
+    result = lab.correlate(im, kernel, boundary)
+    expected = lab.correlate_direct(im, kernel, boundary)
+    assert object_hash(im) == oim, 'Be careful not to modify the original image!'
+    assert result == expected
+
+
+def test_correlate_inexact_separable_kernel():
+    # two passes of 0.1 weights round differently than one, so these go direct
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    for kernel in [{'dimension': 3, 'list_vals': [0.1]*9}, {'dimension': 3, 'list_vals': [1/9]*9}]:
+        assert lab.separate_kernel(kernel) is not None and lab.exact_factors(lab.separate_kernel(kernel)) is None
+        for boundary in ['zero', 'extend', 'wrap']:
+            assert lab.correlate(im, kernel, boundary) == lab.correlate_direct(im, kernel, boundary)
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'extend', 'wrap'])
+@pytest.mark.parametrize("kernsize", [1, 3, 9, 51])
+def test_box_sum_matches_correlate(kernsize, boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    oim = object_hash(im)
+    result = lab.box_sum(im, kernsize, boundary)
+    expected = lab.correlate(im, {'dimension': kernsize, 'list_vals': [1]*kernsize*kernsize}, boundary)
+    assert object_hash(im) == oim, 'Be careful not to modify the original image!'
+    compare_greyscale_images(result, expected)
+
+
+@pytest.mark.parametrize("kernsize", [3, 11, 51])
+def test_blurred_large_kernels(kernsize):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallmushroom.png'))
+    kernel = {'dimension': kernsize, 'list_vals': [1/(kernsize*kernsize)]*kernsize*kernsize}
+    expected = lab.round_and_clip_image(lab.correlate_direct(im, kernel, 'extend'))
+    compare_greyscale_images(lab.blurred(im, kernsize), expected)
+
+
+
+@pytest.mark.parametrize("size", [(0, 4), (4, 0), (0, 0)])
+def test_blurred_empty_images(size):
+    height, width = size
+    im = {'height': height, 'width': width, 'pixels': []}
+    for result in [lab.blurred(im, 3), lab.blurred(im, 4), lab.sharpened(im, 3)]:
+        assert result == {'height': height, 'width': width, 'pixels': []}
+
+@pytest.mark.parametrize("fname", ['smallfrog', 'smallmushroom', 'pattern', 'centered_pixel'])
+def test_compact_image_load(fname):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', f'{fname}.png')
+    color = lab.load_compact_image(inpfile)
+    grey = lab.load_compact_image(inpfile, color=False)
+    assert color.is_color() and not grey.is_color()
+    assert all(isinstance(plane, bytearray) for plane in color.planes + grey.planes)
+    compare_color_images(color.to_dict(), lab.load_color_image(inpfile))
+    compare_greyscale_images(grey.to_dict(), lab.load_greyscale_image(inpfile))
+    compare_color_images(lab.CompactImage.from_dict(color.to_dict()).to_dict(), color.to_dict())
+
+
+def test_compact_image_filters():
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png')
+    im = lab.load_color_image(inpfile)
+    compact = lab.load_compact_image(inpfile)
+    grey = lab.load_greyscale_image(inpfile)
+    compact_grey = lab.load_compact_image(inpfile, color=False)
+    filters = [
+        lab.inverted,
+        lab.edges,
+        lab.make_blur_filter(5),
+        lab.make_sharpen_filter(3),
+    ]
+    for filt in filters:
+        color_filt = lab.color_filter_from_greyscale_filter(filt)
+        result = color_filt(compact)
+        assert isinstance(result, lab.CompactImage)
+        compare_color_images(result.to_dict(), color_filt(im))
+        compare_greyscale_images(filt(compact_grey).to_dict(), filt(grey))
+    cascade = lab.filter_cascade([lab.color_filter_from_greyscale_filter(f) for f in filters])
+    compare_color_images(cascade(compact).to_dict(), cascade(im))
+    compare_greyscale_images(lab.correlate(compact_grey, SEPARABLE_KERNELS['box'], 'wrap'),
+                             lab.correlate(grey, SEPARABLE_KERNELS['box'], 'wrap'))
+
+
+@pytest.mark.parametrize("fname", sorted(f[:-4] for f in os.listdir(os.path.join(TEST_DIRECTORY, 'test_images')) if f.endswith('.png')))
+def test_numpy_backend_parity(fname):
+    pytest.importorskip('numpy')
+    import numpy_backend
+
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', f'{fname}.png')
+    grey = lab.load_greyscale_image(inpfile)
+    color = lab.load_color_image(inpfile)
+    kernel = {'dimension': 3, 'list_vals': [0.5, 2, -1, 4, 0.25, 6, 7, -8, 1]}
+
+    def run_filters():
+        results = [lab.inverted(grey), lab.edges(grey), lab.blurred(grey, 5), lab.sharpened(grey, 3),
+                   lab.filter_brightness(color, 20)]
+        for boundary in ['zero', 'extend', 'wrap']:
+            results.append(lab.round_and_clip_image(lab.correlate(grey, SEPARABLE_KERNELS['box'], boundary)))
+        if grey['height']*grey['width'] < 5000:
+            for boundary in ['zero', 'extend', 'wrap']:
+                results.append(lab.correlate(grey, kernel, boundary))
+        return results
+
+    expected = run_filters()
+    previous = lab.set_backend(numpy_backend)
+    try:
+        result = run_filters()
+    finally:
+        lab.set_backend(previous)
+    assert result == expected
+
+
+def test_numpy_backend_float_pixels():
+    pytest.importorskip('numpy')
+    import numpy_backend
+
+    im = {'height': 2, 'width': 3, 'pixels': [0.5, 10.7, -3.2, 255, 300.25, 128]}
+    expected = [lab.inverted(im), lab.round_and_clip_image(im)]
+    previous = lab.set_backend(numpy_backend)
+    try:
+        result = [lab.inverted(im), lab.round_and_clip_image(im)]
+    finally:
+        lab.set_backend(previous)
+    assert result == expected
+    assert result[0]['pixels'][:3] == [254.5, 255-10.7, 258.2]
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'extend', 'wrap'])
+@pytest.mark.parametrize("kernsize", [3, 5, 9])
+def test_correlate_direct_matches_get_pixel(kernsize, boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallmushroom.png'))
+    # dyadic weights are exact; tenths and the box weights round, so they
+    # also check the order in which the taps are added
+    for vals in [[((i*7) % 11 - 5)/4 for i in range(kernsize*kernsize)],
+                 [((i*7) % 11 - 5)/10 for i in range(kernsize*kernsize)],
+                 [1/(kernsize*kernsize)]*kernsize*kernsize]:
+        result = lab.correlate_direct(im, {'dimension': kernsize, 'list_vals': vals}, boundary)
+        radius = kernsize//2
+        expected = []
+        for y in range(im['height']):
+            for x in range(im['width']):
+                pixel_val = 0
+                for k, weight in enumerate(vals):
+                    i, j = divmod(k, kernsize)
+                    pixel_val += lab.advanced_get_pixel(im, x+j-radius, y+i-radius, boundary)*weight
+                expected.append(pixel_val)
+        assert result['pixels'] == expected
+
+
+def test_boundary_table_cache(monkeypatch):
+    monkeypatch.setattr(lab, 'boundary_table_cache', {})
+    monkeypatch.setattr(lab, 'BOUNDARY_TABLE_CACHE_SIZE', 2)
+    first = lab.boundary_table(10, 8, 3, 'wrap')
+    lab.boundary_table(10, 8, 5, 'wrap')
+    assert lab.boundary_table(10, 8, 3, 'wrap') is first
+    lab.boundary_table(4, 4, 3, 'zero')
+    assert list(lab.boundary_table_cache) == [(10, 8, 3, 'wrap'), (4, 4, 3, 'zero')]
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'extend', 'wrap'])
+def test_correlate_tiled(boundary):
+    import parallel
+
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    for kernel in [SEPARABLE_KERNELS['box'], SEPARABLE_KERNELS['sobel_x'], SEPARABLE_KERNELS['shifted'],
+                   {'dimension': 3, 'list_vals': [0.5, 2, -1, 4, 0.25, 6, 7, -8, 1]}]:
+        result = parallel.correlate_tiled(im, kernel, boundary, workers=3, min_pixels=0)
+        assert object_hash(result) == object_hash(lab.correlate(im, kernel, boundary))
+
+
+def test_correlate_tiled_large_float_kernel():
+    import parallel
+
+    im = {'height': 64, 'width': 64, 'pixels': [(x*7 + y*13 + (x*y) % 17) % 256 for y in range(64) for x in range(64)]}
+    kernel = {'dimension': 31, 'list_vals': [((i*7) % 11 - 5)/3 for i in range(961)]}
+    result = parallel.correlate_tiled(im, kernel, 'wrap', workers=3, min_pixels=0)
+    assert result == lab.correlate(im, kernel, 'wrap')
+
+
+def test_filter_tiled():
+    import parallel
+
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallmushroom.png'))
+    result = parallel.filter_tiled(im, 'blurred', (7,), 3, workers=4, min_pixels=0)
+    assert object_hash(result) == object_hash(lab.blurred(im, 7))
+    result = parallel.filter_tiled(im, 'edges', (), 1, workers=4, min_pixels=0)
+    assert object_hash(result) == object_hash(lab.edges(im))
+
+
+def test_cascade_plan():
+    color_edges = lab.color_filter_from_greyscale_filter(lab.edges)
+    color_blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(5))
+    stages = lab.plan_cascade([color_edges, color_edges, color_blur, color_edges])
+    assert [kind for kind, _ in stages] == ['channels']
+    assert [kind for kind, _ in stages[0][1]] == ['image']*4
+
+    swap = lambda im: im
+    stages = lab.plan_cascade([lab.color_filter_from_greyscale_filter(lab.inverted),
+                               lab.color_filter_from_greyscale_filter(lab.make_brightness_filter(-40)),
+                               lab.color_filter_from_greyscale_filter(lab.round_and_clip_image),
+                               swap, lab.inverted, lab.inverted])
+    assert [kind for kind, _ in stages] == ['channels', 'image', 'point']
+    assert [kind for kind, _ in stages[0][1]] == ['point']
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_fused_cascade_matches_sequential(compact):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png')
+    im = lab.load_compact_image(inpfile) if compact else lab.load_color_image(inpfile)
+    color = lab.color_filter_from_greyscale_filter
+    filters = [color(lab.edges), color(lab.edges), color(lab.make_blur_filter(5)), color(lab.edges),
+               color(lab.inverted), color(lab.make_brightness_filter(-70)), color(lab.round_and_clip_image),
+               color(lab.make_sharpen_filter(3))]
+    expected = im
+    for filt in filters:
+        expected = filt(expected)
+    result = lab.filter_cascade(filters)(im)
+    if compact:
+        result, expected = result.to_dict(), expected.to_dict()
+    compare_color_images(result, expected)
+
+    grey = lab.load_greyscale_image(inpfile)
+    cascade = lab.filter_cascade([lab.inverted, lab.make_brightness_filter(30), lab.round_and_clip_image, lab.edges])
+    compare_greyscale_images(cascade(grey), lab.edges(lab.round_and_clip_image(
+        {'height': grey['height'], 'width': grey['width'], 'pixels': [255-p+30 for p in grey['pixels']]})))
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'extend', 'wrap'])
+def test_stream_correlate(boundary):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png')
+    im = lab.load_greyscale_image(inpfile)
+    with lab.RowReader(inpfile) as reader:
+        reads = []
+        def read_row(y):
+            reads.append(y)
+            return reader.read_row(y)
+        for kernel in [SEPARABLE_KERNELS['box'], SEPARABLE_KERNELS['sobel_y'],
+                       {'dimension': 3, 'list_vals': [0.5, 2, -1, 4, 0.25, 6, 7, -8, 1]}]:
+            reads.clear()
+            rows = list(lab.stream_correlate(read_row, reader.height, reader.width, kernel, boundary))
+            assert [p for row in rows for p in row] == lab.correlate(im, kernel, boundary)['pixels']
+            # only the last kernel rows are kept, so rows are read (nearly) once
+            assert len(reads) <= reader.height + 2*kernel['dimension']
+
+
+def test_stream_filters_to_file(tmp_path):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'smallmushroom.png')
+    im = lab.load_greyscale_image(inpfile)
+    with lab.RowReader(inpfile) as reader:
+        outfile = str(tmp_path / 'edges.pgm')
+        lab.save_greyscale_rows(lab.stream_edges(reader.read_row, reader.height, reader.width),
+                                reader.width, reader.height, outfile)
+        compare_greyscale_images(lab.load_greyscale_image(outfile), lab.edges(im))
+        rows = lab.stream_blurred(reader.read_row, reader.height, reader.width, 5)
+        assert [p for row in rows for p in row] == lab.blurred(im, 5)['pixels']
+
+        reads = []
+        def read_row(y):
+            reads.append(y)
+            return reader.read_row(y)
+        rows = list(lab.stream_edges(read_row, reader.height, reader.width))
+        assert [p for row in rows for p in row] == lab.edges(im)['pixels']
+        assert reads == list(range(reader.height))
+
+        for n in [1, 4, 25]:
+            reads.clear()
+            rows = list(lab.stream_blurred(read_row, reader.height, reader.width, n))
+            assert [p for row in rows for p in row] == lab.blurred(im, n)['pixels']
+            if n % 2 == 1:
+                assert reads == list(range(reader.height))
+
+
+
+def test_stream_pgm_out_of_core(tmp_path):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'smallmushroom.png')
+    im = lab.load_greyscale_image(inpfile)
+    w, h = im['width'], im['height']
+    pgmfile = str(tmp_path / 'mushroom.pgm')
+    lab.save_greyscale_rows((im['pixels'][y*w:(y+1)*w] for y in range(h)), w, h, pgmfile)
+    # a header with a comment in it still parses
+    commented = str(tmp_path / 'commented.pgm')
+    with open(pgmfile, 'rb') as f:
+        data = f.read()
+    with open(commented, 'wb') as f:
+        f.write(data.replace(b'P5\n', b'P5 # made by test\n', 1))
+
+    for filename in [pgmfile, commented]:
+        with lab.PGMRowReader(filename) as reader:
+            assert (reader.width, reader.height) == (w, h)
+            assert reader.read_row(h-1) == im['pixels'][(h-1)*w:]
+            outfile = str(tmp_path / 'edges.pgm')
+            lab.save_greyscale_rows(lab.stream_edges(reader.read_row, h, w), w, h, outfile)
+            compare_greyscale_images(lab.load_greyscale_image(outfile), lab.edges(im))
+            rows = lab.stream_blurred(reader.read_row, h, w, 3)
+            assert [p for row in rows for p in row] == lab.blurred(im, 3)['pixels']
+            with pytest.raises(IndexError):
+                reader.read_row(h)
+
+    with lab.RawRowReader(pgmfile, w, h, offset=len(data) - w*h) as reader:
+        assert reader.read_row(0) == im['pixels'][:w]
+    with open(pgmfile, 'wb') as f:
+        f.write(b'P2\n1 1\n255\n0\n')
+    with pytest.raises(ValueError):
+        lab.PGMRowReader(pgmfile)
+
+
+@pytest.mark.parametrize("size", [(0, 4), (4, 0)])
+def test_stream_empty_images(size):
+    height, width = size
+    read_row = lambda y: [0]*width
+    for n in [3, 4]:
+        assert list(lab.stream_blurred(read_row, height, width, n)) == [[]]*height
+    for boundary in ['zero', 'extend', 'wrap']:
+        rows = lab.stream_correlate(read_row, height, width, SEPARABLE_KERNELS['box'], boundary)
+        assert list(rows) == [[]]*height
+
+def test_color_filter_parallel():
+    import functools
+    from concurrent.futures import ProcessPoolExecutor
+    import parallel
+
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png')
+    im = lab.load_color_image(inpfile)
+    compact = lab.load_compact_image(inpfile)
+    with ProcessPoolExecutor(max_workers=3) as pool:
+        for filt in [lab.edges, lab.inverted, functools.partial(lab.blurred, n=5)]:
+            expected = lab.color_filter_from_greyscale_filter(filt)(im)
+            color_filt = parallel.color_filter_parallel(filt, executor=pool, min_pixels=0)
+            assert object_hash(color_filt(im)) == object_hash(expected)
+            compare_color_images(color_filt(compact).to_dict(), expected)
+    # tiny images never start a pool
+    result = parallel.color_filter_parallel(lambda image: lab.edges(image))(im)
+    compare_color_images(result, lab.color_filter_from_greyscale_filter(lab.edges)(im))
+
+
+def test_batch_parse_chain():
+    import batch
+
+    filters = batch.parse_chain('blur:9, edges,sharpen:7,invert')
+    assert len(filters) == 4 and filters[1] is lab.edges and filters[3] is lab.inverted
+    for spec in ['blur', 'blur:x', 'edges:3', 'emboss']:
+        with pytest.raises(ValueError):
+            batch.parse_chain(spec)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batch_run(tmp_path, workers):
+    import batch
+
+    files = [os.path.join(TEST_DIRECTORY, 'test_images', f'{name}.png') for name in ['smallfrog', 'centered_pixel_color']]
+    lines = []
+    summary = batch.run_batch(files, 'edges,blur:3', str(tmp_path), workers=workers, report=lines.append)
+    assert summary['images'] == 2 and len(lines) == 3
+    color = lab.color_filter_from_greyscale_filter
+    for name in ['smallfrog', 'centered_pixel_color']:
+        expected = lab.filter_cascade([color(lab.edges), color(lab.make_blur_filter(3))])(
+            lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', f'{name}.png')))
+        compare_color_images(lab.load_color_image(str(tmp_path / f'{name}.png')), expected)
+
+
+def test_batch_output_names(tmp_path):
+    import batch
+    from PIL import Image
+
+    for sub in ['a', 'b']:
+        os.makedirs(tmp_path / 'in' / sub)
+        Image.new('RGB', (4, 3), (10, 200, 30)).save(str(tmp_path / 'in' / sub / 'x.png'))
+    files = sorted(str(p) for p in (tmp_path / 'in').glob('**/*.png'))
+    batch.run_batch(files, 'invert', str(tmp_path / 'out'), workers=1, report=lambda line: None)
+    assert sorted(os.listdir(tmp_path / 'out')) == ['a', 'b']
+    assert os.listdir(tmp_path / 'out' / 'a') == ['x.png'] and os.listdir(tmp_path / 'out' / 'b') == ['x.png']
+
+    with pytest.raises(ValueError):
+        batch.output_names(['in/x.png', 'in/x.jpg'], 'out')
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batch_failed_images(tmp_path, workers):
+    import batch
+
+    broken = tmp_path / 'broken.png'
+    broken.write_bytes(b'not an image')
+    good = tmp_path / 'good.png'
+    good.write_bytes(open(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'), 'rb').read())
+    files = [str(broken), str(good)]
+    lines = []
+    summary = batch.run_batch(files, 'invert', str(tmp_path / 'out'), workers=workers, report=lines.append)
+    assert summary['images'] == 1 and [name for name, _ in summary['failed']] == [str(broken)]
+    assert any('failed' in line and 'broken.png' in line for line in lines)
+    assert os.listdir(tmp_path / 'out') == ['good.png']
+
+
+def test_batch_reports_as_images_finish(tmp_path):
+    import batch
+
+    # the large image is submitted first but finishes last
+    files = [os.path.join(TEST_DIRECTORY, 'test_images', f'{name}.png') for name in ['mushroom', 'centered_pixel']]
+    lines = []
+    summary = batch.run_batch(files, 'blur:9,edges,sharpen:9', str(tmp_path), workers=2, report=lines.append)
+    assert [os.path.basename(result[0]) for result in summary['results']] == ['centered_pixel.png', 'mushroom.png']
+    assert 'centered_pixel' in lines[0]
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'extend', 'wrap'])
+def test_correlate_fft(boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    for kernel in [{'dimension': 9, 'list_vals': [((i*7) % 11 - 5)/4 for i in range(81)]},
+                   {'dimension': 13, 'list_vals': [(i*5) % 7 - 3 for i in range(169)]},
+                   SEPARABLE_KERNELS['shifted']]:
+        expected = lab.correlate(im, kernel, boundary, method='direct')
+        assert lab.correlate(im, kernel, boundary, method='fft') == expected
+    kernel = {'dimension': 7, 'list_vals': [((i*7) % 11 - 5)/3 for i in range(49)]}
+    expected = lab.correlate(im, kernel, boundary, method='direct')
+    result = lab.correlate(im, kernel, boundary, method='fft')
+    assert all(abs(i-j) < 1e-9 for i, j in zip(result['pixels'], expected['pixels']))
+
+
+
+@pytest.mark.parametrize("size", [(0, 4), (4, 0), (0, 0)])
+def test_correlate_empty_images(size):
+    height, width = size
+    im = {'height': height, 'width': width, 'pixels': []}
+    for kernel in [SEPARABLE_KERNELS['box'], {'dimension': 3, 'list_vals': [0.1]*9}]:
+        for boundary in ['zero', 'extend', 'wrap']:
+            for method in ['auto', 'direct', 'fft']:
+                assert lab.correlate(im, kernel, boundary, method) == im
+
+def test_correlate_method_selection():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'cat.png'))
+    big = {'dimension': 31, 'list_vals': [((i*7) % 11 - 5)/4 for i in range(961)]}
+    assert lab.choose_correlate_method(im, big) == 'fft'
+    assert lab.choose_correlate_method(im, SEPARABLE_KERNELS['sobel_x']) == 'direct'
+    assert lab.choose_correlate_method(im, SEPARABLE_KERNELS['box'], lab.separate_kernel(SEPARABLE_KERNELS['box'])) == 'direct'
+    with pytest.raises(ValueError):
+        lab.correlate(im, big, 'zero', method='winograd')
+
+    # fft is only picked where snapping makes it exact
+    tenths = {'dimension': 31, 'list_vals': [0.1]*961}
+    assert lab.choose_correlate_method(im, tenths) == 'direct'
+    floats = {'height': im['height'], 'width': im['width'], 'pixels': [p + 0.5 for p in im['pixels']]}
+    assert lab.choose_correlate_method(floats, big) == 'direct'
+
+
+def test_numpy_backend_fft():
+    pytest.importorskip('numpy')
+    import numpy_backend
+
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    kernel = {'dimension': 9, 'list_vals': [((i*7) % 11 - 5)/4 for i in range(81)]}
+    for boundary in ['zero', 'extend', 'wrap']:
+        assert numpy_backend.correlate(im, kernel, boundary, 'fft') == lab.correlate(im, kernel, boundary, 'direct')
+
+
+def test_filter_cache(tmp_path):
+    import cache
+
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png')
+    im = lab.load_color_image(inpfile)
+    grey = lab.load_greyscale_image(inpfile)
+    results = cache.FilterCache(directory=str(tmp_path))
+
+    first = results.call(lab.blurred, grey, 5)
+    first['pixels'][0] = -1  # callers own their copies
+    compare_greyscale_images(results.call(lab.blurred, dict(grey), 5), lab.blurred(grey, 5))
+    assert results.hits == 1
+    compare_greyscale_images(results.apply(lab.make_blur_filter(5), grey), lab.blurred(grey, 5))
+    assert results.hits == 2
+
+    color = lab.color_filter_from_greyscale_filter
+    short = lab.filter_cascade([color(lab.edges), color(lab.make_blur_filter(3))])
+    long = lab.filter_cascade([color(lab.edges), color(lab.make_blur_filter(3)), color(lab.inverted)])
+    compare_color_images(results.apply(short, im), short(im))
+    calls = []
+    def spy(image):
+        calls.append(image)
+        return lab.edges(image)
+    spy.descriptor = ('edges',)
+    longer = lab.filter_cascade([color(spy), color(lab.make_blur_filter(3)), color(lab.inverted)])
+    compare_color_images(results.apply(longer, im), long(im))
+    assert calls == []  # the edges and blur prefix came from the cache
+
+    # a fresh cache on the same directory finds results on disk
+    disk = cache.FilterCache(directory=str(tmp_path))
+    compare_color_images(disk.apply(long, im), long(im))
+    assert disk.hits == 1 and disk.misses == 0
+
+
+def test_filter_cache_eviction():
+    import cache
+
+    grey = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    size = cache.image_size(grey)
+    results = cache.FilterCache(max_bytes=2*size)
+    results.call(lab.blurred, grey, 3)
+    results.call(lab.blurred, grey, 5)
+    results.call(lab.blurred, grey, 3)
+    results.call(lab.blurred, grey, 7)
+    assert results.total_bytes <= 2*size and len(results.entries) == 2
+    hits = results.hits
+    results.call(lab.blurred, grey, 3)
+    assert results.hits == hits + 1
+    results.call(lab.blurred, grey, 5)
+    assert results.hits == hits + 1
+
+
+def test_filter_cache_disk(tmp_path):
+    import cache
+
+    grey = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    images = [lab.blurred(grey, 3), lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png')),
+              lab.load_compact_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png')),
+              lab.correlate(grey, {'dimension': 3, 'list_vals': [0.1]*9}, 'extend')]
+    for image in images:
+        decoded = cache.decode_image(cache.encode_image(image))
+        if isinstance(image, lab.CompactImage):
+            assert (decoded.height, decoded.width, decoded.planes) == (image.height, image.width, image.planes)
+        else:
+            assert decoded == image
+    assert cache.encode_image({'height': 1, 'width': 2, 'pixels': [3, 300]}) is None
+    assert cache.decode_image(b'grey 2 2 1\n\x00') is None
+    assert cache.decode_image(b'\x80\x04garbage') is None
+
+    # the directory is trimmed to max_disk_bytes, least recently used first
+    size = len(cache.encode_image(images[0]))
+    results = cache.FilterCache(directory=str(tmp_path), max_disk_bytes=2*size+10)
+    for n in [3, 5, 7]:
+        results.call(lab.blurred, grey, n)
+    assert results.disk_bytes <= 2*size+10 and len(os.listdir(tmp_path)) == 2
+    fresh = cache.FilterCache(directory=str(tmp_path), max_disk_bytes=2*size+10)
+    assert fresh.disk_bytes == results.disk_bytes
+    compare_greyscale_images(fresh.call(lab.blurred, grey, 5), lab.blurred(grey, 5))
+    assert fresh.hits == 1
+    fresh.call(lab.blurred, grey, 9)
+    assert sorted(os.listdir(tmp_path)) == sorted(key + '.img' for key in fresh.disk_entries)
+    assert fresh.call(lab.blurred, grey, 5) and fresh.hits == 2
+    fresh.entries.clear()
+    fresh.call(lab.blurred, grey, 7)
+    assert fresh.misses == 2  # blurred 7 was removed from disk
+
+
+def test_round_div():
+    for numerator in range(-60, 61):
+        for denominator in [1, 2, 3, 4, 9, 25]:
+            assert lab.round_div(numerator, denominator) == round(numerator/denominator)
+    assert lab.round_div(7*10**30 + 5*10**29, 10**30) == 8
+
+
+@pytest.mark.parametrize("kernsize", [3, 9, 25])
+def test_sharpened_fixed_point(kernsize):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    kernel = {'dimension': kernsize, 'list_vals': [1/(kernsize*kernsize)]*kernsize*kernsize}
+    blur = lab.round_and_clip_image(lab.correlate_direct(im, kernel, 'extend'))['pixels']
+    expected = lab.round_and_clip_image({'height': im['height'], 'width': im['width'],
+                                         'pixels': [2*i-j for i, j in zip(im['pixels'], blur)]})
+    compare_greyscale_images(lab.sharpened(im, kernsize), expected)
+
+
+def test_round_and_clip_does_not_mutate():
+    im = {'height': 1, 'width': 4, 'pixels': [-3.2, 12.5, 255.7, 40]}
+    result = lab.round_and_clip_image(im)
+    assert im['pixels'] == [-3.2, 12.5, 255.7, 40]
+    assert result['pixels'] == [0, 12, 255, 40]
+
+    pixels = im['pixels']
+    assert lab.round_and_clip_image(im, out=im) is im
+    assert im['pixels'] is pixels
+    assert pixels == [0, 12, 255, 40]
+
+
+@pytest.mark.parametrize("name, args", [
+    ('inverted', ()),
+    ('correlate', (SEPARABLE_KERNELS['sobel_x'], 'wrap')),
+    ('correlate', ({'dimension': 3, 'list_vals': [0.5, 2, -1, 4, 0.25, 6, 7, -8, 1]}, 'zero')),
+    ('correlate', ({'dimension': 13, 'list_vals': [(i*5) % 7 - 3 for i in range(169)]}, 'extend', 'fft')),
+    ('round_and_clip_image', ()),
+    ('blurred', (3,)),
+    ('sharpened', (5,)),
+    ('edges', ()),
+])
+def test_filters_write_into_out(name, args):
+    filt = getattr(lab, name)
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
+    expected = filt(im, *args)
+
+    out = {'height': im['height'], 'width': im['width'], 'pixels': [0]*(im['height']*im['width'])}
+    pixels = out['pixels']
+    assert filt(im, *args, out=out) is out
+    assert out['pixels'] is pixels
+    compare_greyscale_images(out, expected)
+
+    # the input itself may be the output buffer
+    original = im['pixels']
+    assert filt(im, *args, out=im) is im
+    assert im['pixels'] is original
+    compare_greyscale_images(im, expected)
+
+    with pytest.raises(ValueError):
+        filt(expected, *args, out={'height': 1, 'width': 1, 'pixels': [0]})
+
+
+def test_compact_filters_write_into_out():
+    frame = lab.load_compact_image(os.path.join(TEST_DIRECTORY, 'test_images', 'tree.png'))
+    out = lab.CompactImage(frame.height, frame.width, [bytearray(frame.height*frame.width) for _ in range(3)])
+    planes = list(out.planes)
+    for filt in [lab.inverted, lab.edges, lambda image, out: lab.sharpened(image, 3, out=out)]:
+        expected = filt(frame, None)
+        assert filt(frame, out) is out
+        assert all(a is b for a, b in zip(out.planes, planes))
+        assert out.planes == expected.planes
+
+
+def test_rgb_to_greyscale_exact():
+    # every tie-prone color with r == g, plus a spread of mixed colors
+    r = bytes(range(256))*3 + bytes((7*i) % 256 for i in range(4096))
+    g = bytes(range(256))*3 + bytes((13*i) % 256 for i in range(4096))
+    b = bytes(range(256)) + bytes(255-i for i in range(256)) + bytes(range(256)) + bytes((i*i) % 256 for i in range(4096))
+    expected = [round(.299 * i + .587 * j + .114 * k) for i, j, k in zip(r, g, b)]
+    assert list(lab.rgb_to_greyscale(r, g, b)) == expected
+
+    pytest.importorskip('numpy')
+    import numpy_backend
+    previous = lab.set_backend(numpy_backend)
+    try:
+        assert list(lab.rgb_to_greyscale(r, g, b)) == expected
+    finally:
+        lab.set_backend(previous)
+
+
+@pytest.mark.parametrize("fname", ['smallfrog', 'tree', 'centered_pixel'])
+def test_save_round_trip(fname, tmp_path):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', f'{fname}.png')
+    color = lab.load_color_image(inpfile)
+    grey = lab.load_greyscale_image(inpfile)
+    for image, save, load in [(color, lab.save_color_image, lab.load_color_image),
+                              (lab.CompactImage.from_dict(color), lab.save_color_image, lab.load_color_image),
+                              (grey, lab.save_greyscale_image, lab.load_greyscale_image),
+                              (lab.CompactImage.from_dict(grey), lab.save_greyscale_image, lab.load_greyscale_image)]:
+        outfile = str(tmp_path / 'saved.png')
+        save(image, outfile)
+        assert load(outfile)['pixels'] == (color if load is lab.load_color_image else grey)['pixels']
+
+
+def test_video_pipeline(tmp_path):
+    import io
+    import video
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'tree.png')
+    first = lab.load_compact_image(inpfile)
+    frames = [first, lab.inverted(first), lab.blurred(first, 3)]
+    filt = lab.filter_cascade([lab.color_filter_from_greyscale_filter(lab.edges),
+                               lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))])
+    expected = [filt(frame) for frame in frames]
+
+    raw = io.BytesIO()
+    assert video.write_raw(raw, frames) == 3
+    raw.seek(0)
+    out = io.BytesIO()
+    assert video.process_video(video.read_raw(raw, first.width, first.height), filt,
+                               lambda f: video.write_raw(out, f), max_in_flight=1) == 3
+    out.seek(0)
+    got = list(video.read_raw(out, first.width, first.height))
+    assert [frame.planes for frame in got] == [frame.planes for frame in expected]
+
+    assert video.write_directory(frames, str(tmp_path / 'frames')) == 3
+    got = list(video.filter_frames(video.read_directory(str(tmp_path / 'frames')), filt))
+    assert [frame.planes for frame in got] == [frame.planes for frame in expected]
+
+    # identical consecutive frames would be merged into one by the GIF encoder
+    grey = [lab.load_compact_image(inpfile, color=False)]
+    grey.append(lab.inverted(grey[0]))
+    assert video.write_gif((frame for frame in grey), str(tmp_path / 'clip.gif')) == 2
+    got = list(video.read_gif(str(tmp_path / 'clip.gif'), color=False))
+    assert [frame.planes for frame in got] == [frame.planes for frame in grey]
+
+
+def test_prefetch_errors_and_early_close():
+    import video
+
+    def frames():
+        yield 1
+        yield 2
+        raise ValueError('bad frame')
+
+    stream = video.prefetch(frames(), 1)
+    assert next(stream) == 1
+    assert next(stream) == 2
+    with pytest.raises(ValueError):
+        next(stream)
+
+    closed = []
+
+    def endless():
+        try:
+            while True:
+                yield 0
+        finally:
+            closed.append(True)
+
+    stream = video.prefetch(endless(), 2)
+    assert next(stream) == 0
+    stream.close()
+    assert closed == [True]
+
+
+def test_bench_report_and_compare():
+    import json
+    import bench
+    results = bench.run_benchmarks([8], [3], ['wrap'], repeat=1, report=lambda line: None)
+    names = [entry['name'] for entry in results['results']]
+    assert 'correlate/8/3/wrap' in names and 'cascade/8/3' in names and 'color_edges/8' in names
+    assert all(entry['seconds'] > 0 for entry in results['results'])
+    results = json.loads(json.dumps(results))
+
+    baseline = json.loads(json.dumps(results))
+    for entry in baseline['results']:
+        entry['seconds'] *= 2 if entry['name'] == 'edges/8' else 0.5
+    verdicts = {row[0]: row[4] for row in bench.compare(results, baseline, 0.1)}
+    assert verdicts['edges/8'] == 'faster'
+    assert verdicts['blurred/8/3'] == 'slower'
+
+    skipped = bench.run_benchmarks([8], [3], ['wrap'], max_seconds=0, report=lambda line: None)
+    assert all('skipped' in entry for entry in skipped['results'])
+
+    # estimates follow the path correlate takes for each kernel
+    estimates = {case['name']: case['estimate'] for case in bench.cases([256], [25], ['zero'])}
+    assert estimates['correlate/256/25/zero'] == 256*256*25*25*lab.DIRECT_TAP_SECONDS
+    assert estimates['correlate_ones/256/25/zero'] == 256*256*2*25*lab.DIRECT_TAP_SECONDS
+    assert estimates['correlate_peak/256/25/zero'] < estimates['correlate/256/25/zero']
+    skipped = bench.run_benchmarks([256], [25], ['zero'], repeat=1, max_seconds=0.5,
+                                   report=lambda line: None)
+    assert 'skipped' in {entry['name']: entry for entry in skipped['results']}['correlate/256/25/zero']
+
+
+def sobel_reference(im, norm):
+    kx = {'dimension': 3, 'list_vals': [-1, 0, 1, -2, 0, 2, -1, 0, 1]}
+    ky = {'dimension': 3, 'list_vals': [-1, -2, -1, 0, 0, 0, 1, 2, 1]}
+    o_x = lab.correlate_direct(im, kx, 'extend')['pixels']
+    o_y = lab.correlate_direct(im, ky, 'extend')['pixels']
+    if norm == 'l1':
+        pixels = [abs(i) + abs(j) for i, j in zip(o_x, o_y)]
+    else:
+        pixels = [round((i**2 + j**2)**(1/2)) for i, j in zip(o_x, o_y)]
+    return lab.round_and_clip_image({'height': im['height'], 'width': im['width'], 'pixels': pixels})
+
+
+@pytest.mark.parametrize("norm", ['l2', 'l1'])
+@pytest.mark.parametrize("fname", ['pattern', 'centered_pixel', 'smallfrog', 'chess'])
+def test_edges_fused(fname, norm):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', f'{fname}.png'))
+    expected = sobel_reference(im, norm)
+    compare_greyscale_images(lab.edges(im, norm=norm), expected)
+    # float images take the two-correlation path
+    floats = {'height': im['height'], 'width': im['width'], 'pixels': [float(p) for p in im['pixels']]}
+    compare_greyscale_images(lab.edges(floats, norm=norm), expected)
+
+
+
+@pytest.mark.parametrize("size", [(0, 4), (4, 0), (0, 0)])
+def test_edges_empty_images(size):
+    height, width = size
+    im = {'height': height, 'width': width, 'pixels': []}
+    for norm in ['l2', 'l1']:
+        assert lab.edges(im, norm=norm) == {'height': height, 'width': width, 'pixels': []}
+    rows = list(lab.stream_edges(lambda y: [], height, width))
+    assert rows == [[]]*height
+
+def test_edges_fused_extremes():
+    # single rows and columns, and gradients far beyond the clipping point
+    for height, width in [(1, 1), (1, 7), (6, 1), (4, 5)]:
+        pixels = [255*((x + y) % 2) for y in range(height) for x in range(width)]
+        im = {'height': height, 'width': width, 'pixels': pixels}
+        for norm in ['l2', 'l1']:
+            compare_greyscale_images(lab.edges(im, norm=norm), sobel_reference(im, norm))
+    with pytest.raises(ValueError):
+        lab.edges(im, norm='l3')
+
+
+def test_numpy_backend_edges_l1():
+    pytest.importorskip('numpy')
+    import numpy_backend
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallmushroom.png'))
+    previous = lab.set_backend(numpy_backend)
+    try:
+        result = lab.edges(im, norm='l1')
+    finally:
+        lab.set_backend(previous)
+    compare_greyscale_images(result, lab.edges(im, norm='l1'))
+
+
+def test_pyramid_levels():
+    im = {'height': 5, 'width': 7, 'pixels': [37]*35}
+    levels = lab.pyramid(im)
+    assert [(level['height'], level['width']) for level in levels] == [(5, 7), (3, 4), (2, 2), (1, 1)]
+    assert all(level['pixels'] == [37]*(level['height']*level['width']) for level in levels)
+    assert lab.upsampled(levels[1], 5, 7) == im
+    assert len(lab.pyramid(im, 2)) == 2
+
+    # a ramp keeps its mean and stays monotonic through the prefilter
+    ramp = {'height': 1, 'width': 8, 'pixels': [0, 32, 64, 96, 128, 160, 192, 224]}
+    half = lab.downsampled(ramp)['pixels']
+    assert half == sorted(half) and sum(half)/len(half) == 112
+    with pytest.raises(ValueError):
+        lab.upsampled(ramp, 1, 17)
+
+    color = lab.load_compact_image(os.path.join(TEST_DIRECTORY, 'test_images', 'tree.png'))
+    small = lab.pyramid(color, 3)[-1]
+    assert small.is_color() and (small.height, small.width) == ((color.height+3)//4, (color.width+3)//4)
+
+
+@pytest.mark.parametrize("fname", ['cat', 'smallfrog'])
+def test_blurred_approximate(fname):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', f'{fname}.png'))
+    # small kernels are not worth a pyramid level, and stay exact
+    assert lab.blurred(im, 5, approximate=True) == lab.blurred(im, 5)
+
+    exact = lab.blurred(im, 25)['pixels']
+    approximate = lab.blurred(im, 25, approximate=True)
+    assert (approximate['height'], approximate['width']) == (im['height'], im['width'])
+    errors = [abs(a - b) for a, b in zip(exact, approximate['pixels'])]
+    assert sum(errors)/len(errors) < 3
+    assert all(isinstance(p, int) and 0 <= p <= 255 for p in approximate['pixels'])
+
+
+def test_profiling_records_stages_and_channels():
+    import profiling
+    im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel_color.png'))
+    color_edges = lab.color_filter_from_greyscale_filter(lab.edges)
+    color_blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))
+
+    def flipped(image):
+        return {'height': image['height'], 'width': image['width'], 'pixels': image['pixels'][::-1]}
+    cascade = lab.filter_cascade([color_edges, color_blur, flipped])
+    seen = []
+    with profiling.profile(callback=seen.append, memory=True) as p:
+        result = cascade(im)
+        color_edges(im)
+        p.wrap(lab.blurred)(lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png')), 3)
+    assert lab.profiler is None
+    compare_color_images(result, flipped(color_blur(color_edges(im))))
+
+    paths = [record['path'] for record in p.records]
+    assert seen == p.records
+    assert paths[-1] == 'blurred'
+    for path in ['cascade', 'cascade > stage 1: channels', 'cascade > stage 1: channels > green',
+                 'cascade > stage 1: channels > green > stage 2: blurred(3)', 'cascade > stage 2: flipped',
+                 'red', 'green', 'blue']:
+        assert path in paths
+    for record in p.records:
+        assert record['pixels'] == im['height']*im['width']
+        assert record['seconds'] >= 0 and record['peak_bytes'] >= 0
+    cascade_record = p.records[paths.index('cascade')]
+    assert cascade_record['depth'] == 0
+    assert cascade_record['peak_bytes'] >= max(r['peak_bytes'] for r in p.records if r['path'].startswith('cascade >'))
+    assert p.summary()[0]['seconds'] >= p.summary()[-1]['seconds']
+    assert 'cascade > stage 1: channels' in p.report()
+
+
+def test_lazy_graph_optimization():
+    import lazy
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    node = lazy.inverted(lazy.inverted(lazy.round_and_clip_image(lazy.blurred(im, 3))))
+    assert node.optimized().kind == 'filter'
+    assert repr(node.optimized()) == 'blurred(3)(image(%dx%d))' % (im['height'], im['width'])
+    assert lazy.inverted(lazy.inverted(im)).optimized().kind == 'source'
+
+    # consecutive point ops fuse into one node, and rounding stays when needed
+    floats = {'height': 1, 'width': 3, 'pixels': [0.4, 254.6, 300.0]}
+    node = lazy.round_and_clip_image(lazy.inverted(lazy.point(floats, 'halved', lambda c: c/2)))
+    optimized = node.optimized()
+    assert optimized.kind == 'point' and optimized.input.kind == 'source'
+    assert [name for name, _ in optimized.ops] == ['halved', 'inverted', 'round_and_clip_image']
+    assert node['pixels'] == [255, 128, 105]
+    assert floats['pixels'] == [0.4, 254.6, 300.0]
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'extend', 'wrap'])
+def test_lazy_matches_eager_and_crops(boundary):
+    import lazy
+    for fname, color in [('centered_pixel', False), ('smallfrog', False), ('tree', True)]:
+        path = os.path.join(TEST_DIRECTORY, 'test_images', f'{fname}.png')
+        im = lab.load_color_image(path) if color else lab.load_greyscale_image(path)
+        kernel = {'dimension': 5, 'list_vals': [(i % 7) - 3 for i in range(25)]}
+        node = lazy.round_and_clip_image(lazy.correlate(lazy.inverted(lazy.sharpened(lazy.edges(im), 3)), kernel, boundary))
+        node = lazy.blurred(node, 3)
+
+        def eager(image):
+            image = lab.sharpened(lab.edges(image), 3)
+            image = lab.round_and_clip_image(lab.correlate(lab.inverted(image), kernel, boundary))
+            return lab.blurred(image, 3)
+        expected = lab.color_filter_from_greyscale_filter(eager)(im) if color else eager(im)
+
+        for region in [(0, 0, im['height'], im['width']), (0, 0, 2, 3), (im['height']-3, im['width']-4, 3, 4),
+                       (im['height']//2, 1, 1, im['width']-2)]:
+            assert node.evaluate(region) == lab.cropped(expected, region), region
+        assert node['pixels'] == expected['pixels']
+
+    with pytest.raises(ValueError):
+        node.evaluate((0, 0, im['height']+1, 1))
+
+
+class RecordingPixels(list):
+    # a pixel list that remembers which indices were read
+    def __init__(self, pixels):
+        super().__init__(pixels)
+        self.read = set()
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            self.read.add(index)
+        return super().__getitem__(index)
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'extend', 'wrap'])
+def test_region_filters(boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    kernel = {'dimension': 7, 'list_vals': [(i % 5) - 2 for i in range(49)]}
+    filters = [
+        lambda image, **kw: lab.correlate(image, kernel, boundary, **kw),
+        lambda image, **kw: lab.blurred(image, 5, **kw),
+        lambda image, **kw: lab.sharpened(image, 3, **kw),
+        lambda image, **kw: lab.edges(image, **kw),
+        lambda image, **kw: lab.inverted(image, **kw),
+        lambda image, **kw: lab.round_and_clip_image(image, **kw),
+    ]
+    regions = [(0, 0, 5, 7), (im['height']-4, im['width']-9, 4, 9), (10, 20, 16, 16),
+               (0, 0, im['height'], im['width'])]
+    for filt in filters:
+        full = filt(im)
+        for region in regions:
+            assert filt(im, region=region) == lab.cropped(full, region)
+
+    # only the region and the kernel's halo are read
+    pixels = RecordingPixels(im['pixels'])
+    lab.correlate({'height': im['height'], 'width': im['width'], 'pixels': pixels}, kernel, boundary,
+                  region=(10, 20, 16, 16))
+    assert len(pixels.read - {0}) <= (16+6)*(16+6)
+
+    out = {'height': 2, 'width': 3, 'pixels': [0]*6}
+    assert lab.edges(im, out=out, region=(3, 4, 2, 3)) is out
+    with pytest.raises(ValueError):
+        lab.blurred(im, 3, region=(0, 0, im['height']+1, 1))
+
+
+def test_region_compact_image():
+    color = lab.load_compact_image(os.path.join(TEST_DIRECTORY, 'test_images', 'tree.png'))
+    region = (5, 7, 20, 30)
+    for filt in [lab.edges, lab.inverted, lambda image, **kw: lab.blurred(image, 7, **kw)]:
+        result = filt(color, region=region)
+        assert isinstance(result, lab.CompactImage)
+        assert result.planes == lab.cropped(filt(color), region).planes
+
+
+def rank_reference(im, n, rank, boundary):
+    # sort every window, reading pixels through advanced_get_pixel
+    result = []
+    for y in range(im['height']):
+        for x in range(im['width']):
+            window = sorted(lab.advanced_get_pixel(im, x+i, y+j, boundary)
+                            for j in range(-(n//2), n//2+1) for i in range(-(n//2), n//2+1))
+            result.append(window[rank])
+    return {'height': im['height'], 'width': im['width'], 'pixels': result}
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'extend', 'wrap'])
+def test_rank_filters(boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
+    frog = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    frog = lab.cropped(frog, (5, 10, 24, 36))
+    for image in [im, frog]:
+        for n, rank in [(1, 0), (3, 4), (5, 0), (5, 24), (7, 10)]:
+            compare_greyscale_images(lab.rank_filtered(image, n, rank, boundary),
+                                     rank_reference(image, n, rank, boundary))
+        compare_greyscale_images(lab.median_filtered(image, 3, boundary), rank_reference(image, 3, 4, boundary))
+        compare_greyscale_images(lab.eroded(image, 3, boundary), rank_reference(image, 3, 0, boundary))
+        compare_greyscale_images(lab.dilated(image, 3, boundary), rank_reference(image, 3, 8, boundary))
+
+    # the dense column histograms give the same answers, as do float images
+    previous = lab.DENSE_RANK_WINDOW
+    lab.DENSE_RANK_WINDOW = 3
+    try:
+        for n, rank in [(3, 4), (5, 12), (5, 24)]:
+            compare_greyscale_images(lab.rank_filtered(frog, n, rank, boundary), rank_reference(frog, n, rank, boundary))
+    finally:
+        lab.DENSE_RANK_WINDOW = previous
+    floats = {'height': frog['height'], 'width': frog['width'], 'pixels': [p/2 for p in frog['pixels']]}
+    assert lab.median_filtered(floats, 3, boundary) == rank_reference(floats, 3, 4, boundary)
+
+    assert lab.median_filtered(frog, 5, boundary, region=(3, 4, 10, 12)) == \
+        lab.cropped(lab.median_filtered(frog, 5, boundary), (3, 4, 10, 12))
+    with pytest.raises(ValueError):
+        lab.median_filtered(frog, 4, boundary)
+    with pytest.raises(ValueError):
+        lab.rank_filtered(frog, 3, 9, boundary)
+    assert lab.median_filtered(frog, 3, 'mirror') is None
+
+
+
+@pytest.mark.parametrize("size", [(0, 4), (4, 0), (0, 0)])
+def test_rank_filters_empty_images(size):
+    height, width = size
+    im = {'height': height, 'width': width, 'pixels': []}
+    for boundary in ['zero', 'extend', 'wrap']:
+        for n in [3, 15]:
+            assert lab.median_filtered(im, n, boundary) == im
+            assert lab.eroded(im, n, boundary) == lab.dilated(im, n, boundary) == im
+
+def test_rank_filters_compact():
+    color = lab.load_compact_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel_color.png'))
+    result = lab.median_filtered(color, 3)
+    assert isinstance(result, lab.CompactImage) and result.is_color()
+    expected = [lab.median_filtered(channel, 3)['pixels'] for channel in color.channels()]
+    assert [list(plane) for plane in result.planes] == expected
+
+
+def test_lookup_tables():
+    op = lambda c: (c*3) % 256
+    table = lab.lookup_table(op)
+    assert table == [op(c) for c in range(256)] and not hasattr(op, 'table')
+    assert lab.lookup_table(lab.inverted.point_op) is lab.inverted.point_op.table
+    assert lab.lookup_table(op, {4, 9})[:10] == [0, 0, 0, 0, 12, 0, 0, 0, 0, 27]
+    assert lab.lookup_table(lab.inverted.point_op, {4}) is lab.inverted.point_op.table
+    pixels = [(i*37) % 256 for i in range(1000)]
+    assert lab.apply_lookup_table(pixels, table) == [op(c) for c in pixels]
+    assert lab.apply_lookup_table(bytearray(pixels), table) == bytearray(op(c) for c in pixels)
+    # tables leaving the 8-bit range are indexed, pixels outside it are refused
+    assert lab.apply_lookup_table(pixels, [c/2 for c in range(256)]) == [c/2 for c in pixels]
+    assert lab.apply_lookup_table(pixels + [256], table) is None
+    assert lab.apply_lookup_table(pixels + [1.5], table) is None
+
+    im = {'height': 40, 'width': 25, 'pixels': pixels}
+    assert lab.apply_point_op(im, lambda c: c+300)['pixels'] == [c+300 for c in pixels]
+    floats = {'height': 40, 'width': 25, 'pixels': [c+0.5 for c in pixels]}
+    assert lab.inverted(floats)['pixels'] == [254.5-c for c in pixels]
+
+    composed = lab.compose_point_ops(lab.tabulated(op), lab.inverted.point_op)
+    assert composed.table == [255-op(c) for c in range(256)]
+    assert composed(1.5) == 255-4.5
+    assert not hasattr(lab.compose_point_ops(op, lab.inverted.point_op), 'table')
+
+
+def test_apply_per_pixel_keeps_no_table():
+    state = {'offset': 5}
+    def shift(c):
+        assert c in (0, 7), 'only values in the image are looked up'
+        return c + state['offset']
+    im = {'height': 20, 'width': 20, 'pixels': [0, 7]*200}
+    assert lab.apply_per_pixel(im, shift)['pixels'] == [5, 12]*200
+    state['offset'] = 10
+    assert lab.apply_per_pixel(im, shift)['pixels'] == [10, 17]*200
+    assert not hasattr(shift, 'table')
+
+
+def test_brightness_is_clipped():
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png')
+    im = lab.load_color_image(inpfile)
+    for n in [-70, 40]:
+        expected = [tuple(min(max(c+n, 0), 255) for c in p) for p in im['pixels']]
+        assert lab.filter_brightness(im, n)['pixels'] == expected
+        compact = lab.filter_brightness(lab.load_compact_image(inpfile), n)
+        assert isinstance(compact, lab.CompactImage) and compact.to_dict()['pixels'] == expected
+
+
+def test_tone_curve_cascade():
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png')
+    im = lab.load_compact_image(inpfile)
+    filters = [lab.make_brightness_filter(-30), lab.make_contrast_filter(1.5), lab.inverted,
+               lab.make_gamma_filter(0.5), lab.make_brightness_filter(10)]
+    stages = lab.plan_cascade([lab.color_filter_from_greyscale_filter(f) for f in filters])
+    assert [kind for kind, _ in stages[0][1]] == ['point']
+
+    expected = im.to_dict()
+    for filt in filters:
+        expected = lab.color_filter_from_greyscale_filter(filt)(expected)
+    result = lab.filter_cascade([lab.color_filter_from_greyscale_filter(f) for f in filters])(im)
+    compare_color_images(result.to_dict(), expected)
+    assert lab.describe_filter(filters[1]) == 'contrast(1.5)'
+
+
+SEAM_IMAGES = {'pattern': 'pattern_color', 'smallfrog': 'smallfrog', 'bluegill': 'bluegill',
+               'twocats': 'twocats', 'tree': 'tree', 'centered_pixel': 'centered_pixel_color'}
+
+
+@pytest.mark.parametrize("name", sorted(SEAM_IMAGES))
+def test_seam_steps(name):
+    def expected(suffix):
+        with open(os.path.join(TEST_DIRECTORY, 'test_results', f'{name}_{suffix}.pickle'), 'rb') as f:
+            return pickle.load(f)
+
+    im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', f'{SEAM_IMAGES[name]}.png'))
+    grey = lab.greyscale_image_from_color_image(im)
+    greyfile = os.path.join(TEST_DIRECTORY, 'test_results', f'{name}_grey.png')
+    if os.path.exists(greyfile):
+        compare_greyscale_images(grey, lab.load_greyscale_image(greyfile))
+    energy = lab.compute_energy(grey)
+    assert energy['pixels'] == expected('energy')['pixels']
+    cem = lab.cumulative_energy_map(energy)
+    assert cem['pixels'] == expected('cumulative_energy')['pixels']
+    seam = lab.minimum_energy_seam(cem)
+    assert seam == expected('minimum_energy_seam')
+    seamfile = os.path.join(TEST_DIRECTORY, 'test_results', f'{name}_1seam.png')
+    if os.path.exists(seamfile):
+        compare_color_images(lab.image_without_seam(im, seam), lab.load_color_image(seamfile))
+
+
+@pytest.mark.parametrize("name, fname", [('pattern', 'pattern_color'), ('centered_pixel', 'centered_pixel_color'),
+                                         ('smallfrog', 'smallfrog'), ('mushroom', 'smallmushroom')])
+def test_seam_carving(name, fname):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', f'{fname}.png')
+    im = lab.load_color_image(inpfile)
+    seams = sorted(os.listdir(os.path.join(TEST_DIRECTORY, 'test_results', f'seams_{name}')))
+    for count in sorted({1, len(seams)//2, len(seams)}):
+        expected = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_results', f'seams_{name}', seams[count-1]))
+        compare_color_images(lab.seam_carving(im, count), expected)
+    result = lab.seam_carving(lab.load_compact_image(inpfile), len(seams))
+    assert isinstance(result, lab.CompactImage)
+    compare_color_images(result.to_dict(), expected)
+    assert im == lab.load_color_image(inpfile)
+    with pytest.raises(ValueError):
+        lab.seam_carving(im, im['width'])
+
+
+def test_carved_energy_matches_full_recompute():
+    im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    grey = lab.greyscale_image_from_color_image(im)
+    energy = lab.compute_energy(grey)
+    for _ in range(grey['width']-1):
+        seam = lab.minimum_energy_seam(lab.cumulative_energy_map(energy))
+        grey = lab.image_without_seam(grey, seam)
+        energy = lab.carved_energy(energy, grey, seam)
+        assert energy == lab.compute_energy(grey)
+
+
 if __name__ == '__main__':
     import os
     import sys
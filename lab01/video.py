@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Filter sequences of frames (animated GIFs, directories of images, or raw
+frame bytes) with the lab.py filters
+
+Decoding, filtering, and encoding run as a pipeline: a reader thread decodes
+frames ahead of the filter stage, a second thread filters them (or hands them
+to an executor), and the caller encodes the results, with at most
+max_in_flight frames waiting between any two stages.  The filter is built
+once, so its cascade plan is reused for every frame, and so are lab.py's
+boundary tables, which are cached by frame size.  Pixel buffers are not
+reused: frames are handed between threads and may be held by the consumer
+for any length of time, so every decoded and filtered frame has planes of
+its own (only the raw reader's and writer's interleaved file buffers are
+kept for the whole run).
+
+Invoked as, for example:
+   python3 video.py clip.gif 'edges,blur:3' edges.gif
+   python3 video.py frames/ 'sharpen:5' sharpened/ --grey
+   python3 video.py clip.rgb 'blur:9' blurred.rgb --size 640x360
+
+   filt = lab.filter_cascade([color_edges, color_blur])
+   process_video(read_gif('clip.gif'), filt, lambda frames: write_gif(frames, 'out.gif'))
+"""
+
+import os
+import sys
+import glob
+import queue
+import argparse
+import threading
+from collections import deque
+
+from PIL import Image
+
+import lab
+import batch
+
+
+def read_gif(filename, color=True):
+    '''
+    Yield the frames of an (animated) GIF as CompactImages
+    '''
+    with Image.open(filename) as img:
+        w, h = img.size
+        for index in range(getattr(img, 'n_frames', 1)):
+            img.seek(index)
+            frame = img.convert('RGB')  # palette frames, possibly partial
+            if color:
+                planes = [bytearray(band.tobytes()) for band in frame.split()]
+            else:
+                planes = [lab.greyscale_plane(frame)]
+            yield lab.CompactImage(h, w, planes)
+
+
+def read_directory(directory, pattern='*.png', color=True):
+    '''
+    Yield the images in directory matching pattern, in name order, as
+    CompactImages
+    '''
+    for filename in sorted(glob.glob(os.path.join(directory, pattern))):
+        yield lab.load_compact_image(filename, color)
+
+
+def read_raw(f, width, height, color=True):
+    '''
+    Yield frames from a binary file of back-to-back raw frames, each
+    height*width pixels of interleaved RGB bytes (or single greyscale bytes
+    if color is False), as CompactImages
+
+    Each frame is read into the same buffer and split into new planes.
+    '''
+    channels = 3 if color else 1
+    buffer = bytearray(width*height*channels)
+    view = memoryview(buffer)
+    while True:
+        filled = 0
+        while filled < len(buffer):
+            count = f.readinto(view[filled:])
+            if not count:
+                break
+            filled += count
+        if filled == 0:
+            return
+        if filled < len(buffer):
+            raise ValueError('Truncated frame: %d of %d bytes' % (filled, len(buffer)))
+        # the slices are copies, so the read buffer is free for the next frame
+        yield lab.CompactImage(height, width, [buffer[i::channels] for i in range(channels)])
+
+
+def write_gif(frames, filename, duration=100, loop=0):
+    '''
+    Save frames as an animated GIF, showing each for duration milliseconds
+
+    Frames are converted one at a time as PIL asks for them, so the
+    pipeline's backpressure still holds.  GIF output is not streamed,
+    though: PIL's encoder keeps every (palettized) frame until the end of
+    the clip to work out frame differences.  Use write_directory or
+    write_raw for clips that should not be held in memory.
+
+    Returns:
+    The number of frames written
+    '''
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        raise ValueError('No frames to write')
+    count = 1
+
+    def rest():
+        nonlocal count
+        for frame in frames:
+            count += 1
+            yield lab.pil_image(frame, 'RGB' if frame.is_color() else 'L')
+
+    image = lab.pil_image(first, 'RGB' if first.is_color() else 'L')
+    image.save(filename, save_all=True, append_images=rest(), duration=duration, loop=loop)
+    return count
+
+
+def write_directory(frames, directory, pattern='frame%05d.png'):
+    '''
+    Save each frame as its own image in directory
+
+    Returns:
+    The number of frames written
+    '''
+    os.makedirs(directory, exist_ok=True)
+    count = 0
+    for count, frame in enumerate(frames, 1):
+        filename = os.path.join(directory, pattern % (count-1))
+        if frame.is_color():
+            lab.save_color_image(frame, filename)
+        else:
+            lab.save_greyscale_image(frame, filename)
+    return count
+
+
+def write_raw(f, frames):
+    '''
+    Write frames to a binary file in the layout read_raw reads
+
+    Returns:
+    The number of frames written
+    '''
+    buffer = bytearray()
+    count = 0
+    for count, frame in enumerate(frames, 1):
+        channels = len(frame.planes)
+        size = frame.height*frame.width*channels
+        if len(buffer) != size:
+            buffer = bytearray(size)
+        for i, plane in enumerate(frame.planes):
+            buffer[i::channels] = plane
+        f.write(buffer)
+    return count
+
+
+def put_unless_stopped(ready, item, stop):
+    # block on the bounded queue, but give up once the consumer has gone away
+    while not stop.is_set():
+        try:
+            ready.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def prefetch(iterable, max_in_flight=4):
+    '''
+    Iterate over iterable in a background thread, keeping at most
+    max_in_flight items ready ahead of the consumer
+
+    Exceptions raised by iterable are re-raised in the consumer, and closing
+    this generator early stops (and closes) iterable.
+    '''
+    ready = queue.Queue(maxsize=max_in_flight)
+    stop = threading.Event()
+    iterator = iter(iterable)
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put_unless_stopped(ready, (False, item), stop):
+                    return
+            put_unless_stopped(ready, (True, None), stop)
+        except BaseException as e:
+            put_unless_stopped(ready, (True, e), stop)
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            done, item = ready.get()
+            if done:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def filter_frames(frames, filt, max_in_flight=4, executor=None):
+    '''
+    Apply filt to every frame, decoding the next frames in a background
+    thread meanwhile
+
+    Parameters:
+    * frames: iterable of images (dicts or CompactImages)
+    * filt: filter to apply, typically built once with lab.filter_cascade
+    * max_in_flight (int): bound on frames decoded (or submitted) ahead
+    * executor (Executor): optional pool to filter several frames at once;
+      with a ProcessPoolExecutor, filt must be picklable (see
+      parallel.color_filter_parallel)
+
+    Returns:
+    A generator of filtered frames, in order, each a new image that the
+    caller may keep
+    '''
+    frames = prefetch(frames, max_in_flight)
+    if executor is None:
+        for frame in frames:
+            yield filt(frame)
+        return
+
+    pending = deque()
+    for frame in frames:
+        pending.append(executor.submit(filt, frame))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def process_video(frames, filt, write, max_in_flight=4, executor=None):
+    '''
+    Run the whole pipeline: decode frames in one thread, filter them in
+    another, and encode them with write(filtered_frames) in this thread
+
+    Returns:
+    Whatever write returns
+    '''
+    return write(prefetch(filter_frames(frames, filt, max_in_flight, executor), max_in_flight))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply a filter chain to every frame of a clip.')
+    parser.add_argument('source', help='GIF, directory of PNGs, or raw frame file (with --size)')
+    parser.add_argument('chain', help="filters to apply in order, e.g. 'edges,blur:3'")
+    parser.add_argument('destination', help='GIF, raw frame file (with --size input), or directory')
+    parser.add_argument('--size', help='WIDTHxHEIGHT of raw input frames')
+    parser.add_argument('--grey', action='store_true', help='convert to greyscale first')
+    parser.add_argument('--duration', type=int, default=None, help='GIF frame duration in ms')
+    parser.add_argument('--max-in-flight', type=int, default=4, help='frames buffered between stages')
+    parsed = parser.parse_args(argv)
+
+    try:
+        filters = batch.parse_chain(parsed.chain)
+    except ValueError as e:
+        parser.error(str(e))
+    if not parsed.grey:
+        filters = [lab.color_filter_from_greyscale_filter(filt) for filt in filters]
+    filt = lab.filter_cascade(filters)
+    color = not parsed.grey
+
+    duration = parsed.duration
+    raw_input = None
+    if os.path.isdir(parsed.source):
+        frames = read_directory(parsed.source, color=color)
+    elif parsed.size:
+        try:
+            width, height = [int(v) for v in parsed.size.lower().split('x')]
+        except ValueError:
+            parser.error('--size must look like 640x360')
+        raw_input = open(parsed.source, 'rb')
+        frames = read_raw(raw_input, width, height, color)
+    else:
+        if duration is None:
+            with Image.open(parsed.source) as img:
+                duration = img.info.get('duration', 100)
+        frames = read_gif(parsed.source, color)
+
+    destination = parsed.destination
+    try:
+        if destination.lower().endswith('.gif'):
+            count = process_video(frames, filt, lambda f: write_gif(f, destination, duration or 100),
+                                  parsed.max_in_flight)
+        elif parsed.size and not os.path.isdir(destination):
+            with open(destination, 'wb') as out:
+                count = process_video(frames, filt, lambda f: write_raw(out, f), parsed.max_in_flight)
+        else:
+            count = process_video(frames, filt, lambda f: write_directory(f, destination),
+                                  parsed.max_in_flight)
+    finally:
+        if raw_input is not None:
+            raw_input.close()
+    print('%d frames written to %s' % (count, destination))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())